@@ -8,18 +8,29 @@ from dotenv import load_dotenv
 from flask_caching import Cache
 from threading import Thread
 import requests
+import tempfile
 from openai_integration import OpenAIIntegration
 
+# Antes dos módulos de utils: a configuração deles (REDIS_URL, FONTE_AGREGACAO...) é lida ao importar
+load_dotenv()
 
 from decorator import require_valid_token
 from utils.supabaseUtil import get_supabase
-from utils.parse_faturas import parse_faturas
 from getFaturas import get_faturas
-from utils.utils import is_valid_nif, get_periodo_datas, buscar_faturas_periodo, parse_periodo, calcular_stats, agrupar_por_hora, gerar_comparativo_por_hora, limpar_cache_por_nif , calcular_variacao_dados, gerar_dados_resumo_ia, processar_faturas_otimizado
+from utils.rollup import construir_rollup, HORA_DESCONHECIDA
+from utils.hoje import celulas_hoje
+from utils.agregacao import agregar_periodo, agregar_periodos, agregar_grupo
+from utils.heatmap import NOMES_DIAS, ATUAL, ANTERIOR
+from utils.filiais import metricas_filiais
+from utils.consultas import consulta_faturas
+from utils.geracoes import chave_com_geracao, invalidar_cache, invalidar_cache_faturas
+from utils.cache_rotas import CacheRotas, ttl_periodo, TTL_POR_PERIODO, TTL_ANALISE_IA_POR_PERIODO, TTL_PADRAO
+from utils.ingestao import processar_ficheiro
+from utils.jobs_ingestao import criar_job, obter_job, job_do_nif
+from utils.utils import is_valid_nif, get_periodo_datas, parse_periodo, calcular_stats, agrupar_por_hora, gerar_comparativo_por_hora, limpar_cache_por_nif , calcular_variacao_dados, gerar_dados_resumo_ia
 
 
 # Configuração
-load_dotenv()
 app = Flask(__name__)
 CORS(app)
 
@@ -30,6 +41,7 @@ app.config.from_mapping({
     'CACHE_DEFAULT_TIMEOUT': 180,
 })
 cache = Cache(app)
+cache_rotas = CacheRotas(cache)
 supabase = get_supabase()
 TZ = pytz.timezone('Europe/Lisbon')
 
@@ -39,17 +51,92 @@ def current_time_str(fmt='%H:%M'):
     return datetime.now(TZ).strftime(fmt)
 
 
-def cache_key():
-    nif = request.args.get('nif', '')
-    periodo = request.args.get('periodo', '0')
-    return f"{request.path}/{nif}/{periodo}"
+def chave_analise_ia(nif, filial, periodo):
+    return chave_com_geracao(f"analise_ia:{nif}:{filial or 'todas'}:{periodo}", nif, filial)
 
-def cache_key_analise_completa():
-    """Chave de cache específica para análise completa"""
-    nif = request.args.get('nif', '')
-    filial = request.args.get('filial', '')
-    periodo = request.args.get('periodo', '0')
-    return f"analise_completa/{nif}/{filial}/{periodo}"
+def montar_resumo(periodo, dados_processados):
+    """Resposta do resumo de um período a partir do resultado da agregação"""
+    total_at, rec_at, it_at, tk_at = dados_processados['stats_atual']
+    total_bt, rec_bt, it_bt, tk_bt = dados_processados['stats_anterior']
+
+    return {
+        'periodo': parse_periodo(periodo),
+        'total_vendas': calcular_variacao_dados(total_at, total_bt),
+        'numero_recibos': calcular_variacao_dados(rec_at, rec_bt),
+        'itens_vendidos': calcular_variacao_dados(it_at, it_bt),
+        'ticket_medio': calcular_variacao_dados(tk_at, tk_bt),
+        'comparativo_por_hora': dados_processados['comparativo_por_hora']
+    }
+
+def montar_produtos(periodo, data_inicio, data_fim, produtos, top=0):
+    """
+    Resposta de produtos do período atual a partir de ProdutosPeriodos.
+    OTIMIZAÇÃO: Seleção parcial para o top-K; ordenação completa só sem top.
+    """
+    ti, mi, _ = produtos.totais(ATUAL)
+    ranking = produtos.top(ATUAL, top) if top else produtos.ordenados(ATUAL)
+    itens = [
+        {
+            'produto': d['produto'],
+            'quantidade': d['quantidade'],
+            'montante': round(d['montante'], 2),
+            'porcentagem_montante': round(d['montante'] / mi * 100, 2) if mi else 0.0
+        } for d in ranking
+    ]
+
+    return {
+        'periodo': parse_periodo(periodo),
+        'data_inicio': str(data_inicio),
+        'data_fim': str(data_fim),
+        'total_itens': ti,
+        'total_montante': round(mi, 2),
+        'total_produtos': produtos.quantidade_produtos(ATUAL),
+        'itens': itens
+    }
+
+def montar_heatmap(periodo, datas, heatmap):
+    """Resposta do heatmap hora × dia da semana a partir de HeatmapPeriodos"""
+    data_inicio, data_fim, data_inicio_anterior, data_fim_anterior = datas
+
+    # Células com dados, totais e picos de ambos os períodos vêm do motor de heatmap
+    dados_heatmap = heatmap.celulas(ATUAL)
+    total_volume, total_faturas = heatmap.totais(ATUAL)
+    total_volume_anterior, total_faturas_anterior = heatmap.totais(ANTERIOR)
+
+    return {
+        "dados": dados_heatmap,
+        "estatisticas": {
+            "total_volume": round(total_volume, 2),
+            "total_faturas": total_faturas,
+            "periodo": parse_periodo(periodo),
+            "data_inicio": str(data_inicio),
+            "data_fim": str(data_fim),
+            "quantidade_celulas_com_dados": len(dados_heatmap),
+            "variacao_volume": calcular_variacao_dados(total_volume, total_volume_anterior),
+            "variacao_faturas": calcular_variacao_dados(total_faturas, total_faturas_anterior)
+        },
+        "periodo_anterior": {
+            "total_volume": round(total_volume_anterior, 2),
+            "total_faturas": total_faturas_anterior,
+            "data_inicio": str(data_inicio_anterior),
+            "data_fim": str(data_fim_anterior)
+        },
+        "picos": heatmap.picos(ATUAL),
+        "nomes_dias": NOMES_DIAS,
+        "horas_disponiveis": [f"{h:02d}:00" for h in range(24)]
+    }
+
+CAMPOS_RESPOSTA_FATURAS = ("id", "data", "total", "numero_fatura", "hora", "nif_cliente")
+
+def montar_faturas(data_inicio, data_fim, faturas):
+    """Resposta da listagem de faturas de um período, só com os campos públicos"""
+    return {
+        "faturas": [{campo: fatura.get(campo) for campo in CAMPOS_RESPOSTA_FATURAS} for fatura in faturas],
+        "periodo": {
+            "inicio": str(data_inicio),
+            "fim": str(data_fim)
+        }
+    }
 
 def precache_essenciais(nif, token):
     base = 'http://localhost:8000/api'
@@ -69,38 +156,45 @@ def home():
     return "hello"
 
 
+# Campos que cada rota lê de faturas_fatura (ver utils.consultas)
+CAMPOS_ULTIMOS_7_DIAS = ('data', 'total')
+CAMPOS_REPORT = ('data', 'hora', 'total')
+CAMPOS_FATURA_PDF = ('texto_completo', 'qrcode')
+CAMPOS_TODAS_FATURAS = ('numero_fatura', 'total', 'hora', 'data', 'nif_cliente')
+
 @app.route('/api/stats/today', methods=['GET'])
 @require_valid_token
-@cache.cached(timeout=180, key_prefix=cache_key)
+@cache_rotas.cached('stats_hoje', ('nif',), ttl=TTL_POR_PERIODO[0], swr=True)
 def stats():
     nif = request.args.get('nif', '')
     if not nif.isdigit():
         return jsonify({'error': 'NIF é obrigatório e deve conter apenas números'}), 400
 
     hoje = date.today()
-    # query faturas
-    res = supabase.table('faturas_fatura').select('*, itens:faturas_itemfatura(*)') \
-        .eq('nif', nif).eq('data', hoje.isoformat()).execute()
-    faturas = [f for f in (res.data or []) if str(f.get('nif')) == nif]
-
-    total_vendas = sum(float(f['total']) for f in faturas)
-    total_itens = sum(item['quantidade'] for f in faturas for item in f.get('itens', []))
-    produtos = sorted(({'produto': k, 'quantidade': v} for k, v in 
-                       defaultdict(int, ((item['nome'], item['quantidade'])
-                        for f in faturas for item in f.get('itens', []))).items()),
-                      key=lambda x: x['quantidade'], reverse=True)
+    # OTIMIZAÇÃO: Hoje vem do acumulado incremental, que só lê as faturas novas
+    celulas = celulas_hoje(nif)
 
+    total_vendas = sum(c['total'] for c in celulas.values())
+    total_itens = sum(c['itens'] for c in celulas.values())
+    quantidade_faturas = sum(c['recibos'] for c in celulas.values())
+
+    quantidades = defaultdict(int)
     vendas_por_hora = defaultdict(float)
-    for f in faturas:
-        h = f.get('hora', '')[:2] + ':00'
-        vendas_por_hora[h] += float(f['total']) if f.get('hora') else 0
+    for (_, hora), celula in celulas.items():
+        for nome, produto in celula['produtos'].items():
+            quantidades[nome] += produto['quantidade']
+        if hora != HORA_DESCONHECIDA:
+            vendas_por_hora[f"{hora:02d}:00"] += celula['total']
+    produtos = sorted(({'produto': k, 'quantidade': v} for k, v in quantidades.items()),
+                      key=lambda x: x['quantidade'], reverse=True)
+
     base = {'08:00', '12:00', '18:00'} | set(vendas_por_hora)
     vendas_horarias = [{'hora': h, 'total': round(vendas_por_hora.get(h, 0), 2)} for h in sorted(base)]
 
-    # últimos 7 dias
+    # últimos 7 dias: só data e total, sem itens
     ontem = hoje - timedelta(days=1)
     inicio = hoje - timedelta(days=7)
-    res7 = supabase.table('faturas_fatura').select('data, total') \
+    res7 = consulta_faturas(supabase, CAMPOS_ULTIMOS_7_DIAS).eq('nif', nif) \
         .gte('data', inicio.isoformat()).lte('data', ontem.isoformat()).execute()
     vendas7 = defaultdict(float)
     for f in res7.data or []:
@@ -113,7 +207,7 @@ def stats():
         'vendas_por_dia': [{'data': str(hoje), 'total': round(total_vendas, 2)}],
         'vendas_por_hora': vendas_horarias,
         'vendas_por_produto': produtos,
-        'quantidade_faturas': len(faturas),
+        'quantidade_faturas': quantidade_faturas,
         'filtro_data': str(hoje),
         'ultima_atualizacao': current_time_str(),
         'ultimos_7_dias': ult7,
@@ -123,7 +217,7 @@ def stats():
 
 @app.route('/api/stats/report', methods=['GET'])
 @require_valid_token
-@cache.cached(timeout=180, key_prefix=cache_key)
+@cache_rotas.cached('report', ('nif',), ttl=TTL_POR_PERIODO[0], swr=True)
 def report():
     nif = request.args.get('nif', '')
     if not nif:
@@ -132,10 +226,11 @@ def report():
     ontem = hoje - timedelta(days=1)
     inicio = hoje - timedelta(days=7)
 
-    fetch = lambda q: (supabase.table('faturas_fatura').select('*')
-                       .eq(*q).execute().data or [])
-    fh = fetch(('data', hoje.isoformat())), fetch(('gte', inicio.isoformat()), ('lte', ontem.isoformat()))
-    f_hoje, f_7d = fh
+    # OTIMIZAÇÃO: Só data, hora e total de cada fatura, sem texto nem itens
+    fetch = lambda ini, fim: (consulta_faturas(supabase, CAMPOS_REPORT).eq('nif', nif)
+                              .gte('data', ini.isoformat()).lte('data', fim.isoformat())
+                              .execute().data or [])
+    f_hoje, f_7d = fetch(hoje, hoje), fetch(inicio, ontem)
 
     def agg(fats):
         d = defaultdict(lambda: {'volume': 0.0, 'quantidade': 0})
@@ -170,7 +265,7 @@ def report():
 
 @app.route('/api/products', methods=['GET'])
 @require_valid_token
-@cache.cached(timeout=180, key_prefix=cache_key)
+@cache_rotas.cached('produtos', ('nif', 'filial', 'periodo', 'top'), swr=True)
 def products():
     nif = request.args.get('nif', '').strip()
     filial = request.args.get('filial', '').strip() or None  # Se não vier, será None
@@ -183,41 +278,22 @@ def products():
     except:
         return jsonify({'error': 'Período inválido.'}), 400
 
+    # top=N devolve só os N produtos de maior montante; sem top, a lista completa
+    try:
+        top = int(request.args.get('top', 0))
+    except ValueError:
+        return jsonify({'error': 'top inválido. Deve ser um número inteiro positivo.'}), 400
+    if top < 0:
+        return jsonify({'error': 'top inválido. Deve ser um número inteiro positivo.'}), 400
+
     try:
         di, df, dia, df_an = get_periodo_datas(p)
     except ValueError as e:
         return jsonify({'error': str(e)}), 400
 
-    # Buscar faturas com ou sem filtro por filial
-    fats = buscar_faturas_periodo(nif, di, df, filial=filial)
-
-    cont = defaultdict(lambda: {'quantidade': 0, 'montante': 0.0})
-    ti = mi = 0
-
-    for f in fats:
-        for it in f.get('faturas_itemfatura', []):
-            cont[it['nome']]['quantidade'] += it['quantidade']
-            cont[it['nome']]['montante'] += it['quantidade'] * float(it['preco_unitario'])
-            ti += it['quantidade']
-            mi += it['quantidade'] * float(it['preco_unitario'])
-
-    itens = sorted([
-        {
-            'produto': k,
-            'quantidade': d['quantidade'],
-            'montante': round(d['montante'], 2),
-            'porcentagem_montante': round(d['montante'] / mi * 100, 2) if mi else 0.0
-        } for k, d in cont.items()
-    ], key=lambda x: x['montante'], reverse=True)
-
-    result = {
-        'periodo': parse_periodo(p),
-        'data_inicio': str(di),
-        'data_fim': str(df),
-        'total_itens': ti,
-        'total_montante': round(mi, 2),
-        'itens': itens
-    }
+    # Totais por produto do período atual, com ou sem filtro por filial
+    produtos = agregar_periodo(nif, di, df, filial=filial)['produtos']
+    result = montar_produtos(p, di, df, produtos, top)
 
     chave_cache = f'ultima_atualizacao:{nif}'
     if filial:
@@ -253,31 +329,62 @@ def limpar_cache_analise_completa():
         return jsonify({'error': 'NIF é obrigatório'}), 400
     
     try:
-        # Limpar cache específico da análise completa
         chaves_limpas = 0
+        geracao = None
         
         if periodo:
-            # Limpar cache específico do período
-            cache_key = f"analise_completa/{nif}/{filial}/{periodo}"
-            if cache.delete(cache_key):
+            # Limpar cache específico do período (a chave da geração atual)
+            if cache_rotas.apagar('analise_completa', {'nif': nif, 'filial': filial, 'periodo': periodo}):
                 chaves_limpas += 1
         else:
-            # Limpar todos os caches da análise completa para este NIF
-            for p in range(6):  # Períodos 0-5
-                cache_key = f"analise_completa/{nif}/{filial}/{p}"
-                if cache.delete(cache_key):
-                    chaves_limpas += 1
+            # Todos os períodos: um INCR da geração do NIF/filial retira todas as entradas
+            geracao = invalidar_cache(nif, filial)
         
         return jsonify({
             'success': True,
             'message': f'Cache da análise completa limpo para NIF {nif}',
             'chaves_limpas': chaves_limpas,
+            'geracao': geracao,
             'timestamp': datetime.now().isoformat()
         }), 200
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/rollup/construir', methods=['POST'])
+@require_valid_token
+def construir_rollup_route():
+    """
+    Constrói (backfill) o rollup horário de um NIF.
+    Por omissão cobre desde o início do ano anterior até ontem, o suficiente para todos os períodos.
+    """
+    nif = request.args.get('nif', '').strip()
+    if not is_valid_nif(nif):
+        return jsonify({'error': 'NIF é obrigatório e deve conter apenas números'}), 400
+
+    hoje = date.today()
+    try:
+        data_inicio = date.fromisoformat(request.args.get('data_inicio') or hoje.replace(year=hoje.year - 1, month=1, day=1).isoformat())
+        data_fim = date.fromisoformat(request.args.get('data_fim') or (hoje - timedelta(days=1)).isoformat())
+    except ValueError:
+        return jsonify({'error': 'Datas inválidas. Use o formato AAAA-MM-DD'}), 400
+
+    if data_inicio > data_fim:
+        return jsonify({'error': 'data_inicio deve ser anterior a data_fim'}), 400
+
+    try:
+        celulas = construir_rollup(nif, data_inicio, data_fim)
+        return jsonify({
+            'success': True,
+            'nif': nif,
+            'data_inicio': str(data_inicio),
+            'data_fim': str(data_fim),
+            'dias_com_vendas': len(celulas),
+            'timestamp': datetime.now().isoformat()
+        }), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/ultima-atualizacao', methods=['GET'])
 @require_valid_token
 def ultima_atualizacao():
@@ -288,7 +395,15 @@ def ultima_atualizacao():
     return jsonify({'nif': nif, 'ultima_atualizacao': val}), 200
 
 
+@app.route('/api/cache/estatisticas', methods=['GET'])
+@require_valid_token
+def estatisticas_cache():
+    """Hits e misses do cache das rotas por família, neste worker"""
+    return jsonify({'pid': os.getpid(), 'familias': cache_rotas.estatisticas()}), 200
+
+
 @app.route('/api/stats/resumo', methods=['GET'])
+@cache_rotas.cached('resumo', ('nif', 'filial', 'periodo'), swr=True)
 def resumo_stats():
     if request.method == "OPTIONS":
         response = jsonify({"message": "OK"})
@@ -313,30 +428,9 @@ def resumo_stats():
     except ValueError as e:
         return jsonify({'error': str(e)}), 400
 
-    # OTIMIZAÇÃO: Uma única chamada ao banco para ambos os períodos
-    # Buscar faturas do período mais amplo (anterior + atual)
-    data_mais_antiga = min(dia, di)
-    data_mais_recente = max(dfan, df)
-    
-    # Uma única consulta ao banco
-    faturas_completas = buscar_faturas_periodo(nif, data_mais_antiga, data_mais_recente, filial=filial)
-    
-    # Processar todas as faturas de uma vez usando a função otimizada
-    dados_processados = processar_faturas_otimizado(faturas_completas, di, df, dia, dfan)
-    
-    # Extrair dados processados
-    total_at, rec_at, it_at, tk_at = dados_processados['stats_atual']
-    total_bt, rec_bt, it_bt, tk_bt = dados_processados['stats_anterior']
-    comp = dados_processados['comparativo_por_hora']
-
-    data = {
-        'periodo': parse_periodo(p),
-        'total_vendas': calcular_variacao_dados(total_at, total_bt),
-        'numero_recibos': calcular_variacao_dados(rec_at, rec_bt),
-        'itens_vendidos': calcular_variacao_dados(it_at, it_bt),
-        'ticket_medio': calcular_variacao_dados(tk_at, tk_bt),
-        'comparativo_por_hora': comp
-    }
+    # OTIMIZAÇÃO: Uma única leitura e uma única passagem para ambos os períodos
+    dados_processados = agregar_periodo(nif, di, df, dia, dfan, filial=filial)
+    data = montar_resumo(p, dados_processados)
 
     chave_cache = f'ultima_atualizacao:{nif}'
     if filial:
@@ -347,8 +441,198 @@ def resumo_stats():
     return jsonify(data), 200
 
 
+@app.route('/api/stats/resumo/batch', methods=['GET'])
+@require_valid_token
+@cache_rotas.cached('resumo_batch', ('nif', 'filial', 'periodos'), ttl=TTL_POR_PERIODO, swr=True)
+def resumo_stats_batch():
+    """
+    Resumos de vários períodos num só pedido (ex.: periodos=0,1,2,3,4,5).
+    OTIMIZAÇÃO: O intervalo que cobre todos os períodos é lido uma única vez
+    e agregado por período sobre os mesmos dados.
+    """
+    nif = request.args.get('nif', '').strip()
+    filial = request.args.get('filial', '').strip() or None
+
+    if not is_valid_nif(nif):
+        return jsonify({'error': 'NIF inválido'}), 400
+
+    try:
+        periodos = sorted({int(p) for p in request.args.get('periodos', '0,1,2,3,4,5').split(',') if p.strip()})
+        datas = {p: get_periodo_datas(p) for p in periodos}
+    except ValueError:
+        return jsonify({'error': 'Períodos inválidos. Use números de 0 a 5 separados por vírgula.'}), 400
+
+    if not periodos:
+        return jsonify({'error': 'Períodos inválidos. Use números de 0 a 5 separados por vírgula.'}), 400
+
+    resultados = agregar_periodos(nif, datas, filial=filial)
+
+    return jsonify({
+        'nif': nif,
+        'filial': filial,
+        'periodos': {str(p): montar_resumo(p, resultados[p]) for p in periodos}
+    }), 200
+
+
+# Máximo de NIFs por pedido de grupo (limita o tamanho do filtro in)
+MAX_NIFS_GRUPO = int(os.getenv('MAX_NIFS_GRUPO', 50))
+
+
+@app.route('/api/grupo/resumo', methods=['GET'])
+@require_valid_token
+@cache_rotas.cached('grupo', ('nifs', 'filiais', 'periodo'))
+def resumo_grupo():
+    """
+    Resumo consolidado de um grupo de NIFs e filiais, com a repartição por NIF
+    (ex.: nifs=123,456&filiais=Loja 1,Loja 2&periodo=3).
+    OTIMIZAÇÃO: Uma única leitura para todo o grupo e uma única passagem que
+    agrega por NIF e no total, em vez de um pedido por entidade.
+    """
+    nifs = list(dict.fromkeys(n.strip() for n in request.args.get('nifs', '').split(',') if n.strip()))
+    filiais = [f.strip() for f in request.args.get('filiais', '').split(',') if f.strip()] or None
+
+    if not nifs or not all(is_valid_nif(n) for n in nifs):
+        return jsonify({'error': 'nifs é obrigatório: lista de NIFs (só números) separados por vírgula'}), 400
+    if len(nifs) > MAX_NIFS_GRUPO:
+        return jsonify({'error': f'Máximo de {MAX_NIFS_GRUPO} NIFs por pedido'}), 400
+
+    try:
+        p = int(request.args.get('periodo', '0'))
+        di, df, dia, dfan = get_periodo_datas(p)
+    except ValueError:
+        return jsonify({'error': 'Período inválido. Deve ser um número inteiro de 0 a 5.'}), 400
+
+    total, por_nif = agregar_grupo(nifs, di, df, dia, dfan, filiais=filiais)
+    volume_total = total['stats_atual'][0]
+
+    entidades = []
+    for nif in nifs:
+        dados = por_nif[nif]
+        volume = dados['stats_atual'][0]
+        entidades.append({
+            'nif': nif,
+            **montar_resumo(p, dados),
+            'participacao': round(volume / volume_total * 100, 2) if volume_total else 0.0,
+            'filiais': metricas_filiais(dados)
+        })
+    entidades.sort(key=lambda e: e['participacao'], reverse=True)
+
+    return jsonify({
+        'nifs': nifs,
+        'filiais': filiais,
+        'periodo': parse_periodo(p),
+        'data_inicio': str(di),
+        'data_fim': str(df),
+        'consolidado': montar_resumo(p, total),
+        'entidades': entidades
+    }), 200
+
+
+@app.route('/api/filiais/comparacao', methods=['GET'])
+@require_valid_token
+@cache_rotas.cached('filiais_comparacao', ('nif', 'periodo'), swr=True)
+def comparacao_filiais():
+    """
+    Compara as filiais de um NIF no período: volume, faturas, itens, ticket médio,
+    curva horária, quota do total e variação face ao período anterior.
+    OTIMIZAÇÃO: Uma única leitura e passagem; as métricas por filial são
+    acumuladas junto com as restantes.
+    """
+    nif = request.args.get('nif', '').strip()
+    if not is_valid_nif(nif):
+        return jsonify({'error': 'NIF é obrigatório e deve conter apenas números'}), 400
+
+    try:
+        p = int(request.args.get('periodo', '0'))
+        di, df, dia, dfan = get_periodo_datas(p)
+    except ValueError:
+        return jsonify({'error': 'Período inválido. Deve ser um número inteiro de 0 a 5.'}), 400
+
+    dados_processados = agregar_periodo(nif, di, df, dia, dfan)
+    filiais = metricas_filiais(dados_processados, comparar=True)
+
+    return jsonify({
+        'nif': nif,
+        'periodo': parse_periodo(p),
+        'data_inicio': str(di),
+        'data_fim': str(df),
+        'total_filiais': len(filiais),
+        'total_volume': round(dados_processados['stats_atual'][0], 2),
+        'filiais': filiais
+    }), 200
+
+
+SECOES_DASHBOARD = ('resumo', 'produtos', 'heatmap', 'faturas')
+
+
+@app.route('/api/dashboard', methods=['GET'])
+@require_valid_token
+@cache_rotas.cached('dashboard', ('nif', 'filial', 'periodo', 'sections', 'top'), swr=True)
+def dashboard():
+    """
+    Secções do dashboard de um nif/filial/período num só pedido
+    (ex.: sections=resumo,produtos,heatmap,faturas).
+    OTIMIZAÇÃO: Uma única leitura e uma única passagem de agregação alimentam
+    todas as secções, em vez de um pedido e uma leitura por secção.
+    Cada secção tem o mesmo formato que a rota correspondente.
+    """
+    nif = request.args.get('nif', '').strip()
+    filial = request.args.get('filial', '').strip() or None
+
+    if not is_valid_nif(nif):
+        return jsonify({'error': 'NIF é obrigatório e deve conter apenas números'}), 400
+
+    secoes = [s.strip() for s in request.args.get('sections', ','.join(SECOES_DASHBOARD)).split(',') if s.strip()]
+    invalidas = [s for s in secoes if s not in SECOES_DASHBOARD]
+    if not secoes or invalidas:
+        return jsonify({'error': f"Secções inválidas. Use: {', '.join(SECOES_DASHBOARD)}"}), 400
+
+    try:
+        p = int(request.args.get('periodo', '0'))
+        top = int(request.args.get('top', 0))
+    except ValueError:
+        return jsonify({'error': 'Período ou top inválido. Devem ser números inteiros.'}), 400
+    if top < 0:
+        return jsonify({'error': 'top inválido. Deve ser um número inteiro positivo.'}), 400
+
+    try:
+        datas = get_periodo_datas(p)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    di, df, dia, dfan = datas
+
+    # As faturas só existem na leitura em bruto; sem elas serve o rollup
+    dados_processados = agregar_periodo(nif, di, df, dia, dfan, filial=filial, manter_faturas='faturas' in secoes)
+
+    resultado = {'nif': nif, 'filial': filial, 'periodo': parse_periodo(p)}
+    if 'resumo' in secoes:
+        resultado['resumo'] = montar_resumo(p, dados_processados)
+    if 'produtos' in secoes:
+        resultado['produtos'] = montar_produtos(p, di, df, dados_processados['produtos'], top)
+    if 'heatmap' in secoes:
+        resultado['heatmap'] = montar_heatmap(p, datas, dados_processados['heatmap'])
+    if 'faturas' in secoes:
+        resultado['faturas'] = montar_faturas(di, df, dados_processados['faturas_atual'])
+
+    return jsonify(resultado), 200
+
+
+def invalidar_cache_faturas_criadas(criadas):
+    """
+    Invalida o cache dos NIFs/filiais das faturas criadas e retorna quantos NIFs foram afetados.
+    OTIMIZAÇÃO: Um INCR por (NIF, filial) em vez de apagar chave a chave.
+    """
+    return len(invalidar_cache_faturas(criadas))
+
+
 @app.route('/api/upload-fatura', methods=['POST'])
+@require_valid_token
 def upload_fatura():
+    """
+    Recebe um ficheiro de faturas.
+    Por omissão grava-o em disco, coloca a ingestão na fila e responde 202 com o job_id;
+    com sincrono=true processa no próprio pedido e responde com o resultado.
+    """
     if 'file' not in request.files:
         return jsonify({'erro': 'Arquivo não enviado'}), 400
 
@@ -356,102 +640,78 @@ def upload_fatura():
     if not f.filename:
         return jsonify({'erro': 'Arquivo sem nome'}), 400
 
-    try:
-        text = f.read().decode('utf-8')
-    except UnicodeDecodeError:
-        return jsonify({'erro': 'Arquivo com codificação inválida. Use UTF-8'}), 400
+    if request.args.get('sincrono', 'false').lower() != 'true':
+        # O estado do job só é visível para o NIF declarado aqui e para os emitentes das faturas criadas
+        nif = request.args.get('nif', '').strip()
+        if nif and not is_valid_nif(nif):
+            return jsonify({'erro': 'NIF inválido'}), 400
+
+        # O worker do pedido só grava o ficheiro; a ingestão corre no pool de jobs
+        descritor, caminho = tempfile.mkstemp(prefix='upload-fatura-', suffix='.txt')
+        os.close(descritor)
+        f.save(caminho)
+        job_id = criar_job(caminho, f.filename, ao_concluir=invalidar_cache_faturas_criadas, nif=nif or None)
+        return jsonify({
+            'mensagem': 'Ficheiro recebido, ingestão em background',
+            'job_id': job_id,
+            'estado': f'/api/upload-fatura/{job_id}?nif={nif}' if nif else f'/api/upload-fatura/{job_id}'
+        }), 202
 
     try:
-        fats = parse_faturas(text)
-        if not fats:
-            return jsonify({'erro': 'Nenhuma fatura válida encontrada no arquivo'}), 400
-    except Exception as e:
+        resultado = processar_ficheiro(f.stream)
+    except ValueError as e:
         return jsonify({'erro': str(e)}), 400
 
-    criadas, erros = [], []
-
-    for fa in fats:
-        # Agora 'filial' também é obrigatório
-        campos_obrigatorios = ['numero_fatura', 'data', 'hora', 'total', 'nif_emitente', 'nif_cliente', 'itens', 'filial']
-        if any(not fa.get(c) for c in campos_obrigatorios):
-            erros.append({
-                'numero_fatura': fa.get('numero_fatura', 'desconhecido'),
-                'erro': 'Campos obrigatórios faltando'
-            })
-            continue
-
-        nf = fa['numero_fatura'].replace('/', '_').replace(' ', '')
-        now = datetime.utcnow().isoformat()
-
-        try:
-            res = supabase.table('faturas_fatura').insert({
-                'numero_fatura': nf,
-                'data': fa['data'],
-                'hora': fa['hora'],
-                'total': float(fa['total']),
-                'texto_original': fa['texto_original'],
-                'texto_completo': fa['texto_completo'],
-                'qrcode': fa['qrcode'],
-                'filial': fa['filial'],  # 👈 campo filial incluído
-                'nif': fa['nif_emitente'],
-                'nif_cliente': fa['nif_cliente'],
-                'criado_em': now,
-                'atualizado_em': now
-            }).execute()
-
-            if not res.data:
-                raise ValueError('Falha ao inserir fatura no banco de dados')
-
-            fid = res.data[0]['id']
-
-            for it in fa['itens']:
-                supabase.table('faturas_itemfatura').insert({
-                    'fatura_id': fid,
-                    'nome': it['nome'],
-                    'quantidade': it['quantidade'],
-                    'preco_unitario': float(it['preco_unitario']),
-                    'total': float(it['total'])
-                }).execute()
-
-            criadas.append(res.data[0])
+    if resultado['ingerido']:
+        ingerido = resultado['ingerido']
+        return jsonify({
+            'mensagem': 'Ficheiro já processado anteriormente, nenhuma fatura inserida',
+            'faturas': [],
+            'erros': [],
+            'duplicadas': [],
+            'ficheiro_duplicado': True,
+            'faturas_no_ficheiro': ingerido.get('faturas', 0),
+            'processado_em': ingerido.get('processado_em'),
+            'cache_limpo': 0
+        }), 200
 
-        except Exception as e:
-            msg = str(e)
-            erros.append({'numero_fatura': nf, 'erro': msg})
+    criadas, erros, duplicadas = resultado['criadas'], resultado['erros'], resultado['duplicadas']
+    cache_limpo = invalidar_cache_faturas_criadas(criadas) if criadas else 0
 
-    # Limpar cache da análise completa para os NIFs das faturas criadas
     if criadas:
-        nifs_afetados = set()
-        for fatura in criadas:
-            nifs_afetados.add(fatura.get('nif'))
-        
-        # Limpar cache para todos os períodos e filiais dos NIFs afetados
-        for nif_afetado in nifs_afetados:
-            for periodo in range(6):  # Períodos 0-5
-                # Limpar cache sem filial específica
-                cache_key = f"analise_completa/{nif_afetado}//{periodo}"
-                cache.delete(cache_key)
-                
-                # Limpar cache com filial (se houver)
-                for fatura in criadas:
-                    if fatura.get('nif') == nif_afetado:
-                        filial_fatura = fatura.get('filial', '')
-                        if filial_fatura:
-                            cache_key_filial = f"analise_completa/{nif_afetado}/{filial_fatura}/{periodo}"
-                            cache.delete(cache_key_filial)
-
-    status = 201 if criadas else 400
+        status = 201
+    elif duplicadas and not erros:
+        status = 200
+    else:
+        status = 400
     return jsonify({
         'mensagem': f'{len(criadas)} fatura(s) processada(s) com sucesso',
         'faturas': criadas,
         'erros': erros,
-        'cache_limpo': len(nifs_afetados) if criadas else 0
+        'duplicadas': duplicadas,
+        'cache_limpo': cache_limpo
     }), status
 
 
+@app.route('/api/upload-fatura/<job_id>', methods=['GET'])
+@require_valid_token
+def estado_upload_fatura(job_id):
+    """Estado de um job de ingestão do NIF: processadas, falhadas, duplicadas e throughput"""
+    nif = request.args.get('nif', '').strip()
+    if not is_valid_nif(nif):
+        return jsonify({'erro': 'NIF inválido'}), 400
+
+    # Um job de outro NIF responde como inexistente, para não revelar que existe
+    job = obter_job(job_id)
+    if not job_do_nif(job, nif):
+        return jsonify({'erro': 'Job não encontrado'}), 404
+    return jsonify(job), 200
+
+
 
 @app.route("/api/faturas", methods=["GET"])
 @require_valid_token
+@cache_rotas.cached('faturas', ('nif', 'filial', 'periodo'))
 def buscar_faturas_periodo_route():
     nif = request.args.get("nif", "").strip()
     filial = request.args.get("filial", "").strip() or None
@@ -471,8 +731,7 @@ def buscar_faturas_periodo_route():
         return jsonify({"error": str(e)}), 400
 
     # Consulta no Supabase
-    query = supabase.table("faturas_fatura") \
-        .select("id, data, total, numero_fatura, hora, nif_cliente") \
+    query = consulta_faturas(supabase, CAMPOS_RESPOSTA_FATURAS) \
         .eq("nif", nif) \
         .gte("data", data_inicio.isoformat()) \
         .lte("data", data_fim.isoformat())
@@ -486,13 +745,7 @@ def buscar_faturas_periodo_route():
     if not faturas:
         return jsonify({"message": "Nenhuma fatura encontrada para esse período."}), 404
 
-    return jsonify({
-        "faturas": faturas,
-        "periodo": {
-            "inicio": str(data_inicio),
-            "fim": str(data_fim)
-        }
-    }), 200
+    return jsonify(montar_faturas(data_inicio, data_fim, faturas)), 200
 
 
 from utils.gerarPdf import gerar_pdf
@@ -502,8 +755,7 @@ def baixar_fatura_pdf():
 
     numero_fatura = request.args.get('numero_fatura', '').strip()
     
-    response = supabase.table("faturas_fatura") \
-        .select("texto_completo, qrcode") \
+    response = consulta_faturas(supabase, CAMPOS_FATURA_PDF) \
         .eq("numero_fatura", numero_fatura) \
         .single() \
         .execute()
@@ -530,6 +782,7 @@ def baixar_fatura_pdf():
 
 @app.route("/api/faturas/todas", methods=["GET"])
 @require_valid_token
+@cache_rotas.cached('faturas_todas', ('nif',), ttl=TTL_PADRAO)
 def buscar_todas_faturas():
     nif = request.args.get("nif")  # Obtém o NIF do query param
     
@@ -537,8 +790,7 @@ def buscar_todas_faturas():
         return jsonify({"error": "NIF é obrigatório e deve conter apenas números"}), 400
 
     # Consulta no Supabase (sem filtro de data)
-    result = supabase.table("faturas_fatura") \
-        .select("numero_fatura, total, hora, data,nif_cliente") \
+    result = consulta_faturas(supabase, CAMPOS_TODAS_FATURAS) \
         .eq("nif", nif) \
         .order("data", desc=True) \
         .execute()
@@ -552,7 +804,7 @@ def buscar_todas_faturas():
 
 @app.route("/api/heatmap", methods=["GET"])
 @require_valid_token
-#@cache.cached(timeout=180, key_prefix=cache_key)
+@cache_rotas.cached('heatmap', ('nif', 'periodo'), swr=True)
 def heatmap_horarios():
     """
     Retorna dados para gerar um heatmap de horários (hora × dia da semana)
@@ -573,179 +825,19 @@ def heatmap_horarios():
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
 
-    # OTIMIZAÇÃO: Uma única chamada ao banco para ambos os períodos
-    # Buscar faturas do período mais amplo (anterior + atual)
-    data_mais_antiga = min(data_inicio_anterior, data_inicio)
-    data_mais_recente = max(data_fim_anterior, data_fim)
-    
-    # Uma única consulta ao banco
-    faturas_completas = buscar_faturas_periodo(nif, data_mais_antiga, data_mais_recente)
-    
-    # Processar todas as faturas de uma vez usando a função otimizada
-    dados_processados = processar_faturas_otimizado(faturas_completas, data_inicio, data_fim, data_inicio_anterior, data_fim_anterior)
-    
-    # Extrair faturas separadas por período
-    faturas = dados_processados['faturas_atual']
-    faturas_anterior = dados_processados['faturas_anterior']
+    # OTIMIZAÇÃO: Uma única leitura e uma única passagem para ambos os períodos
+    dados_processados = agregar_periodo(nif, data_inicio, data_fim, data_inicio_anterior, data_fim_anterior)
+    heatmap = dados_processados['heatmap']
+    faturas_lidas = dados_processados['stats_atual'][1] + dados_processados['stats_anterior'][1]
     
-    if not faturas and not faturas_anterior:
+    if not faturas_lidas:
         return jsonify({
             "message": "Nenhuma fatura encontrada para o período especificado",
             "dados": [],
             "periodo": parse_periodo(periodo)
         }), 200
 
-    # Estrutura para armazenar dados do heatmap
-    # heatmap_data[hora][dia_semana] = {"volume": 0.0, "quantidade": 0}
-    heatmap_data = {}
-    
-    # Inicializar estrutura com todas as horas (0-23) e dias da semana (0-6)
-    for hora in range(24):
-        heatmap_data[hora] = {}
-        for dia in range(7):  # 0=Segunda, 1=Terça, ..., 6=Domingo
-            heatmap_data[hora][dia] = {"volume": 0.0, "quantidade": 0}
-
-    # Processar cada fatura
-    for fatura in faturas:
-        try:
-            # Extrair data e hora da fatura
-            data_str = fatura.get("data")
-            hora_str = fatura.get("hora")
-            
-            if not data_str or not hora_str:
-                continue
-                
-            # Converter data
-            data_obj = datetime.strptime(data_str, "%Y-%m-%d").date()
-            
-            # Extrair hora (formato esperado: "HH:MM:SS" ou "HH:MM")
-            if ":" in hora_str:
-                hora_parts = hora_str.split(":")
-                hora = int(hora_parts[0])
-            else:
-                continue
-                
-            # Calcular dia da semana (0=Segunda, 6=Domingo)
-            # weekday() retorna 0=Segunda, 6=Domingo, mas queremos 0=Segunda
-            dia_semana = data_obj.weekday()
-            
-            # Volume da fatura
-            volume = float(fatura.get("total", 0))
-            
-            # Acumular dados
-            if 0 <= hora < 24 and 0 <= dia_semana < 7:
-                heatmap_data[hora][dia_semana]["volume"] += volume
-                heatmap_data[hora][dia_semana]["quantidade"] += 1
-                
-        except (ValueError, TypeError, KeyError) as e:
-            # Ignorar faturas com dados inválidos
-            continue
-
-    # Converter para formato de resposta
-    dados_heatmap = []
-    nomes_dias = ["Segunda", "Terça", "Quarta", "Quinta", "Sexta", "Sábado", "Domingo"]
-    
-    for hora in range(24):
-        for dia in range(7):
-            dados = heatmap_data[hora][dia]
-            if dados["quantidade"] > 0:  # Só incluir células com dados
-                dados_heatmap.append({
-                    "hora": f"{hora:02d}:00",
-                    "hora_num": hora,
-                    "dia_semana": nomes_dias[dia],
-                    "dia_num": dia,
-                    "volume": round(dados["volume"], 2),
-                    "quantidade_faturas": dados["quantidade"],
-                    "ticket_medio": round(dados["volume"] / dados["quantidade"], 2) if dados["quantidade"] > 0 else 0.0
-                })
-
-    # faturas_anterior já foi obtida na consulta única acima
-    
-    # Processar dados do período anterior
-    heatmap_data_anterior = {}
-    for hora in range(24):
-        heatmap_data_anterior[hora] = {}
-        for dia in range(7):
-            heatmap_data_anterior[hora][dia] = {"volume": 0.0, "quantidade": 0}
-
-    for fatura in faturas_anterior:
-        try:
-            data_str = fatura.get("data")
-            hora_str = fatura.get("hora")
-            
-            if not data_str or not hora_str:
-                continue
-                
-            data_obj = datetime.strptime(data_str, "%Y-%m-%d").date()
-            
-            if ":" in hora_str:
-                hora_parts = hora_str.split(":")
-                hora = int(hora_parts[0])
-            else:
-                continue
-                
-            dia_semana = data_obj.weekday()
-            volume = float(fatura.get("total", 0))
-            
-            if 0 <= hora < 24 and 0 <= dia_semana < 7:
-                heatmap_data_anterior[hora][dia_semana]["volume"] += volume
-                heatmap_data_anterior[hora][dia_semana]["quantidade"] += 1
-                
-        except (ValueError, TypeError, KeyError) as e:
-            continue
-
-    # Calcular estatísticas gerais
-    total_volume = sum(d["volume"] for d in dados_heatmap)
-    total_faturas = sum(d["quantidade_faturas"] for d in dados_heatmap)
-    
-    # Calcular estatísticas do período anterior
-    total_volume_anterior = sum(d["volume"] for d in heatmap_data_anterior.values() for d in d.values())
-    total_faturas_anterior = sum(d["quantidade"] for d in heatmap_data_anterior.values() for d in d.values())
-    
-    # Encontrar horários de pico
-    if dados_heatmap:
-        pico_volume = max(dados_heatmap, key=lambda x: x["volume"])
-        pico_quantidade = max(dados_heatmap, key=lambda x: x["quantidade_faturas"])
-    else:
-        pico_volume = pico_quantidade = None
-
-    # Calcular variação
-    variacao_volume = calcular_variacao_dados(total_volume, total_volume_anterior)
-    variacao_faturas = calcular_variacao_dados(total_faturas, total_faturas_anterior)
-
-    resultado = {
-        "dados": dados_heatmap,
-        "estatisticas": {
-            "total_volume": round(total_volume, 2),
-            "total_faturas": total_faturas,
-            "periodo": parse_periodo(periodo),
-            "data_inicio": str(data_inicio),
-            "data_fim": str(data_fim),
-            "quantidade_celulas_com_dados": len(dados_heatmap),
-            "variacao_volume": variacao_volume,
-            "variacao_faturas": variacao_faturas
-        },
-        "periodo_anterior": {
-            "total_volume": round(total_volume_anterior, 2),
-            "total_faturas": total_faturas_anterior,
-            "data_inicio": str(data_inicio_anterior),
-            "data_fim": str(data_fim_anterior)
-        },
-        "picos": {
-            "maior_volume": {
-                "hora": pico_volume["hora"],
-                "dia": pico_volume["dia_semana"],
-                "volume": pico_volume["volume"]
-            } if pico_volume else None,
-            "maior_quantidade": {
-                "hora": pico_quantidade["hora"],
-                "dia": pico_quantidade["dia_semana"],
-                "quantidade": pico_quantidade["quantidade_faturas"]
-            } if pico_quantidade else None
-        },
-        "nomes_dias": nomes_dias,
-        "horas_disponiveis": [f"{h:02d}:00" for h in range(24)]
-    }
+    resultado = montar_heatmap(periodo, (data_inicio, data_fim, data_inicio_anterior, data_fim_anterior), heatmap)
 
     #marcar_atualizacao_cache(nif)
     return jsonify(resultado), 200
@@ -755,7 +847,7 @@ def heatmap_horarios():
 
 @app.route("/api/analise-completa", methods=["GET"])
 @require_valid_token
-@cache.cached(timeout=180, key_prefix=cache_key_analise_completa)
+@cache_rotas.cached('analise_completa', ('nif', 'filial', 'periodo'), swr=True)
 def analise_completa():
    
     
@@ -778,131 +870,49 @@ def analise_completa():
         except ValueError as e:
             return jsonify({"error": str(e)}), 400
 
-        # OTIMIZAÇÃO: Uma única chamada ao banco para ambos os períodos
-        # Buscar faturas do período mais amplo (anterior + atual)
-        data_mais_antiga = min(data_inicio_anterior, data_inicio)
-        data_mais_recente = max(data_fim_anterior, data_fim)
-        
-        # Uma única consulta ao banco
-        faturas_completas = buscar_faturas_periodo(nif, data_mais_antiga, data_mais_recente, filial=filial)
-        
-        # Processar todas as faturas de uma vez usando a função otimizada
-        dados_processados = processar_faturas_otimizado(faturas_completas, data_inicio, data_fim, data_inicio_anterior, data_fim_anterior)
+        # OTIMIZAÇÃO: Uma única leitura e uma única passagem para ambos os períodos
+        dados_processados = agregar_periodo(nif, data_inicio, data_fim, data_inicio_anterior, data_fim_anterior, filial=filial)
         
         # Extrair dados processados
         total_atual, recibos_atual, itens_atual, ticket_atual = dados_processados['stats_atual']
         total_anterior, recibos_anterior, itens_anterior, ticket_anterior = dados_processados['stats_anterior']
         comparativo_por_hora = dados_processados['comparativo_por_hora']
-        faturas_atual = dados_processados['faturas_atual']
-        faturas_anterior = dados_processados['faturas_anterior']
-
-        # Produtos mais vendidos
-        contagem_produtos = defaultdict(lambda: {"quantidade": 0, "montante": 0.0})
-        total_montante = 0.0
 
-        for f in faturas_atual:
-            for item in (f.get("faturas_itemfatura") or []):
-                nome = item.get("nome")
-                qtd = item.get("quantidade", 0)
-                preco_unitario = float(item.get("preco_unitario", 0.0))
+        # Produtos mais vendidos (top 10 por seleção parcial)
+        produtos = dados_processados['produtos']
+        _, total_montante, _ = produtos.totais(ATUAL)
 
-                contagem_produtos[nome]["quantidade"] += qtd
-                contagem_produtos[nome]["montante"] += qtd * preco_unitario
-                total_montante += qtd * preco_unitario
-
-        produtos_mais_vendidos = sorted([
+        produtos_mais_vendidos = [
             {
-                "produto": nome,
+                "produto": dados["produto"],
                 "quantidade": dados["quantidade"],
                 "montante": round(dados["montante"], 2),
                 "porcentagem_montante": round((dados["montante"] / total_montante) * 100, 2) if total_montante else 0.0
             }
-            for nome, dados in contagem_produtos.items()
-        ], key=lambda x: x["montante"], reverse=True)[:10]
-
-        # Heatmap data
-        heatmap_data = {}
-        for hora in range(24):
-            heatmap_data[hora] = {}
-            for dia in range(7):
-                heatmap_data[hora][dia] = {"volume": 0.0, "quantidade": 0}
-
-        for fatura in faturas_atual:
-            try:
-                data_str = fatura.get("data")
-                hora_str = fatura.get("hora")
-                
-                if not data_str or not hora_str:
-                    continue
-                    
-                data_obj = datetime.strptime(data_str, "%Y-%m-%d").date()
-                
-                if ":" in hora_str:
-                    hora_parts = hora_str.split(":")
-                    hora = int(hora_parts[0])
-                else:
-                    continue
-                    
-                dia_semana = data_obj.weekday()
-                volume = float(fatura.get("total", 0))
-                
-                if 0 <= hora < 24 and 0 <= dia_semana < 7:
-                    heatmap_data[hora][dia_semana]["volume"] += volume
-                    heatmap_data[hora][dia_semana]["quantidade"] += 1
-                    
-            except (ValueError, TypeError, KeyError) as e:
-                continue
+            for dados in produtos.top(ATUAL, 10)
+        ]
 
         # Picos do heatmap
-        picos_heatmap = []
-        for hora in range(24):
-            for dia in range(7):
-                dados = heatmap_data[hora][dia]
-                if dados["quantidade"] > 0:
-                    picos_heatmap.append({
-                        "hora": f"{hora:02d}:00",
-                        "dia_semana": ["Segunda", "Terça", "Quarta", "Quinta", "Sexta", "Sábado", "Domingo"][dia],
-                        "volume": round(dados["volume"], 2),
-                        "quantidade_faturas": dados["quantidade"]
-                    })
-
-        picos_heatmap = sorted(picos_heatmap, key=lambda x: x["volume"], reverse=True)[:5]
+        picos_heatmap = dados_processados['heatmap'].top_celulas(ATUAL, 5)
 
         # Vendas por dia (últimos 7 dias)
         hoje = date.today()
         sete_dias_atras = hoje - timedelta(days=7)
-        vendas_por_dia = defaultdict(float)
-        
-        for f in faturas_atual:
-            if f.get("data") >= sete_dias_atras.isoformat():
-                vendas_por_dia[f["data"]] += float(f.get("total", 0))
+        vendas_por_dia = dados_processados['vendas_por_dia_atual']
 
         vendas_ultimos_7_dias = [
             {"data": dia, "total": round(total, 2)}
             for dia, total in sorted(vendas_por_dia.items())
+            if dia >= sete_dias_atras.isoformat()
         ]
 
-        # Informações de filiais
+        # Informações de filiais (da mesma passagem de agregação, sem segunda consulta)
         filiais_info = {}
         if not filial:
-            query = supabase.table("faturas_fatura") \
-                .select("filial, total") \
-                .eq("nif", nif) \
-                .gte("data", data_inicio.isoformat()) \
-                .lte("data", data_fim.isoformat()) \
-                .execute()
-            
-            filiais_data = query.data or []
-            filiais_agg = defaultdict(float)
-            for f in filiais_data:
-                filiais_agg[f.get("filial", "Sem filial")] += float(f.get("total", 0))
-            
+            volume_por_filial = metricas_filiais(dados_processados)
             filiais_info = {
-                "total_filiais": len(filiais_agg),
-                "volume_por_filial": [
-                    {"filial": filial, "volume": round(volume, 2)}
-                    for filial, volume in sorted(filiais_agg.items(), key=lambda x: x[1], reverse=True)
-                ]
+                "total_filiais": len(volume_por_filial),
+                "volume_por_filial": volume_por_filial
             }
 
         # Métricas de performance
@@ -1085,6 +1095,7 @@ def analise_completa():
 
 @app.route("/api/analise-ia-completa", methods=["GET"])
 @require_valid_token
+@cache_rotas.cached('analise_ia_completa', ('nif', 'filial', 'periodo'), ttl=TTL_ANALISE_IA_POR_PERIODO)
 def analise_ia_completa():
     """
     Rota para análise IA completa - Gera TODOS os tipos de análise
@@ -1261,7 +1272,7 @@ def gerar_analises_cache():
         for periodo in periodos_para_gerar:
             try:
                 # Verificar se já existe no cache (exceto se forçar)
-                cache_key = f"analise_ia:{nif}:{filial or 'todas'}:{periodo}"
+                cache_key = chave_analise_ia(nif, filial, periodo)
                 
                 if not forcar_geracao and cache.get(cache_key):
                     resultados[periodo] = {
@@ -1283,14 +1294,7 @@ def gerar_analises_cache():
                 
                 if resultado["success"]:
                     # Salvar no cache com timeout baseado no período
-                    timeout_cache = {
-                        0: 86400,  # 1 dia para hoje
-                        1: 86400,  # 1 dia para ontem
-                        2: 604800,  # 1 semana para semana
-                        3: 2592000,  # 1 mês para mês
-                        4: 2592000,  # 1 mês para trimestre
-                        5: 31536000  # 1 ano para ano
-                    }
+                    timeout_cache = ttl_periodo(periodo, TTL_ANALISE_IA_POR_PERIODO)
                     
                     dados_cache = {
                         "analise": resultado["analysis"],
@@ -1301,13 +1305,13 @@ def gerar_analises_cache():
                         "filial": filial
                     }
                     
-                    cache.set(cache_key, dados_cache, timeout=timeout_cache.get(periodo, 86400))
+                    cache.set(cache_key, dados_cache, timeout=timeout_cache)
                     
                     resultados[periodo] = {
                         "status": "gerado",
                         "mensagem": f"Análise para período {periodo} gerada e salva no cache",
                         "dados": dados_cache,
-                        "timeout_cache": timeout_cache.get(periodo, 86400)
+                        "timeout_cache": timeout_cache
                     }
                 else:
                     erros.append(f"Erro na análise período {periodo}: {resultado['error']}")
@@ -1367,7 +1371,7 @@ def obter_analise_cache():
             return jsonify({"error": "Período inválido. Deve ser um número inteiro de 0 a 5."}), 400
 
         # Buscar no cache
-        cache_key = f"analise_ia:{nif}:{filial or 'todas'}:{periodo}"
+        cache_key = chave_analise_ia(nif, filial, periodo)
         dados_cache = cache.get(cache_key)
         
         if dados_cache:
@@ -1405,14 +1409,7 @@ def obter_analise_cache():
                 
                 if resultado["success"]:
                     # Salvar no cache com timeout baseado no período
-                    timeout_cache = {
-                        0: 86400,  # 1 dia para hoje
-                        1: 86400,  # 1 dia para ontem
-                        2: 604800,  # 1 semana para semana
-                        3: 2592000,  # 1 mês para mês
-                        4: 2592000,  # 1 mês para trimestre
-                        5: 31536000  # 1 ano para ano
-                    }
+                    timeout_cache = ttl_periodo(periodo, TTL_ANALISE_IA_POR_PERIODO)
                     
                     dados_cache = {
                         "analise": resultado["analysis"],
@@ -1423,7 +1420,7 @@ def obter_analise_cache():
                         "filial": filial
                     }
                     
-                    cache.set(cache_key, dados_cache, timeout=timeout_cache.get(periodo, 86400))
+                    cache.set(cache_key, dados_cache, timeout=timeout_cache)
                     
                     return jsonify({
                         "success": True,
@@ -1439,7 +1436,7 @@ def obter_analise_cache():
                         "metadata": {
                             "timestamp_geracao": dados_cache["timestamp_geracao"],
                             "fonte": "gerado_automaticamente",
-                            "timeout_cache": timeout_cache.get(periodo, 86400)
+                            "timeout_cache": timeout_cache
                         }
                     }), 200
                 else:
@@ -1477,19 +1474,13 @@ def limpar_cache_analises():
 
         filial = request.args.get("filial", "").strip() or None
         
-        # Limpar cache para todos os períodos
-        periodos = [0, 1, 2, 3, 4, 5]
-        limpos = 0
-        
-        for periodo in periodos:
-            cache_key = f"analise_ia:{nif}:{filial or 'todas'}:{periodo}"
-            if cache.delete(cache_key):
-                limpos += 1
-                print(f"Cache limpo para NIF {nif}")
+        # Todos os períodos: um INCR da geração do NIF/filial retira todas as análises
+        geracao = invalidar_cache(nif, filial)
+        print(f"Cache limpo para NIF {nif}")
         return jsonify({
             "success": True,
             "mensagem": f"Cache limpo para NIF {nif}",
-            "analises_limpas": limpos,
+            "geracao": geracao,
             "timestamp": datetime.now().isoformat()
         }), 200
 
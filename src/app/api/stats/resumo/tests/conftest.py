@@ -0,0 +1,223 @@
+# 🔹 Ambiente de testes: Redis em memória (fakeredis) e Supabase falso sobre listas
+
+import json
+import os
+import re
+import sys
+import types
+
+import pytest
+
+# O Redis dos módulos de utils é criado ao importar: tem de ser falso antes disso
+fakeredis = pytest.importorskip('fakeredis')
+pytest.importorskip('lupa')  # scripts Lua do rollup
+import redis  # noqa: E402
+
+servidor_redis = fakeredis.FakeRedis()
+redis.Redis.from_url = staticmethod(lambda url, **kwargs: servidor_redis)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# O cliente Supabase é substituído em cada teste (ver supabase_falso)
+supabase_util = types.ModuleType('utils.supabaseUtil')
+supabase_util.get_supabase = lambda: None
+sys.modules.setdefault('utils.supabaseUtil', supabase_util)
+
+
+def _parse_faturas(texto):
+    """Parser de teste: uma fatura em JSON por linha (ValueError se a linha não for JSON)"""
+    return [json.loads(linha) for linha in texto.splitlines() if linha.strip()]
+
+
+parse_faturas = types.ModuleType('utils.parse_faturas')
+parse_faturas.parse_faturas = _parse_faturas
+sys.modules.setdefault('utils.parse_faturas', parse_faturas)
+
+
+class _Resposta:
+    def __init__(self, data):
+        self.data = data
+
+
+class _Consulta:
+    """Subconjunto do query builder do PostgREST usado pela leitura e pela ingestão"""
+
+    # Keyset: data.gt.D,and(data.eq.D,id.gt.N)
+    _KEYSET = re.compile(r"data\.gt\.([^,]+),and\(data\.eq\.([^,]+),id\.gt\.(\d+)\)")
+
+    def __init__(self, supabase, tabela):
+        self._supabase = supabase
+        self._tabela = tabela
+        self._linhas = list(supabase.tabelas.setdefault(tabela, []))
+        self._ordem = []
+        self._limite = None
+        self._novas = None
+        self._apagar = False
+
+    def select(self, campos):
+        self._supabase.selects.append((self._tabela, campos))
+        return self
+
+    def insert(self, linhas):
+        self._novas = [linhas] if isinstance(linhas, dict) else list(linhas)
+        return self
+
+    def delete(self):
+        self._apagar = True
+        return self
+
+    def gte(self, coluna, valor):
+        self._linhas = [l for l in self._linhas if str(l[coluna]) >= str(valor)]
+        return self
+
+    def lte(self, coluna, valor):
+        self._linhas = [l for l in self._linhas if str(l[coluna]) <= str(valor)]
+        return self
+
+    def gt(self, coluna, valor):
+        self._linhas = [l for l in self._linhas if l[coluna] > valor]
+        return self
+
+    def eq(self, coluna, valor):
+        self._linhas = [l for l in self._linhas if str(l.get(coluna)) == str(valor)]
+        return self
+
+    def in_(self, coluna, valores):
+        valores = {str(v) for v in valores}
+        self._linhas = [l for l in self._linhas if str(l.get(coluna)) in valores]
+        return self
+
+    def or_(self, filtro):
+        maior, igual, ultimo_id = self._KEYSET.fullmatch(filtro).groups()
+        self._linhas = [
+            l for l in self._linhas
+            if l['data'] > maior or (l['data'] == igual and l['id'] > int(ultimo_id))
+        ]
+        return self
+
+    def order(self, coluna):
+        self._ordem.append(coluna)
+        return self
+
+    def limit(self, n):
+        self._limite = n
+        return self
+
+    def execute(self):
+        self._supabase.pedidos += 1
+        if self._novas is not None:
+            return _Resposta(self._supabase.inserir(self._tabela, self._novas))
+        if self._apagar:
+            ids = {id(l) for l in self._linhas}
+            tabela = self._supabase.tabelas[self._tabela]
+            tabela[:] = [l for l in tabela if id(l) not in ids]
+            return _Resposta([dict(l) for l in self._linhas])
+
+        linhas = sorted(self._linhas, key=lambda l: tuple(l[c] for c in self._ordem))
+        for limite in (self._limite, self._supabase.max_linhas):
+            if limite is not None:
+                linhas = linhas[:limite]
+        return _Resposta([dict(l) for l in linhas])
+
+
+class SupabaseFalso:
+    """
+    Tabelas em listas de dicionários; as faturas trazem os itens em 'faturas_itemfatura',
+    como no select com embedding do PostgREST.
+    """
+
+    def __init__(self):
+        self.tabelas = {'faturas_fatura': [], 'faturas_itemfatura': []}
+        self.pedidos = 0
+        # (tabela, expressão select) de cada consulta
+        self.selects = []
+        # max-rows do PostgREST: limite de linhas por resposta imposto pelo servidor
+        self.max_linhas = None
+        # rejeitar(tabela, linhas) -> True faz falhar o INSERT inteiro (é atómico)
+        self.rejeitar = None
+        self.inserts = []
+        self._proximo_id = 1
+
+    @property
+    def faturas(self):
+        return self.tabelas['faturas_fatura']
+
+    def inserir(self, tabela, linhas):
+        self.inserts.append((tabela, len(linhas)))
+        if self.rejeitar and self.rejeitar(tabela, linhas):
+            raise Exception(f'INSERT em {tabela} rejeitado')
+
+        gravadas = []
+        for linha in linhas:
+            linha = dict(linha)
+            if tabela == 'faturas_fatura':
+                linha.setdefault('id', max([f['id'] for f in self.faturas] + [self._proximo_id - 1]) + 1)
+                self._proximo_id = linha['id'] + 1
+                linha.setdefault('faturas_itemfatura', [])
+            else:
+                fatura = next(f for f in self.faturas if f['id'] == linha['fatura_id'])
+                fatura['faturas_itemfatura'].append(linha)
+            self.tabelas[tabela].append(linha)
+            gravadas.append(linha)
+        return [dict(l) for l in gravadas]
+
+    def table(self, tabela):
+        return _Consulta(self, tabela)
+
+
+@pytest.fixture
+def supabase_falso(monkeypatch):
+    from utils import utils, rollup, hoje, segmentos, ingestao, agregacao_rpc
+
+    supabase = SupabaseFalso()
+    for modulo in (utils, ingestao, agregacao_rpc):
+        monkeypatch.setattr(modulo, 'supabase', supabase)
+
+    # Caches em memória do processo começam vazios em cada teste
+    servidor_redis.flushall()
+    monkeypatch.setattr(rollup, 'dias_fechados', rollup._DiasFechados())
+    monkeypatch.setattr(segmentos, 'cache_segmentos', segmentos.CacheSegmentos())
+    hoje._acumulados.clear()
+    return supabase
+
+
+class _App:
+    """App Flask com Flask-Caching em memória e o CacheRotas a testar"""
+
+    def __init__(self, local=None):
+        from flask import Flask
+        from flask_caching import Cache
+        from utils.cache_rotas import CacheRotas
+
+        self.flask = Flask(__name__)
+        self.cache = Cache(self.flask, config={'CACHE_TYPE': 'SimpleCache', 'CACHE_THRESHOLD': 10000})
+        self.rotas = CacheRotas(self.cache, local=local)
+        self.timeouts = []
+        guardar = self.cache.set
+        self.cache.set = lambda chave, valor, timeout=None: self.timeouts.append(timeout) or guardar(
+            chave, valor, timeout=timeout
+        )
+        self.cliente = self.flask.test_client()
+
+    def rota(self, url, familia, corpo=lambda: 'ok', **kwargs):
+        """Regista uma rota com cache; corpo() dá a resposta e as chamadas ficam em chamadas"""
+        chamadas = []
+
+        @self.flask.route(url, endpoint=familia)
+        @self.rotas.cached(familia, **kwargs)
+        def rota():
+            from flask import request
+            chamadas.append(dict(request.args))
+            return corpo()
+
+        return chamadas
+
+    def get(self, url):
+        return self.cliente.get(url)
+
+
+@pytest.fixture
+def app_cache(supabase_falso):
+    pytest.importorskip('flask')
+    pytest.importorskip('flask_caching')
+    return _App()
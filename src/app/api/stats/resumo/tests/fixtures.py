@@ -0,0 +1,75 @@
+# 🔹 Faturas de exemplo partilhadas pelos testes
+
+from datetime import date, timedelta
+
+import pytest
+
+NIF = '500000000'
+
+# Dias fechados: o rollup nunca grava hoje
+ONTEM = date.today() - timedelta(days=1)
+INICIO_ATUAL = ONTEM - timedelta(days=6)
+INICIO_ANTERIOR = INICIO_ATUAL - timedelta(days=7)
+FIM_ANTERIOR = INICIO_ATUAL - timedelta(days=1)
+
+
+def _item(nome, quantidade, preco):
+    return {'nome': nome, 'quantidade': quantidade, 'preco_unitario': preco, 'total': round(quantidade * preco, 2)}
+
+
+def gerar_faturas(n=60, primeiro_id=1):
+    """
+    Faturas dos períodos atual e anterior com casos difíceis: quantidades
+    fracionárias, faturas sem hora ou com hora inválida, sem filial e itens sem nome.
+    """
+    horas = ['08:15', '12:30', '19:05', None, '25:00', 'xx:10']
+    filiais = [1, 2, None]
+    produtos = [('Pão', 3, 0.2), ('Queijo', 0.75, 12.4), ('Café', 1, 0.7), (None, 2, 1.5)]
+
+    faturas = []
+    for i in range(n):
+        dia = INICIO_ANTERIOR + timedelta(days=i % 14)
+        itens = [_item(*produtos[(i + k) % len(produtos)]) for k in range(1 + i % 3)]
+        faturas.append({
+            'id': primeiro_id + i,
+            'nif': NIF,
+            'data': dia.isoformat(),
+            'hora': horas[i % len(horas)],
+            'filial': filiais[i % len(filiais)],
+            'total': round(sum(item['total'] for item in itens), 2),
+            'faturas_itemfatura': itens
+        })
+    return faturas
+
+
+def gerar_faturas_upload(n=10, primeiro_numero=1, nif=NIF):
+    """Faturas como as devolve parse_faturas, antes da inserção (ver conftest)"""
+    faturas = []
+    for i in range(n):
+        numero = primeiro_numero + i
+        itens = [_item('Pão', 2, 0.2), _item('Café', 1 + i % 2, 0.7)]
+        faturas.append({
+            'numero_fatura': f'FT 2024/{numero}',
+            'data': ONTEM.isoformat(),
+            'hora': '10:30',
+            'total': round(sum(item['total'] for item in itens), 2),
+            'texto_original': f'fatura {numero}',
+            'texto_completo': f'fatura {numero}',
+            'qrcode': f'qr{numero}',
+            'filial': 1 + i % 2,
+            'nif_emitente': nif,
+            'nif_cliente': '999999990',
+            'itens': itens
+        })
+    return faturas
+
+
+def aproximar(valor):
+    """Compara floats com tolerância em qualquer nível de dicionários, listas e tuplos"""
+    if isinstance(valor, dict):
+        return {chave: aproximar(v) for chave, v in valor.items()}
+    if isinstance(valor, (list, tuple)):
+        return type(valor)(aproximar(v) for v in valor)
+    if isinstance(valor, float):
+        return pytest.approx(valor, abs=1e-6)
+    return valor
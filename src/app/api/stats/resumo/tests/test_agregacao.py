@@ -0,0 +1,37 @@
+# 🔹 Agregação numa única passagem: totais, filiais e horas a partir das faturas
+
+import pytest
+
+from fixtures import INICIO_ANTERIOR, INICIO_ATUAL, FIM_ANTERIOR, ONTEM
+from utils.agregacao import AgregadorFaturas
+from utils.rollup import acumular_celulas
+
+
+def _fatura(dia, hora, filial, total):
+    return {'data': dia.isoformat(), 'hora': hora, 'filial': filial, 'total': total, 'faturas_itemfatura': []}
+
+
+FATURAS = [
+    _fatura(ONTEM, '09:10', 1, 10.0),
+    _fatura(ONTEM, '09:50', '1', 5.0),
+    _fatura(ONTEM, None, None, 2.5),
+    _fatura(INICIO_ANTERIOR, '20:00', 2, 4.0)
+]
+
+
+@pytest.mark.parametrize('de_celulas', [False, True])
+def test_filiais_numericas_e_sem_filial(de_celulas):
+    agregador = AgregadorFaturas(INICIO_ATUAL, ONTEM, INICIO_ANTERIOR, FIM_ANTERIOR)
+    if de_celulas:
+        agregador.adicionar_celulas(acumular_celulas({}, FATURAS))
+    else:
+        agregador.adicionar_lote(FATURAS)
+    resultado = agregador.resultado()
+
+    # A coluna filial é numérica: 1 e '1' são a mesma filial, com chave em texto
+    atual = resultado['filiais_atual']
+    assert set(atual) == {'1', 'Sem Filial'}
+    assert atual['1']['volume'] == 15.0 and atual['1']['recibos'] == 2
+    assert atual['1']['vendas_por_hora'][9] == 15.0
+    assert set(resultado['filiais_anterior']) == {'2'}
+    assert resultado['stats_atual'] == (17.5, 3, 0, 5.83)
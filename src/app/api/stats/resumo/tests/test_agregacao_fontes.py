@@ -0,0 +1,85 @@
+# 🔹 As três fontes de agregação (faturas em bruto, rollup e RPC) dão o mesmo resultado
+
+import pytest
+
+from fixtures import NIF, ONTEM, INICIO_ATUAL, INICIO_ANTERIOR, FIM_ANTERIOR, aproximar, gerar_faturas
+from utils.agregacao import AgregadorFaturas, _cortes
+from utils.agregacao_rpc import FonteSQLite, linhas_para_celulas
+from utils.heatmap import ATUAL, ANTERIOR
+from utils.rollup import ler_rollup
+
+PERIODOS = (INICIO_ATUAL, ONTEM, INICIO_ANTERIOR, FIM_ANTERIOR)
+
+
+def _resumo(resultado):
+    """Partes do resultado comparáveis entre fontes (as faturas só existem em bruto)"""
+    return {
+        'stats_atual': resultado['stats_atual'],
+        'stats_anterior': resultado['stats_anterior'],
+        'vendas_por_hora_atual': resultado['vendas_por_hora_atual'],
+        'vendas_por_hora_anterior': resultado['vendas_por_hora_anterior'],
+        'filiais_atual': resultado['filiais_atual'],
+        'filiais_anterior': resultado['filiais_anterior'],
+        'vendas_por_dia_atual': resultado['vendas_por_dia_atual'],
+        'vendas_por_dia_anterior': resultado['vendas_por_dia_anterior'],
+        'heatmap': [resultado['heatmap'].celulas(p) for p in (ATUAL, ANTERIOR)],
+        'produtos': [resultado['produtos'].como_dict(p) for p in (ATUAL, ANTERIOR)],
+        'produtos_totais': [resultado['produtos'].totais(p) for p in (ATUAL, ANTERIOR)]
+    }
+
+
+def _de_faturas(faturas, filial=None):
+    if filial:
+        faturas = [f for f in faturas if str(f['filial']) == str(filial)]
+    return AgregadorFaturas(*PERIODOS).adicionar_lote(faturas).resultado()
+
+
+def _de_celulas(celulas):
+    return AgregadorFaturas(*PERIODOS).adicionar_celulas(celulas).resultado()
+
+
+def _de_rpc(faturas, filial=None):
+    fonte = FonteSQLite()
+    fonte.carregar(NIF, faturas)
+    cortes = _cortes([AgregadorFaturas(*PERIODOS)])
+    return _de_celulas(linhas_para_celulas(fonte.agregar(NIF, INICIO_ANTERIOR, ONTEM, filial=filial, cortes=cortes)))
+
+
+@pytest.fixture
+def faturas(supabase_falso):
+    supabase_falso.faturas.extend(gerar_faturas())
+    return supabase_falso.faturas
+
+
+@pytest.mark.parametrize('filial', [None, '1'])
+def test_rollup_igual_a_faturas_em_bruto(faturas, filial):
+    esperado = _resumo(_de_faturas(faturas, filial))
+
+    # A primeira leitura constrói o rollup, a segunda lê-o do Redis e a terceira da memória
+    for _ in range(3):
+        obtido = _resumo(_de_celulas(ler_rollup(NIF, INICIO_ANTERIOR, ONTEM, filial=filial)))
+        assert obtido == aproximar(esperado)
+
+
+@pytest.mark.parametrize('filial', [None, '1'])
+def test_rpc_igual_a_faturas_em_bruto(faturas, filial):
+    esperado = _resumo(_de_faturas(faturas, filial))
+    assert _resumo(_de_rpc(faturas, filial)) == aproximar(esperado)
+
+
+def test_quantidades_fracionarias_mantidas(faturas):
+    produtos = _de_celulas(ler_rollup(NIF, INICIO_ANTERIOR, ONTEM))['produtos']
+    queijo = _de_faturas(faturas)['produtos'].como_dict(ATUAL)['Queijo']['quantidade']
+    assert queijo != int(queijo)
+    assert produtos.como_dict(ATUAL)['Queijo']['quantidade'] == pytest.approx(queijo)
+
+
+def test_backend_numpy_igual_ao_python(faturas):
+    pytest.importorskip('numpy')
+    from utils.agregacao_numpy import AgregadorFaturasNumpy
+
+    esperado = _resumo(_de_faturas(faturas))
+    em_bruto = AgregadorFaturasNumpy(*PERIODOS).adicionar_lote(faturas).resultado()
+    celulas = AgregadorFaturasNumpy(*PERIODOS).adicionar_celulas(ler_rollup(NIF, INICIO_ANTERIOR, ONTEM)).resultado()
+    assert _resumo(em_bruto) == aproximar(esperado)
+    assert _resumo(celulas) == aproximar(esperado)
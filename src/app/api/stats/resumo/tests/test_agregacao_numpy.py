@@ -0,0 +1,43 @@
+# 🔹 Backend colunar (NumPy): mesmo resultado que o backend Python e fallback sem NumPy
+
+import pytest
+
+from fixtures import INICIO_ANTERIOR, INICIO_ATUAL, FIM_ANTERIOR, ONTEM, gerar_faturas
+from utils import agregacao
+from utils.agregacao import AgregadorFaturas, criar_agregador
+from utils.heatmap import ATUAL, ANTERIOR
+
+np = pytest.importorskip('numpy')
+from utils import agregacao_numpy  # noqa: E402
+from utils.agregacao_numpy import AgregadorFaturasNumpy  # noqa: E402
+
+PERIODOS = (INICIO_ATUAL, ONTEM, INICIO_ANTERIOR, FIM_ANTERIOR)
+
+
+def test_backend_configurado(monkeypatch):
+    monkeypatch.setattr(agregacao, 'BACKEND_AGREGACAO', 'numpy')
+    assert isinstance(criar_agregador(*PERIODOS), AgregadorFaturasNumpy)
+
+    # Sem NumPy instalado o deployment continua com o backend Python
+    monkeypatch.setattr(agregacao_numpy, 'np', None)
+    agregador = criar_agregador(*PERIODOS)
+    assert type(agregador) is AgregadorFaturas
+
+
+def test_rankings_e_faturas_iguais_ao_python():
+    faturas = gerar_faturas(n=200)
+    python = AgregadorFaturas(*PERIODOS, manter_faturas=True)
+    colunar = AgregadorFaturasNumpy(*PERIODOS, manter_faturas=True)
+    # Vários lotes, como na leitura paginada
+    for inicio in range(0, len(faturas), 64):
+        python.adicionar_lote(faturas[inicio:inicio + 64])
+        colunar.adicionar_lote(faturas[inicio:inicio + 64])
+    esperado, obtido = python.resultado(), colunar.resultado()
+
+    for periodo in (ATUAL, ANTERIOR):
+        for chave in ('quantidade', 'montante', 'faturamento'):
+            assert [p['produto'] for p in obtido['produtos'].top(periodo, 3, chave)] == \
+                [p['produto'] for p in esperado['produtos'].top(periodo, 3, chave)]
+        assert obtido['heatmap'].picos(periodo) == esperado['heatmap'].picos(periodo)
+    assert obtido['faturas_atual'] == esperado['faturas_atual']
+    assert obtido['faturas_anterior'] == esperado['faturas_anterior']
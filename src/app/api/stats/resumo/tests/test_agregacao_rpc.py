@@ -0,0 +1,111 @@
+# 🔹 Agregação na base de dados (modo rpc): produtos por segmento e uma só chamada
+
+from datetime import date
+
+import pytest
+
+from fixtures import NIF, ONTEM, INICIO_ATUAL, INICIO_ANTERIOR, FIM_ANTERIOR, aproximar, gerar_faturas
+from utils import agregacao, agregacao_rpc
+from utils.agregacao import agregar_periodo, agregar_periodos
+from utils.agregacao_rpc import FonteSQLite, ler_celulas_rpc
+from utils.heatmap import ATUAL, ANTERIOR
+
+PERIODOS = {
+    'semana': (INICIO_ATUAL, ONTEM, INICIO_ANTERIOR, FIM_ANTERIOR),
+    'ontem': (ONTEM, ONTEM, FIM_ANTERIOR, FIM_ANTERIOR)
+}
+CHAVES = ('stats_atual', 'stats_anterior', 'filiais_atual', 'filiais_anterior',
+          'vendas_por_dia_atual', 'vendas_por_dia_anterior', 'vendas_por_hora_atual')
+
+
+@pytest.fixture
+def fonte(supabase_falso, monkeypatch):
+    supabase_falso.faturas.extend(gerar_faturas())
+    fonte = FonteSQLite()
+    fonte.carregar(NIF, supabase_falso.faturas)
+    monkeypatch.setattr(agregacao_rpc, 'SQLITE_AGREGACAO_PATH', ':memory:')
+    monkeypatch.setattr(agregacao_rpc, '_fonte_sqlite', fonte)
+    return fonte
+
+
+def test_filial_numerica_filtrada_como_texto(fonte):
+    tipos = {linha[0] for linha in fonte._conexao.execute("select typeof(filial) from faturas_fatura")}
+    assert tipos == {'integer', 'null'}
+
+    linhas = fonte.agregar(NIF, INICIO_ANTERIOR, ONTEM, filial='1')
+    assert linhas and {linha['filial'] for linha in linhas} == {'1'}
+    assert {linha['filial'] for linha in fonte.agregar(NIF, INICIO_ANTERIOR, ONTEM)} == {'1', '2', ''}
+
+
+def test_produtos_por_segmento_e_nao_por_dia(fonte):
+    cortes = agregacao._cortes([agregacao.AgregadorFaturas(*PERIODOS['semana'])])
+    assert cortes == [INICIO_ANTERIOR, INICIO_ATUAL, date.today()]
+
+    produtos = [l for l in fonte.agregar(NIF, INICIO_ANTERIOR, ONTEM, cortes=cortes) if l['tipo'] == 'p']
+
+    # Um segmento por período: no máximo 2 x 3 filiais x 4 produtos, em vez de um por dia
+    assert {l['data'] for l in produtos} == {INICIO_ANTERIOR.isoformat(), INICIO_ATUAL.isoformat()}
+    assert len(produtos) == len({(l['data'], l['filial'], l['produto']) for l in produtos}) <= 2 * 3 * 4
+
+
+@pytest.mark.parametrize('filial', [None, '1'])
+def test_periodos_iguais_as_faturas_em_bruto(fonte, monkeypatch, filial):
+    monkeypatch.setattr(agregacao, 'FONTE_AGREGACAO', 'faturas')
+    esperado = {chave: agregar_periodo(NIF, *datas, filial=filial) for chave, datas in PERIODOS.items()}
+
+    monkeypatch.setattr(agregacao, 'FONTE_AGREGACAO', 'rpc')
+    resultados = agregar_periodos(NIF, PERIODOS, filial=filial)
+
+    for chave in PERIODOS:
+        # As células só com produtos não criam dias nem filiais sem vendas
+        assert {c: resultados[chave][c] for c in CHAVES} == aproximar({c: esperado[chave][c] for c in CHAVES})
+        for periodo in (ATUAL, ANTERIOR):
+            assert resultados[chave]['produtos'].como_dict(periodo) == aproximar(
+                esperado[chave]['produtos'].como_dict(periodo)
+            )
+
+
+@pytest.mark.parametrize('backend', ['python', 'numpy'])
+def test_produtos_sem_dias_nem_filiais_fantasma(supabase_falso, monkeypatch, backend):
+    if backend == 'numpy':
+        pytest.importorskip('numpy')
+    monkeypatch.setattr(agregacao, 'BACKEND_AGREGACAO', backend)
+    # Uma só fatura, a meio do período: o segmento dos produtos começa num dia sem vendas
+    fatura = gerar_faturas(n=1)[0]
+    fatura.update(data=(INICIO_ATUAL + (ONTEM - INICIO_ATUAL) / 2).isoformat(), filial=2)
+    fonte = FonteSQLite()
+    fonte.carregar(NIF, [fatura])
+    monkeypatch.setattr(agregacao_rpc, 'SQLITE_AGREGACAO_PATH', ':memory:')
+    monkeypatch.setattr(agregacao_rpc, '_fonte_sqlite', fonte)
+    monkeypatch.setattr(agregacao, 'FONTE_AGREGACAO', 'rpc')
+
+    resultado = agregar_periodo(NIF, *PERIODOS['semana'])
+
+    assert dict(resultado['vendas_por_dia_atual']) == aproximar({fatura['data']: fatura['total']})
+    assert list(resultado['filiais_atual']) == ['2']
+    assert resultado['produtos'].totais(ATUAL)[2] == pytest.approx(fatura['total'])
+
+
+def test_uma_chamada_ao_rpc(fonte, supabase_falso, monkeypatch):
+    chamadas = []
+
+    class _Rpc:
+        def __init__(self, parametros):
+            self._parametros = parametros
+
+        def execute(self):
+            p = self._parametros
+            linhas = fonte.agregar(
+                p['p_nif'], INICIO_ANTERIOR, ONTEM, filial=p['p_filial'],
+                cortes=[date.fromisoformat(c) for c in p['p_cortes']]
+            )
+            return type('Resposta', (), {'data': linhas})()
+
+    supabase_falso.rpc = lambda funcao, parametros: chamadas.append((funcao, parametros)) or _Rpc(parametros)
+    monkeypatch.setattr(agregacao_rpc, 'SQLITE_AGREGACAO_PATH', '')
+
+    celulas = ler_celulas_rpc(NIF, INICIO_ANTERIOR, ONTEM, cortes=[INICIO_ANTERIOR, INICIO_ATUAL])
+
+    assert [funcao for funcao, _ in chamadas] == ['agregar_celulas_faturas']
+    assert chamadas[0][1]['p_cortes'] == [INICIO_ANTERIOR.isoformat(), INICIO_ATUAL.isoformat()]
+    assert sum(c['recibos'] for dia in celulas.values() for c in dia.values()) == len(supabase_falso.faturas)
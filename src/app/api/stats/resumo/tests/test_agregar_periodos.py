@@ -0,0 +1,44 @@
+# 🔹 Vários períodos agregados sobre uma única leitura
+
+from datetime import timedelta
+
+import pytest
+
+from fixtures import NIF, ONTEM, INICIO_ANTERIOR, INICIO_ATUAL, FIM_ANTERIOR, aproximar, gerar_faturas
+from utils import agregacao
+from utils.agregacao import agregar_periodo, agregar_periodos
+
+PERIODOS = {
+    'dia': (ONTEM, ONTEM, ONTEM - timedelta(days=1), ONTEM - timedelta(days=1)),
+    'semana': (INICIO_ATUAL, ONTEM, INICIO_ANTERIOR, FIM_ANTERIOR)
+}
+CHAVES = ('stats_atual', 'stats_anterior', 'vendas_por_hora_atual', 'filiais_atual', 'vendas_por_dia_anterior')
+
+
+@pytest.mark.parametrize('fonte', ['faturas', 'rollup'])
+def test_igual_a_um_pedido_por_periodo(supabase_falso, monkeypatch, fonte):
+    monkeypatch.setattr(agregacao, 'FONTE_AGREGACAO', fonte)
+    supabase_falso.faturas.extend(gerar_faturas())
+
+    resultados = agregar_periodos(NIF, PERIODOS, filial='1')
+
+    for chave, datas in PERIODOS.items():
+        esperado = agregar_periodo(NIF, *datas, filial='1')
+        assert {c: resultados[chave][c] for c in CHAVES} == aproximar({c: esperado[c] for c in CHAVES})
+
+
+def test_uma_leitura_para_todos_os_periodos(supabase_falso, monkeypatch):
+    monkeypatch.setattr(agregacao, 'FONTE_AGREGACAO', 'faturas')
+    monkeypatch.setattr(agregacao, 'iterar_lotes_faturas_cache', lambda nif, inicio, fim, **kw: (
+        intervalos.append((inicio, fim)) or [supabase_falso.faturas]
+    ))
+    intervalos = []
+    supabase_falso.faturas.extend(gerar_faturas())
+
+    resultados = agregar_periodos(NIF, PERIODOS)
+
+    assert intervalos == [(INICIO_ANTERIOR, ONTEM)]
+    assert resultados['semana']['stats_atual'][1] == sum(
+        1 for f in supabase_falso.faturas if f['data'] >= INICIO_ATUAL.isoformat()
+    )
+    assert agregar_periodos(NIF, {}) == {}
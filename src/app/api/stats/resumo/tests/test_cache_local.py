@@ -0,0 +1,94 @@
+# 🔹 L1 em memória do processo à frente do cache Redis das rotas
+
+import time
+
+import pytest
+
+from fixtures import NIF
+from utils import cache_local as modulo_l1
+from utils.cache_local import BYTES_POR_ENTRADA_L1, CANAL_INVALIDACAO_L1, CacheLocal
+from utils.geracoes import invalidar_cache
+from utils.utils import redis_client
+
+URL = f'/resumo?nif={NIF}&periodo=2'
+
+
+def test_expiracao_e_lru_por_memoria():
+    local = CacheLocal(max_bytes=2 * (100 + BYTES_POR_ENTRADA_L1))
+    depois = time.time() + 60
+
+    local.guardar('a', 'A', 100, depois)
+    local.guardar('b', 'B', 100, depois)
+    assert local.obter('a') == 'A'
+    # 'b' é a menos usada: sai para dar lugar a 'c'
+    local.guardar('c', 'C', 100, depois)
+    assert (local.obter('a'), local.obter('b'), local.obter('c')) == ('A', None, 'C')
+    assert local.bytes == 2 * (100 + BYTES_POR_ENTRADA_L1)
+
+    # Entradas maiores que o L1 ou já expiradas não entram; as que expiram saem
+    local.guardar('grande', 'G', local.max_bytes, depois)
+    local.guardar('velha', 'V', 1, time.time() - 1)
+    local.guardar('a', 'A', 100, time.time() + 0.05)
+    time.sleep(0.1)
+    assert [local.obter(c) for c in ('grande', 'velha', 'a')] == [None, None, None]
+    assert local.bytes == 100 + BYTES_POR_ENTRADA_L1
+
+
+@pytest.fixture
+def app_l1(app_cache, monkeypatch):
+    from utils import cache_rotas
+    # Sem a thread de subscrição, que limpa o L1 quando arranca (ver test_remocao_chega_aos_outros_workers)
+    monkeypatch.setattr(cache_rotas, 'iniciar_escuta', lambda: None)
+    app_cache.rotas.local = CacheLocal()
+    leituras = []
+    ler = app_cache.cache.get
+    app_cache.cache.get = lambda chave: leituras.append(chave) or ler(chave)
+    app_cache.leituras_redis = leituras
+    return app_cache
+
+
+def test_hit_servido_sem_ler_o_redis(app_l1):
+    chamadas = app_l1.rota('/resumo', 'resumo')
+
+    for _ in range(3):
+        assert app_l1.get(URL).data == b'ok'
+
+    assert len(chamadas) == 1
+    assert len(app_l1.leituras_redis) == 1
+    estatisticas = app_l1.rotas.estatisticas()['resumo']
+    assert (estatisticas['hits'], estatisticas['hits_l1']) == (2, 2)
+
+
+def test_geracao_nova_nao_encontra_a_entrada_antiga(app_l1):
+    chamadas = app_l1.rota('/resumo', 'resumo')
+    app_l1.get(URL)
+
+    invalidar_cache(NIF)
+    app_l1.get(URL)
+    assert len(chamadas) == 2
+
+
+def test_entrada_stale_so_no_redis(app_l1):
+    # O L1 guarda só até à expiração suave: a resposta stale vem do Redis
+    app_l1.rota('/resumo', 'resumo', ttl=0, swr=True)
+    app_l1.get(URL)
+    assert app_l1.rotas.local.bytes == 0
+
+    assert app_l1.get(URL).data == b'ok'
+    assert len(app_l1.leituras_redis) == 2
+    assert app_l1.rotas.estatisticas()['resumo']['hits_l1'] == 0
+
+
+def test_remocao_chega_aos_outros_workers(supabase_falso):
+    modulo_l1.iniciar_escuta()
+    limite = time.time() + 5
+    while not dict(redis_client.pubsub_numsub(CANAL_INVALIDACAO_L1)).get(CANAL_INVALIDACAO_L1.encode()):
+        assert time.time() < limite, 'subscrição do L1 não arrancou'
+        time.sleep(0.01)
+
+    modulo_l1.cache_local.guardar('rota:resumo', 'R', 10, time.time() + 60)
+    redis_client.publish(CANAL_INVALIDACAO_L1, 'rota:resumo')
+
+    while modulo_l1.cache_local.obter('rota:resumo') is not None:
+        assert time.time() < limite, 'remoção publicada não chegou ao L1'
+        time.sleep(0.01)
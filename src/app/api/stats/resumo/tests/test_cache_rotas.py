@@ -0,0 +1,68 @@
+# 🔹 Decorador de cache das rotas: chave por parâmetros e geração, TTL por período
+
+import pytest
+
+from fixtures import NIF
+from utils.geracoes import invalidar_cache
+
+pytest.importorskip('flask')
+from utils.cache_rotas import TTL_PADRAO, TTL_POR_PERIODO, ttl_periodo, ttl_periodos  # noqa: E402
+
+
+def test_chave_pelos_parametros_declarados(app_cache):
+    chamadas = app_cache.rota('/resumo', 'resumo', parametros=('nif', 'periodo', 'filial'))
+
+    for url in (f'/resumo?nif={NIF}&periodo=2', f'/resumo?nif={NIF}&periodo=2&outro=1',
+                f'/resumo?nif={NIF}&periodo=2&filial=1', f'/resumo?nif={NIF}&periodo=3'):
+        assert app_cache.get(url).data == b'ok'
+    app_cache.get(f'/resumo?nif={NIF}&periodo=2&filial=1')
+
+    # Parâmetros fora da declaração não distinguem respostas; a filial distingue
+    assert [c.get('filial') for c in chamadas] == [None, '1', None]
+    assert app_cache.rotas.estatisticas()['resumo'] == {
+        'hits': 2, 'misses': 3, 'stale': 0, 'coalescidos': 0, 'hits_l1': 0, 'taxa_acerto': 40.0
+    }
+
+
+def test_so_respostas_200_ficam_em_cache(app_cache):
+    chamadas = app_cache.rota('/erro', 'erro', corpo=lambda: ('falhou', 500))
+
+    assert app_cache.get(f'/erro?nif={NIF}').status_code == 500
+    assert app_cache.get(f'/erro?nif={NIF}').status_code == 500
+    assert len(chamadas) == 2
+
+
+def test_invalidacao_por_geracao(app_cache):
+    chamadas = app_cache.rota('/resumo', 'resumo', parametros=('nif', 'periodo', 'filial'))
+    urls = [f'/resumo?nif={NIF}&periodo=2&filial=1', f'/resumo?nif={NIF}&periodo=2&filial=2']
+    for url in urls:
+        app_cache.get(url)
+
+    # Um upload na filial 1 só invalida essa filial (e o total de todas)
+    invalidar_cache(NIF, '1')
+    for url in urls:
+        app_cache.get(url)
+    assert [c['filial'] for c in chamadas] == ['1', '2', '1']
+
+    app_cache.rotas.apagar('resumo', {'nif': NIF, 'periodo': '2', 'filial': '2'})
+    app_cache.get(urls[1])
+    assert len(chamadas) == 4
+
+
+def test_ttl_pela_politica_do_periodo(app_cache):
+    app_cache.rota('/resumo', 'resumo')
+    app_cache.rota('/batch', 'batch', parametros=('nif', 'periodos'))
+    app_cache.rota('/fixo', 'fixo', parametros=('nif',), ttl=42)
+
+    for url in (f'/resumo?nif={NIF}&periodo=2', f'/resumo?nif={NIF}&periodo=x',
+                f'/batch?nif={NIF}&periodos=5,0', f'/fixo?nif={NIF}'):
+        app_cache.get(url)
+    assert app_cache.timeouts == [TTL_POR_PERIODO[2], TTL_PADRAO, TTL_POR_PERIODO[0], 42]
+
+
+def test_periodo_fechado_ate_a_meia_noite():
+    assert 0 < ttl_periodo(1) <= 86400
+    assert ttl_periodo('1', {1: 5}) == ttl_periodo(1)
+    assert ttl_periodo(None) == TTL_PADRAO
+    assert ttl_periodos(['1', '2']) == min(ttl_periodo(1), TTL_POR_PERIODO[2])
+    assert ttl_periodos([]) == TTL_PADRAO
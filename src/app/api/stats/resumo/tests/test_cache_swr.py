@@ -0,0 +1,83 @@
+# 🔹 Stale-while-revalidate: a resposta expirada é servida e recalculada uma vez em background
+
+import threading
+import time
+
+import pytest
+
+from fixtures import NIF
+from utils.utils import redis_client
+
+pytest.importorskip('flask')
+from utils.cache_rotas import JANELA_STALE_SEGUNDOS  # noqa: E402
+
+URL = f'/resumo?nif={NIF}&periodo=2'
+
+
+def _versoes(bloqueio=None):
+    """Corpo que devolve v1, v2, ...; com bloqueio, os recálculos esperam por ele"""
+    versoes = iter(range(1, 100))
+
+    def corpo():
+        versao = next(versoes)
+        if bloqueio is not None and versao > 1:
+            bloqueio.wait(5)
+        return f'v{versao}'
+    return corpo
+
+
+def _esperar_revalidacao(app_cache):
+    limite = time.time() + 5
+    while app_cache.rotas._revalidando and time.time() < limite:
+        time.sleep(0.01)
+
+
+def test_stale_servido_e_recalculado_em_background(app_cache):
+    # TTL 0: a entrada fica stale logo a seguir a ser guardada
+    chamadas = app_cache.rota('/resumo', 'resumo', corpo=_versoes(), ttl=0, swr=True)
+
+    assert app_cache.get(URL).data == b'v1'
+    assert app_cache.timeouts == [JANELA_STALE_SEGUNDOS]
+    assert app_cache.get(URL).data == b'v1'
+    _esperar_revalidacao(app_cache)
+
+    assert len(chamadas) == 2
+    assert app_cache.get(URL).data == b'v2'
+    _esperar_revalidacao(app_cache)
+    estatisticas = app_cache.rotas.estatisticas()['resumo']
+    assert (estatisticas['misses'], estatisticas['stale']) == (1, 2)
+
+
+def test_um_recalculo_por_chave(app_cache):
+    bloqueio = threading.Event()
+    chamadas = app_cache.rota('/resumo', 'resumo', corpo=_versoes(bloqueio), ttl=0, swr=True)
+    app_cache.get(URL)
+
+    # Enquanto o recálculo está em curso, os pedidos continuam a receber a resposta stale
+    respostas = [app_cache.get(URL).data for _ in range(5)]
+    bloqueio.set()
+    _esperar_revalidacao(app_cache)
+
+    assert respostas == [b'v1'] * 5
+    assert len(chamadas) == 2
+
+
+def test_recalculo_de_outro_worker(app_cache):
+    chamadas = app_cache.rota('/resumo', 'resumo', corpo=_versoes(), ttl=0, swr=True)
+    app_cache.get(URL)
+
+    # Outro worker já tem o lock de revalidação desta chave
+    chave = app_cache.rotas.chave('resumo', {'nif': NIF, 'periodo': '2'})
+    redis_client.set(f'revalidar:{chave}', 'outro', px=60000)
+
+    assert app_cache.get(URL).data == b'v1'
+    _esperar_revalidacao(app_cache)
+    assert len(chamadas) == 1
+
+
+def test_sem_swr_a_entrada_expira(app_cache):
+    chamadas = app_cache.rota('/resumo', 'resumo', corpo=_versoes(), ttl=60)
+    app_cache.get(URL)
+    assert app_cache.timeouts == [60]
+    assert app_cache.get(URL).data == b'v1'
+    assert len(chamadas) == 1
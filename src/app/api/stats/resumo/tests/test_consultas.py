@@ -0,0 +1,42 @@
+# 🔹 Select mínimo por rota (montar_select)
+
+import pytest
+
+from fixtures import NIF, ONTEM, INICIO_ANTERIOR, gerar_faturas
+from utils.consultas import consulta_faturas, montar_select, CAMPOS_ITEM_CONTAGEM
+from utils.rollup import construir_rollup
+from utils.utils import CAMPOS_FATURA_CELULAS, CAMPOS_FATURA_GRUPO
+
+
+def test_so_os_campos_declarados():
+    assert montar_select(('data', 'hora', 'total')) == 'data, hora, total'
+    # Campos repetidos saem uma vez, pela ordem em que foram declarados
+    assert montar_select(('total', 'data', 'total')) == 'total, data'
+
+
+def test_join_dos_itens_so_com_campos_de_item():
+    assert montar_select(('id',), CAMPOS_ITEM_CONTAGEM) == 'id, faturas_itemfatura(quantidade)'
+    assert 'faturas_itemfatura' not in montar_select(('id',), ())
+    assert CAMPOS_FATURA_CELULAS == (
+        'id, data, total, hora, filial, faturas_itemfatura(nome, quantidade, preco_unitario, total)'
+    )
+    # O grupo acrescenta o nif; o id dos itens nunca é lido
+    assert CAMPOS_FATURA_GRUPO.startswith('nif, id, data')
+    assert '*' not in CAMPOS_FATURA_GRUPO and 'faturas_itemfatura(id' not in CAMPOS_FATURA_GRUPO
+
+
+@pytest.mark.parametrize('campos, campos_itens', [(('data', 'valor'), ()), (('data',), ('preco',)), (('*',), ())])
+def test_campo_desconhecido_e_erro(campos, campos_itens):
+    with pytest.raises(ValueError, match='Campos desconhecidos'):
+        montar_select(campos, campos_itens)
+
+
+def test_consulta_faturas_usa_o_select(supabase_falso):
+    consulta_faturas(supabase_falso, ('id', 'data')).execute()
+    assert supabase_falso.selects == [('faturas_fatura', 'id, data')]
+
+
+def test_rollup_le_so_as_colunas_das_celulas(supabase_falso):
+    supabase_falso.faturas.extend(gerar_faturas(n=5))
+    construir_rollup(NIF, INICIO_ANTERIOR, ONTEM)
+    assert {select for _, select in supabase_falso.selects} == {CAMPOS_FATURA_CELULAS}
@@ -0,0 +1,28 @@
+# 🔹 Dashboard: resumo, produtos, heatmap e faturas de uma só leitura e uma só passagem
+
+from fixtures import NIF, ONTEM, INICIO_ATUAL, INICIO_ANTERIOR, FIM_ANTERIOR, aproximar, gerar_faturas
+from utils.agregacao import agregar_periodo
+from utils.heatmap import ATUAL
+
+PERIODOS = (INICIO_ATUAL, ONTEM, INICIO_ANTERIOR, FIM_ANTERIOR)
+
+
+def test_todas_as_secoes_de_uma_leitura(supabase_falso):
+    faturas = gerar_faturas()
+    supabase_falso.faturas.extend(faturas)
+
+    completo = agregar_periodo(NIF, *PERIODOS, filial='2', manter_faturas=True)
+
+    # Uma página com as faturas e a página vazia que termina o período
+    assert supabase_falso.pedidos == 2
+    do_periodo = [f for f in faturas if f['filial'] == 2 and f['data'] >= INICIO_ATUAL.isoformat()]
+    assert [f['id'] for f in completo['faturas_atual']] == [
+        f['id'] for f in sorted(do_periodo, key=lambda f: (f['data'], f['id']))
+    ]
+
+    # As secções agregadas são as mesmas que as rotas sem faturas calculam
+    resumo = agregar_periodo(NIF, *PERIODOS, filial='2')
+    for chave in ('stats_atual', 'stats_anterior', 'filiais_atual', 'vendas_por_dia_atual'):
+        assert completo[chave] == aproximar(resumo[chave])
+    assert completo['produtos'].como_dict(ATUAL) == aproximar(resumo['produtos'].como_dict(ATUAL))
+    assert completo['heatmap'].celulas(ATUAL) == resumo['heatmap'].celulas(ATUAL)
@@ -0,0 +1,60 @@
+# 🔹 Uploads idempotentes: impressões digitais de ficheiros e de faturas
+
+import io
+import json
+
+from fixtures import NIF, ONTEM, gerar_faturas_upload
+from utils.ingestao import TTL_INDICE_INGESTAO_DIAS, impressao_ficheiro, inserir_faturas, processar_ficheiro
+from utils.utils import redis_client
+
+
+def _ficheiro(faturas):
+    return io.BytesIO('\n'.join(json.dumps(fa) for fa in faturas).encode('utf-8'))
+
+
+def test_faturas_ja_importadas_nao_se_repetem(supabase_falso):
+    faturas = gerar_faturas_upload(n=5)
+    inserir_faturas(faturas[:3])
+
+    criadas, erros, duplicadas = inserir_faturas(faturas + [faturas[4]])
+
+    assert (len(criadas), erros) == (2, [])
+    assert sorted(d['motivo'] for d in duplicadas) == ['Fatura já importada'] * 3 + ['Fatura repetida no ficheiro']
+    assert len(supabase_falso.faturas) == 5
+
+
+def test_ficheiro_repetido_responde_sem_ir_ao_banco(supabase_falso):
+    faturas = gerar_faturas_upload(n=4)
+    primeiro = processar_ficheiro(_ficheiro(faturas))
+    pedidos = supabase_falso.pedidos
+
+    segundo = processar_ficheiro(_ficheiro(faturas))
+
+    assert len(primeiro['criadas']) == 4
+    assert segundo['criadas'] == [] and segundo['ingerido']['faturas'] == 4
+    assert supabase_falso.pedidos == pedidos
+
+
+def test_ficheiro_com_erros_pode_ser_reenviado(supabase_falso):
+    faturas = gerar_faturas_upload(n=3)
+    faturas[1]['filial'] = None
+
+    processar_ficheiro(_ficheiro(faturas))
+
+    assert redis_client.get(f"ingestao:ficheiro:{impressao_ficheiro(_ficheiro(faturas).read())}") is None
+
+
+def test_indice_por_mes_e_com_expiracao(supabase_falso):
+    faturas = gerar_faturas_upload(n=2)
+    processar_ficheiro(_ficheiro(faturas))
+
+    chave_faturas = f"ingestao:faturas:{NIF}:{ONTEM.isoformat()[:7]}"
+    chave_ficheiro = f"ingestao:ficheiro:{impressao_ficheiro(_ficheiro(faturas).read())}"
+    assert redis_client.scard(chave_faturas) == 2
+    for chave in (chave_faturas, chave_ficheiro):
+        assert 0 < redis_client.ttl(chave) <= TTL_INDICE_INGESTAO_DIAS * 86400
+
+    # Apagar as chaves (como descrito em ingestao.py) força a reingestão
+    supabase_falso.faturas.clear()
+    redis_client.delete(chave_faturas, chave_ficheiro)
+    assert len(processar_ficheiro(_ficheiro(faturas))['criadas']) == 2
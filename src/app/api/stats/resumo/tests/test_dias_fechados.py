@@ -0,0 +1,48 @@
+# 🔹 Dias fechados: em memória sem TTL enquanto a versão do dia não muda, e respostas
+# de períodos fechados em cache até à meia-noite
+
+import pytest
+
+from fixtures import NIF, ONTEM, INICIO_ANTERIOR, INICIO_ATUAL, FIM_ANTERIOR, gerar_faturas
+from utils.agregacao import agregar_periodos
+from utils.rollup import aplicar_delta_rollup, _chave_dia
+from utils.utils import redis_client
+
+PERIODOS = {'semana': (INICIO_ATUAL, ONTEM, INICIO_ANTERIOR, FIM_ANTERIOR)}
+
+
+def test_dias_fechados_servidos_da_memoria(supabase_falso):
+    faturas = gerar_faturas()
+    supabase_falso.faturas.extend(faturas)
+    agregar_periodos(NIF, PERIODOS)  # constrói o rollup
+    esperado = agregar_periodos(NIF, PERIODOS)['semana']['stats_atual']
+
+    # Sem alterar as versões, os dias já não são lidos do Redis
+    redis_client.delete(*[_chave_dia(NIF, f['data']) for f in faturas])
+    assert agregar_periodos(NIF, PERIODOS)['semana']['stats_atual'] == esperado
+
+    # Um upload muda a versão do seu dia: só esse dia volta ao Redis
+    nova = {**gerar_faturas(n=1, primeiro_id=500)[0], 'data': ONTEM.isoformat(), 'total': 100.0}
+    supabase_falso.faturas.append(nova)
+    aplicar_delta_rollup(NIF, nova)
+    total, recibos = agregar_periodos(NIF, PERIODOS)['semana']['stats_atual'][:2]
+    assert recibos == 1 + sum(1 for f in faturas if f['data'] != ONTEM.isoformat() and f['data'] >= INICIO_ATUAL.isoformat())
+    assert total == pytest.approx(100.0 + sum(
+        f['total'] for f in faturas if f['data'] != ONTEM.isoformat() and f['data'] >= INICIO_ATUAL.isoformat()
+    ))
+
+
+def test_periodos_fechados_ate_a_meia_noite(monkeypatch):
+    pytest.importorskip('flask')
+    from utils import cache_rotas
+    from utils.cache_rotas import TTL_ANALISE_IA_POR_PERIODO, TTL_POR_PERIODO, ttl_periodo, ttl_periodos
+
+    assert 0 < cache_rotas._segundos_ate_meia_noite() <= 86400
+    monkeypatch.setattr(cache_rotas, '_segundos_ate_meia_noite', lambda: 5000)
+
+    assert ttl_periodo(1) == ttl_periodo('1', TTL_ANALISE_IA_POR_PERIODO) == 5000
+    assert ttl_periodo(3) == TTL_POR_PERIODO[3]
+    assert ttl_periodo('x') == cache_rotas.TTL_PADRAO
+    # Vários períodos numa resposta: expira com o primeiro
+    assert ttl_periodos(['1', '5']) == min(5000, TTL_POR_PERIODO[5])
+    assert ttl_periodos(['0', '1']) == TTL_POR_PERIODO[0]
@@ -0,0 +1,47 @@
+# 🔹 Métricas por filial a partir dos acumulados da passagem principal
+
+from fixtures import INICIO_ANTERIOR, INICIO_ATUAL, FIM_ANTERIOR, ONTEM
+from utils.agregacao import AgregadorFaturas
+from utils.filiais import metricas_filiais
+
+
+def _fatura(dia, hora, filial, total):
+    return {
+        'data': dia.isoformat(), 'hora': hora, 'filial': filial, 'total': total,
+        'faturas_itemfatura': [{'nome': 'Pão', 'quantidade': 2, 'preco_unitario': total / 2, 'total': total}]
+    }
+
+
+def _dados():
+    return AgregadorFaturas(INICIO_ATUAL, ONTEM, INICIO_ANTERIOR, FIM_ANTERIOR).adicionar_lote([
+        _fatura(ONTEM, '09:00', 1, 30.0),
+        _fatura(ONTEM, '10:00', 1, 10.0),
+        _fatura(ONTEM, '18:00', 2, 60.0),
+        _fatura(INICIO_ANTERIOR, '09:00', 1, 20.0)
+    ]).resultado()
+
+
+def test_metricas_por_filial():
+    metricas = metricas_filiais(_dados())
+
+    # Ordenadas por volume
+    assert [m['filial'] for m in metricas] == ['2', '1']
+    assert metricas[1] == {
+        'filial': '1',
+        'volume': 40.0,
+        'numero_faturas': 2,
+        'itens_vendidos': 4,
+        'ticket_medio': 20.0,
+        'percentual_total': 40.0,
+        'vendas_por_hora': [{'hora': '09:00', 'total': 30.0}, {'hora': '10:00', 'total': 10.0}]
+    }
+    assert 'variacao' not in metricas[0]
+
+
+def test_variacao_face_ao_periodo_anterior():
+    metricas = {m['filial']: m for m in metricas_filiais(_dados(), comparar=True)}
+
+    assert metricas['1']['variacao']['volume'] == {'valor': 40.0, 'variacao': '+100.0%', 'cor': '#28a745', 'ontem': 20.0}
+    # Filial sem vendas no período anterior
+    assert metricas['2']['variacao']['numero_faturas']['ontem'] == 0
+    assert metricas['2']['variacao']['numero_faturas']['variacao'] == '+100.0%'
@@ -0,0 +1,65 @@
+# 🔹 Gerações de cache por NIF e por filial
+
+import pytest
+
+from fixtures import NIF
+from utils import geracoes
+from utils.geracoes import chave_com_geracao, chave_com_geracoes, invalidar_cache, invalidar_cache_faturas
+
+OUTRO_NIF = '500000001'
+
+
+@pytest.fixture
+def chaves(supabase_falso):
+    """Chave de cada resposta antes de qualquer invalidação"""
+    return lambda: {
+        (nif, filial): chave_com_geracao('resumo', nif, filial)
+        for nif in (NIF, OUTRO_NIF) for filial in (None, '1', '2')
+    }
+
+
+def _mudaram(antes, depois):
+    return {par for par in antes if antes[par] != depois[par]}
+
+
+def test_chave_estavel_sem_invalidacao(chaves):
+    assert chaves() == chaves()
+    assert chave_com_geracao('resumo', NIF, '1') == 'resumo@0.0'
+
+
+def test_invalidar_nif_muda_todas_as_filiais(chaves):
+    antes = chaves()
+    invalidar_cache(NIF)
+    assert _mudaram(antes, chaves()) == {(NIF, None), (NIF, '1'), (NIF, '2')}
+
+
+def test_invalidar_filial_muda_a_filial_e_o_total(chaves):
+    antes = chaves()
+    invalidar_cache(NIF, '1')
+    assert _mudaram(antes, chaves()) == {(NIF, None), (NIF, '1')}
+
+
+def test_faturas_gravadas_invalidam_os_seus_pares(chaves):
+    antes = chaves()
+    # Filial numérica e texto são a mesma filial; sem filial só mexe no total
+    nifs = invalidar_cache_faturas([
+        {'nif': NIF, 'filial': 2}, {'nif': NIF, 'filial': '2'}, {'nif': OUTRO_NIF, 'filial': None}
+    ])
+    assert nifs == {NIF, OUTRO_NIF}
+    assert _mudaram(antes, chaves()) == {(NIF, None), (NIF, '2'), (OUTRO_NIF, None)}
+
+
+def test_varios_pares_numa_chave(chaves):
+    antes = chave_com_geracoes('grupo', [(NIF, None), (OUTRO_NIF, None)])
+    assert antes == 'grupo@0.0-0.0'
+    invalidar_cache(OUTRO_NIF)
+    assert chave_com_geracoes('grupo', [(NIF, None), (OUTRO_NIF, None)]) == 'grupo@0.0-1.0'
+
+
+def test_sem_redis_nao_ha_cache(chaves, monkeypatch):
+    class _RedisEmBaixo:
+        def mget(self, chaves):
+            raise ConnectionError('Redis em baixo')
+
+    monkeypatch.setattr(geracoes, 'redis_client', _RedisEmBaixo())
+    assert chave_com_geracao('resumo', NIF) != chave_com_geracao('resumo', NIF)
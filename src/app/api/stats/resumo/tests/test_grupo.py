@@ -0,0 +1,48 @@
+# 🔹 Grupo de NIFs e filiais: totais e repartição por NIF na mesma passagem
+
+import pytest
+
+from fixtures import NIF, ONTEM, INICIO_ATUAL, INICIO_ANTERIOR, FIM_ANTERIOR, aproximar, gerar_faturas
+from utils import agregacao
+from utils.agregacao import agregar_grupo, agregar_periodo
+
+OUTRO_NIF = '500000001'
+PERIODOS = (INICIO_ATUAL, ONTEM, INICIO_ANTERIOR, FIM_ANTERIOR)
+
+
+@pytest.fixture
+def faturas(supabase_falso):
+    supabase_falso.faturas.extend(gerar_faturas(n=40))
+    supabase_falso.faturas.extend({**f, 'nif': OUTRO_NIF} for f in gerar_faturas(n=30, primeiro_id=100))
+    # Fora do grupo
+    supabase_falso.faturas.extend({**f, 'nif': '500000002'} for f in gerar_faturas(n=10, primeiro_id=200))
+    return supabase_falso.faturas
+
+
+@pytest.mark.parametrize('fonte', ['faturas', 'rollup'])
+def test_total_e_por_nif(faturas, monkeypatch, fonte):
+    monkeypatch.setattr(agregacao, 'FONTE_AGREGACAO', fonte)
+
+    total, por_nif = agregar_grupo([NIF, OUTRO_NIF], *PERIODOS, filiais=[1, '2'])
+
+    assert set(por_nif) == {NIF, OUTRO_NIF}
+    for nif in (NIF, OUTRO_NIF):
+        # Só as filiais pedidas, como texto
+        assert set(por_nif[nif]['filiais_atual']) <= {'1', '2'}
+        assert por_nif[nif]['stats_atual'][1] == sum(
+            1 for f in faturas
+            if f['nif'] == nif and f['filial'] in (1, 2) and f['data'] >= INICIO_ATUAL.isoformat()
+        )
+    assert total['stats_atual'][:3] == aproximar(tuple(
+        sum(por_nif[nif]['stats_atual'][i] for nif in por_nif) for i in range(3)
+    ))
+    assert por_nif[NIF]['filiais_atual']['1'] == aproximar(agregar_periodo(NIF, *PERIODOS, filial='1')['filiais_atual']['1'])
+
+
+def test_faturas_em_bruto_numa_so_consulta(faturas, supabase_falso, monkeypatch):
+    monkeypatch.setattr(agregacao, 'FONTE_AGREGACAO', 'faturas')
+
+    agregar_grupo([NIF, OUTRO_NIF], *PERIODOS)
+
+    # Uma página com as faturas dos dois NIFs e a página vazia que termina o período
+    assert supabase_falso.pedidos == 2
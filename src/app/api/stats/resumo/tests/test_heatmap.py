@@ -0,0 +1,45 @@
+# 🔹 Heatmap 24x7 dos dois períodos: células, totais e picos
+
+from utils.heatmap import ATUAL, ANTERIOR, HeatmapPeriodos
+
+
+def _heatmap():
+    heatmap = HeatmapPeriodos()
+    heatmap.adicionar(ATUAL, 9, 0, 10.0)
+    heatmap.adicionar(ATUAL, 9, 0, 5.0)
+    heatmap.adicionar(ATUAL, 20, 6, 30.0)
+    heatmap.adicionar(ATUAL, 13, 2, 12.0, quantidade=4)
+    heatmap.adicionar(ANTERIOR, 9, 0, 1.0)
+    return heatmap
+
+
+def test_celulas_por_hora_e_dia():
+    celulas = _heatmap().celulas(ATUAL)
+
+    assert [(c['hora_num'], c['dia_num']) for c in celulas] == [(9, 0), (13, 2), (20, 6)]
+    assert celulas[0] == {
+        'hora': '09:00', 'hora_num': 9, 'dia_semana': 'Segunda', 'dia_num': 0,
+        'volume': 15.0, 'quantidade_faturas': 2, 'ticket_medio': 7.5
+    }
+    # Os períodos não se misturam
+    assert [c['volume'] for c in _heatmap().celulas(ANTERIOR)] == [1.0]
+
+
+def test_totais_top_e_picos():
+    heatmap = _heatmap()
+
+    assert heatmap.totais(ATUAL) == (57.0, 7)
+    assert [c['hora_num'] for c in heatmap.top_celulas(ATUAL, 2)] == [20, 9]
+    assert [c['hora_num'] for c in heatmap.top_celulas(ATUAL, 1, 'quantidade')] == [13]
+    assert heatmap.picos(ATUAL) == {
+        'maior_volume': {'hora': '20:00', 'dia': 'Domingo', 'volume': 30.0},
+        'maior_quantidade': {'hora': '13:00', 'dia': 'Quarta', 'quantidade': 4}
+    }
+    assert HeatmapPeriodos().picos(ATUAL) == {'maior_volume': None, 'maior_quantidade': None}
+
+
+def test_de_vetores():
+    heatmap = _heatmap()
+    copia = HeatmapPeriodos.de_vetores(heatmap.volume, heatmap.quantidade)
+    assert copia.celulas(ATUAL) == heatmap.celulas(ATUAL)
+    assert copia.celulas(ANTERIOR) == heatmap.celulas(ANTERIOR)
@@ -0,0 +1,106 @@
+# 🔹 Métricas de hoje por watermark: só as faturas novas são lidas, nenhuma se perde ou repete
+
+from datetime import date, datetime, timedelta
+
+import pytest
+
+from fixtures import NIF, gerar_faturas
+from utils import agregacao, hoje
+from utils.agregacao import agregar_periodo
+from utils.hoje import celulas_hoje, invalidar_hoje
+from utils.ingestao import _remover_cabecalhos
+
+HOJE = date.today()
+ONTEM = HOJE - timedelta(days=1)
+
+
+def _de_hoje(n, primeiro_id, minutos=10):
+    """Faturas de hoje gravadas há alguns minutos (já fora da margem do watermark)"""
+    criado_em = (datetime.utcnow() - timedelta(minutes=minutos)).isoformat()
+    return [
+        {**f, 'data': HOJE.isoformat(), 'criado_em': criado_em}
+        for f in gerar_faturas(n=n, primeiro_id=primeiro_id)
+    ]
+
+
+def _totais(celulas):
+    return round(sum(c['total'] for c in celulas.values()), 6), sum(c['recibos'] for c in celulas.values())
+
+
+def _esperado(faturas):
+    return round(sum(f['total'] for f in faturas), 6), len(faturas)
+
+
+def test_so_le_acima_do_watermark(supabase_falso):
+    supabase_falso.faturas.extend(_de_hoje(20, 1))
+    assert _totais(celulas_hoje(NIF)) == _esperado(supabase_falso.faturas)
+    assert hoje._acumulados[NIF].watermark == 20
+
+    supabase_falso.faturas.extend(_de_hoje(5, 21))
+    lidas = []
+    iterar = hoje.iterar_lotes_faturas_periodo
+    def espiar(*args, **kwargs):
+        for lote in iterar(*args, **kwargs):
+            lidas.extend(lote)
+            yield lote
+    hoje.iterar_lotes_faturas_periodo = espiar
+    try:
+        assert _totais(celulas_hoje(NIF)) == _esperado(supabase_falso.faturas)
+    finally:
+        hoje.iterar_lotes_faturas_periodo = iterar
+    assert sorted(f['id'] for f in lidas) == list(range(21, 26))
+
+
+def test_id_menor_visivel_mais_tarde(supabase_falso):
+    # O id 3 ficou atribuído mas só aparece na leitura seguinte (gravação concorrente)
+    faturas = _de_hoje(3, 1, minutos=0) + _de_hoje(2, 4, minutos=0)
+    supabase_falso.faturas.extend(f for f in faturas if f['id'] != 3)
+    celulas_hoje(NIF)
+    assert hoje._acumulados[NIF].watermark is None
+
+    supabase_falso.faturas.append(faturas[2])
+    assert _totais(celulas_hoje(NIF)) == _esperado(faturas)
+    assert _totais(celulas_hoje(NIF)) == _esperado(faturas)
+
+
+def test_fatura_apagada_deixa_de_contar(supabase_falso):
+    faturas = _de_hoje(6, 1)
+    supabase_falso.faturas.extend(faturas)
+    celulas_hoje(NIF)
+
+    # A ingestão apaga uma fatura cujos itens falharam depois de ela já ter sido incorporada
+    assert _remover_cabecalhos([{**faturas[2], 'nif': NIF}])
+    restantes = [f for f in faturas if f['id'] != 3]
+    assert _totais(celulas_hoje(NIF)) == _esperado(restantes)
+
+    # A geração de outro NIF não mexe neste acumulado
+    watermark = hoje._acumulados[NIF].watermark
+    invalidar_hoje(['999999990'])
+    celulas_hoje(NIF)
+    assert hoje._acumulados[NIF].watermark == watermark
+
+
+@pytest.mark.parametrize('fonte', ['faturas', 'rollup', 'rpc'])
+def test_periodo_hoje_pelo_acumulado_em_qualquer_fonte(supabase_falso, monkeypatch, fonte):
+    from utils import agregacao_rpc
+    monkeypatch.setattr(agregacao_rpc, 'ler_celulas_rpc', lambda nif, inicio, fim, **kw: (
+        pytest.fail('hoje lido pelo RPC') if inicio <= HOJE <= fim else {}
+    ))
+    monkeypatch.setattr(agregacao, 'FONTE_AGREGACAO', fonte)
+    supabase_falso.faturas.extend(_de_hoje(10, 1))
+    agregar_periodo(NIF, HOJE, HOJE, ONTEM, ONTEM)
+
+    # As faturas de hoje só são lidas pelo acumulado, e só acima do watermark
+    supabase_falso.faturas.extend(_de_hoje(2, 11))
+    lidos = []
+    monkeypatch.setattr(hoje, 'iterar_lotes_faturas_periodo', lambda *a, **kw: lidos.append(kw) or [
+        [f for f in supabase_falso.faturas if f['id'] > (kw.get('depois_id') or 0)]
+    ])
+    cache = agregacao.iterar_lotes_faturas_cache
+    monkeypatch.setattr(agregacao, 'iterar_lotes_faturas_cache', lambda nif, inicio, fim, **kw: (
+        pytest.fail('hoje lido em bruto') if inicio <= HOJE <= fim else cache(nif, inicio, fim, **kw)
+    ))
+
+    resultado = agregar_periodo(NIF, HOJE, HOJE, ONTEM, ONTEM)
+    assert resultado['stats_atual'][1] == 12
+    assert [kw['depois_id'] for kw in lidos] == [10]
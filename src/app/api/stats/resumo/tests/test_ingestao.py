@@ -0,0 +1,81 @@
+# 🔹 Inserção em lotes de faturas e itens, com repetição fatura a fatura quando um lote falha
+
+from fixtures import NIF, gerar_faturas_upload
+from utils import ingestao
+from utils.ingestao import inserir_faturas
+
+
+def _numeros(faturas):
+    return sorted(f['numero_fatura'] for f in faturas)
+
+
+def _inserts(supabase, tabela):
+    return [n for t, n in supabase.inserts if t == tabela]
+
+
+def test_lotes_de_faturas_e_itens(supabase_falso, monkeypatch):
+    monkeypatch.setattr(ingestao, 'TAMANHO_LOTE_INSERCAO_ITENS', 8)
+    faturas = gerar_faturas_upload(n=25)
+
+    criadas, erros, duplicadas = inserir_faturas(faturas, tamanho_lote=10)
+
+    assert (len(criadas), erros, duplicadas) == (25, [], [])
+    # Um INSERT por lote de faturas e os itens de cada lote em pedidos de 8 (4 faturas)
+    assert _inserts(supabase_falso, 'faturas_fatura') == [10, 10, 5]
+    assert _inserts(supabase_falso, 'faturas_itemfatura') == [8, 8, 4, 8, 8, 4, 8, 2]
+    assert len(supabase_falso.tabelas['faturas_itemfatura']) == 50
+    assert all(len(f['faturas_itemfatura']) == 2 for f in supabase_falso.faturas)
+    assert {f['nif'] for f in supabase_falso.faturas} == {NIF}
+
+
+def test_lote_de_faturas_rejeitado_repete_fatura_a_fatura(supabase_falso):
+    faturas = gerar_faturas_upload(n=6)
+    supabase_falso.rejeitar = lambda tabela, linhas: (
+        tabela == 'faturas_fatura' and any(l['numero_fatura'] == 'FT2024_3' for l in linhas)
+    )
+
+    criadas, erros, _ = inserir_faturas(faturas)
+
+    assert _inserts(supabase_falso, 'faturas_fatura') == [6] + [1] * 6
+    assert [e['numero_fatura'] for e in erros] == ['FT2024_3']
+    assert _numeros(criadas) == _numeros(supabase_falso.faturas) == [
+        f'FT2024_{i}' for i in (1, 2, 4, 5, 6)
+    ]
+
+
+def test_itens_rejeitados_apagam_so_a_sua_fatura(supabase_falso):
+    faturas = gerar_faturas_upload(n=6)
+    supabase_falso.rejeitar = lambda tabela, linhas: (
+        tabela == 'faturas_itemfatura' and any(l['fatura_id'] == 2 for l in linhas)
+    )
+
+    criadas, erros, _ = inserir_faturas(faturas)
+
+    assert [e['numero_fatura'] for e in erros] == ['FT2024_2']
+    assert 2 not in {f['id'] for f in supabase_falso.faturas}
+    assert _numeros(criadas) == _numeros(supabase_falso.faturas)
+    assert len(supabase_falso.tabelas['faturas_itemfatura']) == 10
+
+
+def test_faturas_que_nao_se_apagam_seguem_como_criadas(supabase_falso, monkeypatch):
+    faturas = gerar_faturas_upload(n=3)
+    supabase_falso.rejeitar = lambda tabela, linhas: (
+        tabela == 'faturas_itemfatura' and any(l['fatura_id'] == 2 for l in linhas)
+    )
+    monkeypatch.setattr(ingestao, '_remover_cabecalhos', lambda faturas: False)
+
+    criadas, erros, _ = inserir_faturas(faturas)
+
+    # O banco ficou com a fatura (sem itens): conta como criada, com o erro dos itens
+    assert [e['numero_fatura'] for e in erros] == ['FT2024_2']
+    assert _numeros(criadas) == _numeros(supabase_falso.faturas) == ['FT2024_1', 'FT2024_2', 'FT2024_3']
+
+
+def test_campos_em_falta_nao_vao_para_o_banco(supabase_falso):
+    faturas = gerar_faturas_upload(n=3)
+    faturas[1]['filial'] = None
+
+    criadas, erros, _ = inserir_faturas(faturas)
+
+    assert [e['erro'] for e in erros] == ['Campos obrigatórios faltando']
+    assert len(criadas) == len(supabase_falso.faturas) == 2
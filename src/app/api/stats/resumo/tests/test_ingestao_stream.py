@@ -0,0 +1,56 @@
+# 🔹 Leitura do upload em stream, cortada pelo separador de faturas
+
+import io
+import json
+
+import pytest
+
+from fixtures import gerar_faturas_upload
+from utils import ingestao
+from utils.ingestao import detetar_separador, inserir_faturas, iterar_faturas_stream, processar_ficheiro
+
+
+def _ficheiro(faturas, separador):
+    return io.BytesIO(separador.join(json.dumps(fa, ensure_ascii=False) for fa in faturas).encode('utf-8'))
+
+
+def test_separador_cortado_entre_blocos(supabase_falso):
+    faturas = gerar_faturas_upload(n=12)
+
+    # Blocos pequenos cortam o separador, e os caracteres multibyte, a meio
+    lidas = list(iterar_faturas_stream(_ficheiro(faturas, '\n\n\n'), '\n\n\n', tamanho_bloco=7))
+
+    assert lidas == faturas
+
+
+def test_separador_detetado_no_ficheiro(supabase_falso, monkeypatch):
+    faturas = gerar_faturas_upload(n=6)
+    assert detetar_separador(_ficheiro(faturas, '\n')) == ''
+
+    ficheiro = _ficheiro(faturas, '\f')
+    assert detetar_separador(ficheiro) == '\f'
+    assert ficheiro.tell() == 0
+
+    textos = []
+    parse = ingestao.parse_faturas
+    monkeypatch.setattr(ingestao, 'parse_faturas', lambda texto: textos.append(texto) or parse(texto))
+
+    resultado = processar_ficheiro(ficheiro)
+
+    assert len(resultado['criadas']) == 6
+    # Em stream o parser recebe o texto até ao último separador e depois o resto
+    assert len(textos) > 1
+
+
+def test_ficheiro_sem_separador_e_recusado(supabase_falso, monkeypatch):
+    monkeypatch.setattr(ingestao, 'MAX_TEXTO_SEM_SEPARADOR', 1000)
+    faturas = gerar_faturas_upload(n=30)
+
+    with pytest.raises(ValueError):
+        list(iterar_faturas_stream(_ficheiro(faturas, '\n'), '\f', tamanho_bloco=100))
+
+    # Na ingestão é um erro do ficheiro: as faturas já lidas ficam gravadas
+    texto = _ficheiro(faturas[:2], '\f').getvalue() + b'\f' + _ficheiro(faturas[2:], '\n').getvalue()
+    criadas, erros, _ = inserir_faturas(iterar_faturas_stream(io.BytesIO(texto), '\f', tamanho_bloco=100))
+    assert len(criadas) == 2
+    assert erros[-1]['erro'].startswith('Erro ao ler faturas do ficheiro')
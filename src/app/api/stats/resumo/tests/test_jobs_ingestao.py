@@ -0,0 +1,79 @@
+# 🔹 Jobs de ingestão: estado no Redis e jobs órfãos de processos que terminaram
+
+import json
+import os
+import tempfile
+
+import pytest
+
+from fixtures import NIF, gerar_faturas_upload
+from utils import jobs_ingestao
+from utils.jobs_ingestao import _chave_batimento, criar_job, job_do_nif, obter_job
+from utils.utils import redis_client
+
+
+class _ExecutorFalso:
+    """Guarda os jobs submetidos; correr() executa-os como o pool faria"""
+
+    def __init__(self):
+        self.pendentes = []
+
+    def submit(self, fn, *args):
+        self.pendentes.append((fn, args))
+
+    def correr(self):
+        for fn, args in self.pendentes:
+            fn(*args)
+        self.pendentes = []
+
+
+@pytest.fixture
+def executor(supabase_falso, monkeypatch):
+    executor = _ExecutorFalso()
+    monkeypatch.setattr(jobs_ingestao, '_executor', executor)
+    monkeypatch.setattr(jobs_ingestao, '_batimento', {'pid': None, 'processo': None})
+    return executor
+
+
+def _gravar(faturas):
+    descritor, caminho = tempfile.mkstemp(prefix='upload-fatura-teste-')
+    with os.fdopen(descritor, 'w', encoding='utf-8') as ficheiro:
+        ficheiro.write('\n'.join(json.dumps(fa) for fa in faturas))
+    return caminho
+
+
+def test_job_concluido(executor):
+    caminho = _gravar(gerar_faturas_upload(n=4))
+    concluidas = []
+    job_id = criar_job(caminho, 'faturas.txt', ao_concluir=lambda criadas: concluidas.append(criadas) or 1)
+
+    assert obter_job(job_id)['estado'] == 'em_fila'
+    executor.correr()
+
+    job = obter_job(job_id)
+    assert job['job_id'] == job_id
+    assert (job['estado'], job['processadas'], job['falhadas'], job['cache_limpo']) == ('concluido', 4, 0, 1)
+    assert 'throughput' in job and 'caminho' not in job and 'processo' not in job
+    assert len(concluidas[0]) == 4
+    assert not os.path.exists(caminho)
+    # Sem NIF no upload, o job passa a ser dos emitentes das faturas criadas
+    assert job_do_nif(job, NIF) and not job_do_nif(job, '999999990')
+
+
+def test_job_de_processo_terminado_fica_em_erro(executor):
+    caminho = _gravar(gerar_faturas_upload(n=2))
+    job_id = criar_job(caminho, 'faturas.txt', nif=NIF)
+
+    # O processo que tinha o job na fila reiniciou: deixa de haver batimento
+    redis_client.delete(_chave_batimento(jobs_ingestao._batimento['processo']))
+
+    job = obter_job(job_id)
+    assert job['estado'] == 'erro' and 'interrompida' in job['erro']
+    assert obter_job(job_id)['estado'] == 'erro'
+    assert not os.path.exists(caminho)
+    assert job_do_nif(job, NIF)
+
+
+def test_job_inexistente(executor):
+    assert obter_job('nao-existe') is None
+    assert not job_do_nif(None, NIF)
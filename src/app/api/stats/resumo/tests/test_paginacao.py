@@ -0,0 +1,54 @@
+# 🔹 Paginação por keyset (data, id) de iterar_lotes_faturas_periodo
+
+from fixtures import NIF, ONTEM, INICIO_ANTERIOR, INICIO_ATUAL, gerar_faturas
+from utils.utils import iterar_lotes_faturas_periodo
+
+
+def _ler(nif=NIF, data_ini=INICIO_ANTERIOR, data_fim=ONTEM, **kwargs):
+    return list(iterar_lotes_faturas_periodo(nif, data_ini, data_fim, **kwargs))
+
+
+def test_todas_as_faturas_uma_vez_por_ordem(supabase_falso):
+    # Os ids não crescem com a data e há muitas faturas na mesma data
+    faturas = gerar_faturas(n=50)
+    supabase_falso.faturas.extend(faturas)
+
+    lotes = _ler(tamanho_lote=7)
+
+    assert [len(lote) for lote in lotes] == [7] * 7 + [1]
+    lidas = [f for lote in lotes for f in lote]
+    assert [f['id'] for f in lidas] == [f['id'] for f in sorted(faturas, key=lambda f: (f['data'], f['id']))]
+    # A última página só termina o período depois de uma página vazia
+    assert supabase_falso.pedidos == len(lotes) + 1
+
+
+def test_max_rows_do_servidor_menor_que_o_lote(supabase_falso):
+    faturas = gerar_faturas(n=50)
+    supabase_falso.faturas.extend(faturas)
+    supabase_falso.max_linhas = 6
+
+    lidas = [f for lote in _ler(tamanho_lote=20) for f in lote]
+
+    assert sorted(f['id'] for f in lidas) == sorted(f['id'] for f in faturas)
+    assert len(lidas) == len({f['id'] for f in lidas})
+
+
+def test_intervalo_filial_e_depois_id(supabase_falso):
+    faturas = gerar_faturas(n=50)
+    supabase_falso.faturas.extend(faturas)
+    # Faturas de outro NIF nunca aparecem
+    supabase_falso.faturas.extend({**f, 'nif': '999999999'} for f in gerar_faturas(n=5, primeiro_id=1000))
+
+    lidas = [f for lote in _ler(data_ini=INICIO_ATUAL, filial=['1', '2'], depois_id=20, tamanho_lote=4) for f in lote]
+
+    esperadas = sorted(
+        (f for f in faturas
+         if f['data'] >= INICIO_ATUAL.isoformat() and f['filial'] in (1, 2) and f['id'] > 20),
+        key=lambda f: (f['data'], f['id'])
+    )
+    assert [f['id'] for f in lidas] == [f['id'] for f in esperadas]
+
+
+def test_sem_faturas(supabase_falso):
+    assert _ler() == []
+    assert supabase_falso.pedidos == 1
@@ -0,0 +1,42 @@
+# 🔹 Ranking top-K de produtos sobre a dimensão de produtos partilhada pelos dois períodos
+
+import pytest
+
+from utils.heatmap import ATUAL, ANTERIOR
+from utils.produtos import Dimensao, ProdutosPeriodos
+
+
+def _produtos():
+    produtos = ProdutosPeriodos()
+    produtos.adicionar(ATUAL, 'Pão', 10, 2.0, 2.0)
+    produtos.adicionar(ATUAL, 'Queijo', 0.5, 6.2, 6.2)
+    produtos.adicionar(ATUAL, 'Café', 3, 2.1, 2.0)
+    produtos.adicionar(ATUAL, 'Pão', 5, 1.0, 1.0)
+    produtos.adicionar(ANTERIOR, 'Bolo', 1, 1.5, 1.5)
+    return produtos
+
+
+def test_dimensao_partilhada():
+    produtos = _produtos()
+
+    # Um código por nome, o mesmo nos dois períodos
+    assert produtos.dimensao.valores == ['Pão', 'Queijo', 'Café', 'Bolo']
+    assert produtos.quantidade_produtos(ATUAL) == 3
+    assert produtos.quantidade_produtos(ANTERIOR) == 1
+    assert produtos.como_dict(ANTERIOR) == {'Bolo': {'quantidade': 1, 'montante': 1.5, 'faturamento': 1.5}}
+
+
+def test_top_e_ordenados():
+    produtos = _produtos()
+
+    assert [p['produto'] for p in produtos.top(ATUAL, 2)] == ['Queijo', 'Pão']
+    assert [p['produto'] for p in produtos.top(ATUAL, 1, 'quantidade')] == ['Pão']
+    assert [p['produto'] for p in produtos.ordenados(ATUAL)] == ['Queijo', 'Pão', 'Café']
+    assert produtos.top(ATUAL, 1)[0] == {'produto': 'Queijo', 'quantidade': 0.5, 'montante': 6.2, 'faturamento': 6.2}
+    assert produtos.totais(ATUAL) == pytest.approx((18.5, 11.3, 11.2))
+
+
+def test_produto_so_de_um_periodo_nao_aparece_no_outro():
+    produtos = ProdutosPeriodos(Dimensao())
+    produtos.adicionar(ANTERIOR, 'Bolo', 1, 1.5, 1.5)
+    assert produtos.top(ATUAL) == [] and produtos.ordenados(ATUAL) == []
@@ -0,0 +1,39 @@
+# 🔹 Rollup como fonte por omissão das rotas analíticas
+
+from fixtures import NIF, ONTEM, INICIO_ATUAL, INICIO_ANTERIOR, FIM_ANTERIOR, gerar_faturas
+from utils.agregacao import AgregadorFaturas, agregar_periodo
+from utils.rollup import FONTE_AGREGACAO, _chave_dias_construidos
+from utils.utils import redis_client
+
+PERIODOS = (INICIO_ATUAL, ONTEM, INICIO_ANTERIOR, FIM_ANTERIOR)
+
+
+def test_fonte_por_omissao_e_o_rollup():
+    assert FONTE_AGREGACAO == 'rollup'
+
+
+def test_periodo_fechado_servido_pelo_rollup(supabase_falso):
+    faturas = gerar_faturas()
+    supabase_falso.faturas.extend(faturas)
+    esperado = AgregadorFaturas(*PERIODOS).adicionar_lote(faturas).resultado()
+
+    # A primeira leitura constrói os dias em falta; as seguintes não voltam à base
+    primeiro = agregar_periodo(NIF, *PERIODOS)
+    pedidos = supabase_falso.pedidos
+    segundo = agregar_periodo(NIF, *PERIODOS)
+
+    assert supabase_falso.pedidos == pedidos
+    assert len(redis_client.smembers(_chave_dias_construidos(NIF))) == 14
+    for resultado in (primeiro, segundo):
+        assert resultado['stats_atual'][1:3] == esperado['stats_atual'][1:3]
+        assert round(resultado['stats_atual'][0], 6) == round(esperado['stats_atual'][0], 6)
+        assert round(resultado['stats_anterior'][0], 6) == round(esperado['stats_anterior'][0], 6)
+
+
+def test_manter_faturas_le_em_bruto(supabase_falso):
+    supabase_falso.faturas.extend(gerar_faturas(n=10))
+
+    resultado = agregar_periodo(NIF, *PERIODOS, manter_faturas=True)
+
+    assert len(resultado['faturas_atual']) + len(resultado['faturas_anterior']) == 10
+    assert not redis_client.smembers(_chave_dias_construidos(NIF))
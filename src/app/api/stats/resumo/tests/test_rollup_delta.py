@@ -0,0 +1,109 @@
+# 🔹 Deltas de upload no rollup: o resultado é sempre o de uma reconstrução a partir das faturas
+
+from datetime import date
+
+from fixtures import NIF, ONTEM, INICIO_ANTERIOR, gerar_faturas
+from utils import rollup
+from utils.rollup import (
+    aplicar_delta_rollup, calcular_celulas, construir_rollup, iniciar_insercao_rollup,
+    ler_rollup, terminar_insercao_rollup, _chave_dias_construidos
+)
+from utils.utils import redis_client
+
+
+def _normalizar(celulas):
+    """Células como dicionários simples, com floats arredondados, para comparar"""
+    return {
+        dia_iso: {
+            chave: {
+                'total': round(celula['total'], 6),
+                'recibos': celula['recibos'],
+                'itens': round(celula['itens'], 6),
+                'produtos': {
+                    nome: {campo: round(valor, 6) for campo, valor in produto.items()}
+                    for nome, produto in celula['produtos'].items()
+                }
+            }
+            for chave, celula in dia_celulas.items()
+        }
+        for dia_iso, dia_celulas in celulas.items() if dia_celulas
+    }
+
+
+def _construido(dia):
+    return bool(redis_client.sismember(_chave_dias_construidos(NIF), dia.isoformat()))
+
+
+def _carregar(supabase_falso, faturas):
+    """Grava faturas como a ingestão: marca os dias em curso, insere e aplica os deltas"""
+    iniciar_insercao_rollup(faturas)
+    try:
+        supabase_falso.faturas.extend(faturas)
+        for fatura in faturas:
+            aplicar_delta_rollup(NIF, fatura)
+    finally:
+        terminar_insercao_rollup(faturas)
+
+
+def test_delta_igual_a_reconstrucao(supabase_falso):
+    faturas = gerar_faturas()
+    supabase_falso.faturas.extend(faturas[:40])
+    construir_rollup(NIF, INICIO_ANTERIOR, ONTEM)
+    ler_rollup(NIF, INICIO_ANTERIOR, ONTEM)  # dias em memória, que os deltas têm de invalidar
+
+    _carregar(supabase_falso, faturas[40:])
+
+    esperado = _normalizar(calcular_celulas(NIF, INICIO_ANTERIOR, ONTEM))
+    assert _normalizar(ler_rollup(NIF, INICIO_ANTERIOR, ONTEM)) == esperado
+    assert _normalizar(ler_rollup(NIF, INICIO_ANTERIOR, ONTEM, filial='1')) == {
+        dia_iso: {chave: c for chave, c in dia.items() if chave[0] == '1'} for dia_iso, dia in esperado.items()
+        if any(chave[0] == '1' for chave in dia)
+    }
+
+
+def test_delta_em_dia_por_construir_e_ignorado(supabase_falso):
+    faturas = gerar_faturas(n=5)
+    _carregar(supabase_falso, faturas)
+
+    assert not redis_client.smembers(_chave_dias_construidos(NIF))
+    esperado = _normalizar(calcular_celulas(NIF, INICIO_ANTERIOR, ONTEM))
+    assert _normalizar(ler_rollup(NIF, INICIO_ANTERIOR, ONTEM)) == esperado
+
+
+def test_upload_durante_a_construcao_nao_se_perde(supabase_falso, monkeypatch):
+    faturas = gerar_faturas(n=10)
+    supabase_falso.faturas.extend(faturas[:9])
+    dia = date.fromisoformat(faturas[9]['data'])
+
+    # O upload termina depois de a construção ler as faturas e antes de gravar o dia
+    calcular = rollup.calcular_celulas
+    def calcular_e_carregar(*args, **kwargs):
+        celulas = calcular(*args, **kwargs)
+        _carregar(supabase_falso, faturas[9:])
+        return celulas
+    monkeypatch.setattr(rollup, 'calcular_celulas', calcular_e_carregar)
+    construir_rollup(NIF, INICIO_ANTERIOR, ONTEM)
+    monkeypatch.setattr(rollup, 'calcular_celulas', calcular)
+
+    assert not _construido(dia)
+    assert _construido(ONTEM)
+    esperado = _normalizar(calcular_celulas(NIF, INICIO_ANTERIOR, ONTEM))
+    assert _normalizar(ler_rollup(NIF, INICIO_ANTERIOR, ONTEM)) == esperado
+    assert _construido(dia)
+
+
+def test_construcao_com_insercao_em_curso_nao_conta_a_dobrar(supabase_falso):
+    faturas = gerar_faturas(n=10)
+    supabase_falso.faturas.extend(faturas[:9])
+    dia = date.fromisoformat(faturas[9]['data'])
+
+    # Fatura já gravada quando a construção lê, mas com o delta ainda por aplicar
+    iniciar_insercao_rollup(faturas[9:])
+    supabase_falso.faturas.extend(faturas[9:])
+    construir_rollup(NIF, INICIO_ANTERIOR, ONTEM)
+    assert not _construido(dia)
+    aplicar_delta_rollup(NIF, faturas[9])
+    terminar_insercao_rollup(faturas[9:])
+
+    esperado = _normalizar(calcular_celulas(NIF, INICIO_ANTERIOR, ONTEM))
+    assert _normalizar(ler_rollup(NIF, INICIO_ANTERIOR, ONTEM)) == esperado
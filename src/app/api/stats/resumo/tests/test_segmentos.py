@@ -0,0 +1,65 @@
+# 🔹 Cache de segmentos: dias fechados lidos uma vez e reutilizados entre períodos
+
+from datetime import timedelta
+
+from fixtures import NIF, ONTEM, INICIO_ANTERIOR, INICIO_ATUAL, gerar_faturas
+from utils import segmentos
+from utils.segmentos import CacheSegmentos, invalidar_segmentos, iterar_lotes_faturas_cache
+
+
+def _ids(nif=NIF, data_ini=INICIO_ANTERIOR, data_fim=ONTEM, filial=None):
+    return sorted(f['id'] for lote in iterar_lotes_faturas_cache(nif, data_ini, data_fim, filial=filial) for f in lote)
+
+
+def _esperados(faturas, data_ini=INICIO_ANTERIOR, data_fim=ONTEM, filial=None):
+    return sorted(
+        f['id'] for f in faturas
+        if data_ini.isoformat() <= f['data'] <= data_fim.isoformat() and (not filial or str(f['filial']) == filial)
+    )
+
+
+def test_subintervalos_servidos_da_memoria(supabase_falso):
+    faturas = gerar_faturas()
+    supabase_falso.faturas.extend(faturas)
+
+    assert _ids(data_ini=INICIO_ATUAL) == _esperados(faturas, data_ini=INICIO_ATUAL)
+    pedidos = supabase_falso.pedidos
+
+    # A semana anterior está em falta: é lida num só intervalo; a atual vem da memória
+    assert _ids() == _esperados(faturas)
+    assert supabase_falso.pedidos == pedidos + 2
+    pedidos = supabase_falso.pedidos
+
+    assert _ids(data_ini=INICIO_ATUAL + timedelta(days=2), data_fim=ONTEM - timedelta(days=1)) == \
+        _esperados(faturas, INICIO_ATUAL + timedelta(days=2), ONTEM - timedelta(days=1))
+    # Uma filial sai do segmento de todas as filiais, com a filial numérica comparada como texto
+    assert _ids(filial='1') == _esperados(faturas, filial='1')
+    assert supabase_falso.pedidos == pedidos
+
+
+def test_upload_invalida_os_segmentos(supabase_falso, monkeypatch):
+    faturas = gerar_faturas(n=20)
+    supabase_falso.faturas.extend(faturas)
+    _ids()
+
+    novas = gerar_faturas(n=3, primeiro_id=100)
+    supabase_falso.faturas.extend(novas)
+    # Outro worker gravou as faturas: só a versão no Redis muda, a memória deste processo não
+    monkeypatch.setattr(segmentos.cache_segmentos, 'remover_nif', lambda nif: None)
+    invalidar_segmentos([NIF])
+
+    assert _ids() == _esperados(faturas + novas)
+
+
+def test_despejo_lru_por_memoria():
+    cache = CacheSegmentos(max_bytes=2 * segmentos.BYTES_POR_FATURA)
+    fatura = {'id': 1, 'faturas_itemfatura': []}
+    for dia in ('2024-01-01', '2024-01-02', '2024-01-03'):
+        if dia == '2024-01-03':
+            cache.obter(NIF, None, '2024-01-01', 0)  # o mais antigo passa a recente
+        cache.guardar(NIF, None, dia, 0, [fatura])
+
+    assert cache.obter(NIF, None, '2024-01-02', 0) is None
+    assert cache.obter(NIF, None, '2024-01-01', 0) == [fatura]
+    assert cache.obter(NIF, None, '2024-01-03', 1) is None  # versão antiga
+    assert cache.bytes == segmentos.BYTES_POR_FATURA
@@ -0,0 +1,87 @@
+# 🔹 Single-flight nos misses: pedidos simultâneos à mesma chave partilham um cálculo
+
+import threading
+import time
+
+import pytest
+
+from fixtures import NIF
+from utils.utils import redis_client
+
+pytest.importorskip('flask')
+from utils import cache_rotas  # noqa: E402
+
+URL = f'/resumo?nif={NIF}&periodo=2'
+PEDIDOS = 5
+
+
+def _em_paralelo(app_cache, n=PEDIDOS):
+    """n pedidos simultâneos (um cliente por thread); retorna (status, corpo) de cada um"""
+    respostas = []
+
+    def pedir():
+        resposta = app_cache.flask.test_client().get(URL)
+        respostas.append((resposta.status_code, resposta.data))
+
+    threads = [threading.Thread(target=pedir) for _ in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    return respostas
+
+
+def _lento(status=200):
+    """Corpo que demora o suficiente para os outros pedidos chegarem durante o cálculo"""
+    def corpo():
+        time.sleep(0.2)
+        return 'calculado', status
+    return corpo
+
+
+def test_um_calculo_para_pedidos_simultaneos(app_cache):
+    chamadas = app_cache.rota('/resumo', 'resumo', corpo=_lento())
+
+    respostas = _em_paralelo(app_cache)
+
+    assert respostas == [(200, b'calculado')] * PEDIDOS
+    assert len(chamadas) == 1
+    estatisticas = app_cache.rotas.estatisticas()['resumo']
+    assert (estatisticas['misses'], estatisticas['coalescidos']) == (PEDIDOS, PEDIDOS - 1)
+    assert not app_cache.rotas._em_voo
+
+
+def test_falha_do_lider_cada_um_calcula(app_cache):
+    chamadas = app_cache.rota('/resumo', 'resumo', corpo=_lento(status=500))
+
+    respostas = _em_paralelo(app_cache)
+
+    assert [status for status, _ in respostas] == [500] * PEDIDOS
+    assert len(chamadas) == PEDIDOS
+
+
+def test_espera_pela_resposta_de_outro_worker(app_cache):
+    chamadas = app_cache.rota('/resumo', 'resumo')
+    chave = app_cache.rotas.chave('resumo', {'nif': NIF, 'periodo': '2'})
+    redis_client.set(f'calcular:{chave}', 'outro', px=60000)
+
+    def outro_worker():
+        time.sleep(0.2)
+        app_cache.cache.set(chave, (b'do outro', 200, 'text/html', time.time() + 60), timeout=60)
+        redis_client.delete(f'calcular:{chave}')
+    threading.Thread(target=outro_worker).start()
+
+    assert app_cache.get(URL).data == b'do outro'
+    assert chamadas == []
+    assert app_cache.rotas.estatisticas()['resumo']['coalescidos'] == 1
+
+
+def test_lock_de_outro_worker_sem_resposta(app_cache, monkeypatch):
+    monkeypatch.setattr(cache_rotas, 'LEASE_CALCULO_MS', 300)
+    chamadas = app_cache.rota('/resumo', 'resumo')
+    chave = app_cache.rotas.chave('resumo', {'nif': NIF, 'periodo': '2'})
+    # O outro worker morreu com o lock: ao fim do lease este pedido calcula por si
+    redis_client.set(f'calcular:{chave}', 'outro', px=60000)
+
+    assert app_cache.get(URL).data == b'ok'
+    assert len(chamadas) == 1
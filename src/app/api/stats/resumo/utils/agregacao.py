@@ -0,0 +1,352 @@
+# 🔹 Agregação de faturas numa única passagem
+
+import os
+from collections import defaultdict
+from datetime import date, timedelta
+
+from .utils import gerar_comparativo_por_hora, iterar_lotes_faturas_periodo, CAMPOS_FATURA_GRUPO
+from .rollup import FONTE_AGREGACAO, HORA_DESCONHECIDA, filial_da_fatura, hora_da_fatura, ler_rollup
+from .segmentos import iterar_lotes_faturas_cache
+from .hoje import celulas_hoje
+from .heatmap import HeatmapPeriodos, ATUAL, ANTERIOR
+from .produtos import ProdutosPeriodos
+
+# Backend de agregação por deployment: 'python' (dicionários) ou 'numpy' (colunar, requer NumPy)
+BACKEND_AGREGACAO = os.getenv('BACKEND_AGREGACAO', 'python')
+
+# Fontes que entregam células já agregadas em vez de faturas em bruto
+FONTES_CELULAS = ('rollup', 'rpc')
+
+
+def _sem_hoje(data_ini, data_fim):
+    """Intervalos (antes e depois de hoje) que cobrem o período sem o dia de hoje"""
+    hoje = date.today()
+    if not data_ini <= hoje <= data_fim:
+        return [(data_ini, data_fim)]
+    intervalos = [(data_ini, hoje - timedelta(days=1)), (hoje + timedelta(days=1), data_fim)]
+    return [(inicio, fim) for inicio, fim in intervalos if inicio <= fim]
+
+
+def _celulas_de_hoje(nif, data_ini, data_fim, filial=None):
+    """Células de hoje do acumulado incremental, se hoje estiver no período"""
+    hoje = date.today()
+    if not data_ini <= hoje <= data_fim:
+        return {}
+    return {hoje.isoformat(): celulas_hoje(nif, filial=filial)}
+
+
+def _cortes(agregadores):
+    """Datas em que começa ou acaba (dia seguinte) um período de algum dos agregadores"""
+    cortes = set()
+    for agregador in agregadores:
+        for inicio, fim in ((agregador.data_inicio, agregador.data_fim),
+                            (agregador.data_inicio_anterior, agregador.data_fim_anterior)):
+            if inicio and fim:
+                cortes.update((inicio, fim + timedelta(days=1)))
+    return sorted(cortes)
+
+
+def ler_celulas(nif, data_ini, data_fim, filial=None, cortes=()):
+    """
+    Células {dia_iso: {(filial, hora): celula}} da fonte configurada (rollup ou rpc).
+    Hoje vem sempre do acumulado incremental (celulas_hoje).
+    cortes: limites dos períodos (ver _cortes); o rpc só separa os produtos nessas datas.
+    """
+    if FONTE_AGREGACAO == 'rpc':
+        from .agregacao_rpc import ler_celulas_rpc
+        celulas = {}
+        for inicio, fim in _sem_hoje(data_ini, data_fim):
+            celulas.update(ler_celulas_rpc(nif, inicio, fim, filial=filial, cortes=cortes))
+        celulas.update(_celulas_de_hoje(nif, data_ini, data_fim, filial=filial))
+        return celulas
+    return ler_rollup(nif, data_ini, data_fim, filial=filial)
+
+
+def _acumular(agregadores, nif, data_ini, data_fim, filial=None, manter_faturas=False):
+    """
+    Lê o intervalo uma vez da fonte configurada e acumula-o em todos os agregadores.
+    Com faturas em bruto, hoje vem na mesma do acumulado incremental, exceto com
+    manter_faturas, que precisa das faturas de hoje.
+    """
+    if FONTE_AGREGACAO in FONTES_CELULAS and not manter_faturas:
+        celulas = ler_celulas(nif, data_ini, data_fim, filial=filial, cortes=_cortes(agregadores))
+        for agregador in agregadores:
+            agregador.adicionar_celulas(celulas)
+        return
+
+    intervalos = [(data_ini, data_fim)] if manter_faturas else _sem_hoje(data_ini, data_fim)
+    for inicio, fim in intervalos:
+        for lote in iterar_lotes_faturas_cache(nif, inicio, fim, filial=filial):
+            for agregador in agregadores:
+                agregador.adicionar_lote(lote)
+
+    if not manter_faturas:
+        celulas = _celulas_de_hoje(nif, data_ini, data_fim, filial=filial)
+        for agregador in agregadores:
+            agregador.adicionar_celulas(celulas)
+
+
+def _novo_acumulado(indice):
+    return {
+        'indice': indice,
+        'total': 0.0,
+        'recibos': 0,
+        'itens': 0,
+        'vendas_por_hora': [0.0] * 24,
+        'recibos_por_hora': [0] * 24,
+        'filiais': defaultdict(lambda: {'volume': 0.0, 'recibos': 0, 'itens': 0, 'vendas_por_hora': [0.0] * 24}),
+        'vendas_por_dia': defaultdict(float),
+        'faturas': []
+    }
+
+
+class AgregadorFaturas:
+    """
+    Agrega faturas dos períodos atual e anterior numa única passagem.
+    OTIMIZAÇÃO: Cada fatura é lida uma só vez e cada data é convertida uma só vez
+    por dia distinto; estatísticas, vendas por hora, heatmap 24x7, produtos e
+    métricas por filial (incluindo a curva horária) são preenchidos em conjunto. Aceita lotes de faturas em bruto ou
+    células (rollup ou RPC), e ambos produzem o mesmo resultado.
+    """
+
+    def __init__(self, data_inicio, data_fim, data_inicio_anterior=None, data_fim_anterior=None, manter_faturas=False):
+        self.data_inicio = data_inicio
+        self.data_fim = data_fim
+        self.data_inicio_anterior = data_inicio_anterior
+        self.data_fim_anterior = data_fim_anterior
+        self.manter_faturas = manter_faturas
+
+        self.atual = _novo_acumulado(ATUAL)
+        self.anterior = _novo_acumulado(ANTERIOR)
+        self.heatmap = HeatmapPeriodos()
+        self.produtos = ProdutosPeriodos()
+        self._dias = {}
+
+    def _classificar(self, dia_iso):
+        """Retorna (acumulado do período, dia da semana) de uma data, ou (None, None) fora dos períodos"""
+        classificacao = self._dias.get(dia_iso)
+        if classificacao is None:
+            try:
+                dia = date.fromisoformat(dia_iso) if isinstance(dia_iso, str) else dia_iso
+            except ValueError:
+                dia = None
+
+            if dia is None:
+                classificacao = (None, None)
+            elif self.data_inicio <= dia <= self.data_fim:
+                classificacao = (self.atual, dia.weekday())
+            elif self.data_inicio_anterior and self.data_inicio_anterior <= dia <= self.data_fim_anterior:
+                classificacao = (self.anterior, dia.weekday())
+            else:
+                classificacao = (None, None)
+            self._dias[dia_iso] = classificacao
+        return classificacao
+
+    def _somar(self, periodo, dia_iso, dia_semana, filial, hora, total, recibos, itens):
+        periodo['total'] += total
+        periodo['recibos'] += recibos
+        periodo['itens'] += itens
+        periodo['vendas_por_dia'][dia_iso] += total
+
+        dados_filial = periodo['filiais'][filial]
+        dados_filial['volume'] += total
+        dados_filial['recibos'] += recibos
+        dados_filial['itens'] += itens
+
+        if hora == HORA_DESCONHECIDA:
+            return
+        periodo['vendas_por_hora'][hora] += total
+        dados_filial['vendas_por_hora'][hora] += total
+        periodo['recibos_por_hora'][hora] += recibos
+        self.heatmap.adicionar(periodo['indice'], hora, dia_semana, total, recibos)
+
+    def adicionar_lote(self, faturas):
+        """Acumula um lote de faturas em bruto (com itens em 'faturas_itemfatura')"""
+        for fatura in faturas:
+            dia_iso = fatura.get('data')
+            if not dia_iso:
+                continue
+            periodo, dia_semana = self._classificar(dia_iso)
+            if periodo is None:
+                continue
+
+            itens = 0
+            for item in (fatura.get('faturas_itemfatura') or []):
+                quantidade = item.get('quantidade', 0)
+                self.produtos.adicionar(
+                    periodo['indice'], item.get('nome') or 'Produto Desconhecido', quantidade,
+                    quantidade * float(item.get('preco_unitario', 0.0)), float(item.get('total', 0))
+                )
+                itens += quantidade
+
+            self._somar(
+                periodo, dia_iso, dia_semana, filial_da_fatura(fatura) or 'Sem Filial',
+                hora_da_fatura(fatura), float(fatura.get('total', 0)), 1, itens
+            )
+
+            if self.manter_faturas:
+                periodo['faturas'].append(fatura)
+        return self
+
+    def adicionar_celulas(self, celulas):
+        """Acumula células do rollup {dia_iso: {(filial, hora): celula}}"""
+        for dia_iso, dia_celulas in celulas.items():
+            periodo, dia_semana = self._classificar(dia_iso)
+            if periodo is None:
+                continue
+
+            for (filial, hora), celula in dia_celulas.items():
+                for nome, produto in celula['produtos'].items():
+                    self.produtos.adicionar(
+                        periodo['indice'], nome, produto['quantidade'], produto['montante'], produto['faturamento']
+                    )
+
+                # Células só com produtos (RPC) não têm vendas nesse dia e filial
+                if not celula['recibos']:
+                    continue
+                self._somar(
+                    periodo, dia_iso, dia_semana, filial or 'Sem Filial',
+                    hora, celula['total'], celula['recibos'], celula['itens']
+                )
+        return self
+
+    @staticmethod
+    def _stats(periodo):
+        ticket = round(periodo['total'] / periodo['recibos'], 2) if periodo['recibos'] else 0.0
+        return (periodo['total'], periodo['recibos'], periodo['itens'], ticket)
+
+    @staticmethod
+    def _vendas_por_hora(periodo):
+        # Só as horas com faturas, como o antigo agrupamento por dicionário
+        return {
+            hora: periodo['vendas_por_hora'][hora]
+            for hora in range(24) if periodo['recibos_por_hora'][hora]
+        }
+
+    def _acumulados(self):
+        """Acumulados (atual, anterior) no formato de _novo_acumulado"""
+        return self.atual, self.anterior
+
+    def _heatmap(self):
+        return self.heatmap
+
+    def _produtos(self):
+        return self.produtos
+
+    def resultado(self):
+        """
+        Resultado único consumido por todas as rotas.
+        Mantém as chaves de processar_faturas_otimizado e acrescenta o heatmap
+        (HeatmapPeriodos), os produtos (ProdutosPeriodos), filiais e vendas por
+        dia de ambos os períodos.
+        """
+        atual, anterior = self._acumulados()
+        vendas_por_hora_atual = self._vendas_por_hora(atual)
+        vendas_por_hora_anterior = self._vendas_por_hora(anterior)
+
+        return {
+            'stats_atual': self._stats(atual),
+            'stats_anterior': self._stats(anterior),
+            'vendas_por_hora_atual': vendas_por_hora_atual,
+            'vendas_por_hora_anterior': vendas_por_hora_anterior,
+            'comparativo_por_hora': gerar_comparativo_por_hora(vendas_por_hora_atual, vendas_por_hora_anterior),
+            'heatmap': self._heatmap(),
+            'produtos': self._produtos(),
+            'filiais_atual': dict(atual['filiais']),
+            'filiais_anterior': dict(anterior['filiais']),
+            'vendas_por_dia_atual': dict(atual['vendas_por_dia']),
+            'vendas_por_dia_anterior': dict(anterior['vendas_por_dia']),
+            'faturas_atual': atual['faturas'],
+            'faturas_anterior': anterior['faturas']
+        }
+
+
+def criar_agregador(data_inicio, data_fim, data_inicio_anterior=None, data_fim_anterior=None, manter_faturas=False):
+    """Cria o agregador do backend configurado (BACKEND_AGREGACAO), com fallback para Python"""
+    if BACKEND_AGREGACAO == 'numpy':
+        from .agregacao_numpy import AgregadorFaturasNumpy, numpy_disponivel
+        if numpy_disponivel():
+            return AgregadorFaturasNumpy(data_inicio, data_fim, data_inicio_anterior, data_fim_anterior, manter_faturas=manter_faturas)
+        print("BACKEND_AGREGACAO=numpy mas NumPy não está instalado; a usar o backend Python")
+    return AgregadorFaturas(data_inicio, data_fim, data_inicio_anterior, data_fim_anterior, manter_faturas=manter_faturas)
+
+
+def agregar_periodo(nif, data_inicio, data_fim, data_inicio_anterior=None, data_fim_anterior=None, filial=None,
+                    manter_faturas=False):
+    """
+    Agrega os períodos atual e anterior de um NIF a partir da fonte configurada
+    (rollup, RPC na base de dados ou faturas em bruto, ver FONTE_AGREGACAO).
+    Com manter_faturas as faturas de cada período também são devolvidas, e por isso
+    a leitura é sempre feita sobre as faturas em bruto.
+    Retorna o resultado de AgregadorFaturas.
+    """
+    agregador = criar_agregador(data_inicio, data_fim, data_inicio_anterior, data_fim_anterior, manter_faturas=manter_faturas)
+
+    data_mais_antiga = min(data_inicio, data_inicio_anterior or data_inicio)
+    data_mais_recente = max(data_fim, data_fim_anterior or data_fim)
+
+    _acumular([agregador], nif, data_mais_antiga, data_mais_recente, filial=filial, manter_faturas=manter_faturas)
+    return agregador.resultado()
+
+
+def agregar_periodos(nif, periodos, filial=None):
+    """
+    Agrega vários períodos de um NIF com uma única leitura.
+    periodos: {chave: (data_inicio, data_fim, data_inicio_anterior, data_fim_anterior)}
+    OTIMIZAÇÃO: O intervalo que cobre todos os períodos é lido uma só vez (células
+    do rollup/RPC ou faturas em bruto) e cada lote é distribuído pelos agregadores de cada período.
+    Retorna {chave: resultado de AgregadorFaturas}.
+    """
+    if not periodos:
+        return {}
+
+    agregadores = {chave: criar_agregador(*datas) for chave, datas in periodos.items()}
+
+    datas = [d for datas_periodo in periodos.values() for d in datas_periodo if d]
+    data_mais_antiga, data_mais_recente = min(datas), max(datas)
+
+    _acumular(list(agregadores.values()), nif, data_mais_antiga, data_mais_recente, filial=filial)
+    return {chave: agregador.resultado() for chave, agregador in agregadores.items()}
+
+
+def agregar_grupo(nifs, data_inicio, data_fim, data_inicio_anterior=None, data_fim_anterior=None, filiais=None):
+    """
+    Agrega um grupo de NIFs (opcionalmente só algumas filiais) por NIF e no total.
+    OTIMIZAÇÃO: Com faturas em bruto, todos os NIFs e filiais são lidos numa única
+    consulta paginada com filtros in; cada lote é repartido por NIF e também somado
+    ao total na mesma passagem. Com rollup ou rpc, as células de cada NIF vêm
+    da fonte configurada.
+    Retorna (resultado total, {nif: resultado}).
+    """
+    datas = (data_inicio, data_fim, data_inicio_anterior, data_fim_anterior)
+    total = criar_agregador(*datas)
+    por_nif = {nif: criar_agregador(*datas) for nif in nifs}
+
+    data_mais_antiga = min(data_inicio, data_inicio_anterior or data_inicio)
+    data_mais_recente = max(data_fim, data_fim_anterior or data_fim)
+    filiais = [str(f) for f in filiais] if filiais else None
+
+    if FONTE_AGREGACAO in FONTES_CELULAS:
+        for nif, agregador in por_nif.items():
+            celulas = ler_celulas(nif, data_mais_antiga, data_mais_recente, cortes=_cortes([total]))
+            if filiais:
+                celulas = {
+                    dia_iso: {chave: celula for chave, celula in dia_celulas.items() if chave[0] in filiais}
+                    for dia_iso, dia_celulas in celulas.items()
+                }
+            agregador.adicionar_celulas(celulas)
+            total.adicionar_celulas(celulas)
+    else:
+        lotes = iterar_lotes_faturas_periodo(
+            list(nifs), data_mais_antiga, data_mais_recente, filial=filiais, campos=CAMPOS_FATURA_GRUPO
+        )
+        for lote in lotes:
+            por_lote = defaultdict(list)
+            for fatura in lote:
+                por_lote[str(fatura.get('nif'))].append(fatura)
+            for nif, faturas in por_lote.items():
+                if nif in por_nif:
+                    por_nif[nif].adicionar_lote(faturas)
+            total.adicionar_lote(lote)
+
+    return total.resultado(), {nif: agregador.resultado() for nif, agregador in por_nif.items()}
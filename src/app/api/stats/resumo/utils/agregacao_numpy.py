@@ -0,0 +1,286 @@
+# 🔹 Backend colunar (NumPy) da agregação de faturas
+
+try:
+    import numpy as np
+except ImportError:  # NumPy é opcional: sem ele usa-se sempre o backend Python
+    np = None
+
+from .agregacao import AgregadorFaturas
+from .heatmap import HeatmapPeriodos, ATUAL
+from .produtos import Dimensao, RankingProdutos
+from .rollup import HORA_DESCONHECIDA, filial_da_fatura, hora_da_fatura, normalizar_numero
+
+
+def numpy_disponivel():
+    return np is not None
+
+
+def _cents(valor):
+    return int(round(float(valor) * 100))
+
+
+class ProdutosPeriodosNumpy(RankingProdutos):
+    """
+    Mesmo ranking que ProdutosPeriodos, lido diretamente das matrizes (2, n)
+    do backend colunar (só de leitura); o top-K usa np.argpartition em vez de um heap.
+    """
+
+    def __init__(self, dimensao, linhas, quantidade, montante, faturamento):
+        super().__init__(dimensao)
+        self.linhas = linhas
+        self.quantidade = quantidade
+        self.montante = montante
+        self.faturamento = faturamento
+
+    def _codigos(self, periodo):
+        return np.flatnonzero(self.linhas[periodo])
+
+    def _produto(self, periodo, codigo):
+        return {
+            "produto": self.dimensao.valores[codigo],
+            "quantidade": normalizar_numero(self.quantidade[periodo][codigo]),
+            "montante": float(self.montante[periodo][codigo]),
+            "faturamento": float(self.faturamento[periodo][codigo])
+        }
+
+    def totais(self, periodo=ATUAL):
+        return (
+            normalizar_numero(self.quantidade[periodo].sum()),
+            float(self.montante[periodo].sum()),
+            float(self.faturamento[periodo].sum())
+        )
+
+    def _top_codigos(self, periodo, n, chave):
+        codigos = self._codigos(periodo)
+        if n <= 0:
+            return []
+        valores = -self._vetor(chave, periodo)[codigos]
+        if n < len(codigos):
+            selecionados = np.argpartition(valores, n - 1)[:n]
+        else:
+            selecionados = np.arange(len(codigos))
+        return codigos[selecionados[np.argsort(valores[selecionados], kind='stable')]].tolist()
+
+    def ordenados(self, periodo=ATUAL, chave="montante"):
+        codigos = self._codigos(periodo)
+        ordem = np.argsort(-self._vetor(chave, periodo)[codigos], kind='stable')
+        return [self._produto(periodo, codigo) for codigo in codigos[ordem].tolist()]
+
+    def como_dict(self, periodo=ATUAL):
+        resultado = {}
+        for codigo in self._codigos(periodo).tolist():
+            produto = self._produto(periodo, codigo)
+            resultado[produto.pop("produto")] = produto
+        return resultado
+
+
+class AgregadorFaturasNumpy(AgregadorFaturas):
+    """
+    Mesma interface e mesmo resultado que AgregadorFaturas, mas com os dados de
+    cada lote convertidos em colunas tipadas (período, hora, dia da semana, dia,
+    filial, total em cêntimos, código de produto).
+    OTIMIZAÇÃO: Horas, heatmap, dias, filiais e produtos são somados com
+    np.bincount sobre índices planos (período × dimensão), sem dicionários por fatura.
+    """
+
+    def __init__(self, data_inicio, data_fim, data_inicio_anterior=None, data_fim_anterior=None, manter_faturas=False):
+        if np is None:
+            raise RuntimeError('NumPy não está instalado: use BACKEND_AGREGACAO=python')
+        super().__init__(data_inicio, data_fim, data_inicio_anterior, data_fim_anterior, manter_faturas=manter_faturas)
+
+        # Linhas: 0 = atual, 1 = anterior
+        self._total = np.zeros(2)
+        self._recibos = np.zeros(2)
+        self._itens = np.zeros(2)
+        self._horas_volume = np.zeros(2 * 24)
+        self._horas_recibos = np.zeros(2 * 24)
+        self._heatmap_volume = np.zeros(2 * 24 * 7)
+        self._heatmap_recibos = np.zeros(2 * 24 * 7)
+
+        self._dim_dias = Dimensao()
+        self._dim_filiais = Dimensao()
+        self._dim_produtos = Dimensao()
+        # Matrizes (2, n) que crescem com as dimensões
+        self._por_dimensao = {}
+
+    def _indice_periodo(self, periodo):
+        return periodo['indice']
+
+    def _somar_dimensao(self, nome, tamanho, periodos, codigos, pesos):
+        """Soma pesos em self._por_dimensao[nome][periodo, codigo] com um único bincount"""
+        matriz = self._por_dimensao.get(nome)
+        if matriz is None:
+            matriz = np.zeros((2, tamanho))
+        elif matriz.shape[1] < tamanho:
+            matriz = np.pad(matriz, ((0, 0), (0, tamanho - matriz.shape[1])))
+        matriz += np.bincount(periodos * tamanho + codigos, weights=pesos, minlength=2 * tamanho).reshape(2, tamanho)
+        self._por_dimensao[nome] = matriz
+
+    def _acumular_linhas(self, periodos, horas, semanas, dias, filiais, totais, recibos, itens):
+        if not periodos:
+            return
+        p = np.asarray(periodos, dtype=np.int64)
+        h = np.asarray(horas, dtype=np.int64)
+        w = np.asarray(semanas, dtype=np.int64)
+        d = np.asarray(dias, dtype=np.int64)
+        f = np.asarray(filiais, dtype=np.int64)
+        t = np.asarray(totais, dtype=np.float64)
+        r = np.asarray(recibos, dtype=np.float64)
+        i = np.asarray(itens, dtype=np.float64)
+
+        self._total += np.bincount(p, weights=t, minlength=2)
+        self._recibos += np.bincount(p, weights=r, minlength=2)
+        self._itens += np.bincount(p, weights=i, minlength=2)
+
+        com_hora = h != HORA_DESCONHECIDA
+        ph, hh, wh = p[com_hora], h[com_hora], w[com_hora]
+        indice_hora = ph * 24 + hh
+        self._horas_volume += np.bincount(indice_hora, weights=t[com_hora], minlength=2 * 24)
+        self._horas_recibos += np.bincount(indice_hora, weights=r[com_hora], minlength=2 * 24)
+        indice_heatmap = ph * 168 + hh * 7 + wh
+        self._heatmap_volume += np.bincount(indice_heatmap, weights=t[com_hora], minlength=2 * 168)
+        self._heatmap_recibos += np.bincount(indice_heatmap, weights=r[com_hora], minlength=2 * 168)
+
+        n_dias, n_filiais = len(self._dim_dias), len(self._dim_filiais)
+        self._somar_dimensao('dias_volume', n_dias, p, d, t)
+        self._somar_dimensao('dias_recibos', n_dias, p, d, r)
+        self._somar_dimensao('filiais_volume', n_filiais, p, f, t)
+        self._somar_dimensao('filiais_recibos', n_filiais, p, f, r)
+        self._somar_dimensao('filiais_itens', n_filiais, p, f, i)
+        # Curva horária por filial: índice filial * 24 + hora
+        self._somar_dimensao('filiais_horas', n_filiais * 24, ph, f[com_hora] * 24 + hh, t[com_hora])
+
+    def _acumular_produtos(self, periodos, codigos, quantidades, montantes, faturamentos):
+        if not periodos:
+            return
+        p = np.asarray(periodos, dtype=np.int64)
+        c = np.asarray(codigos, dtype=np.int64)
+        n = len(self._dim_produtos)
+        self._somar_dimensao('produtos_linhas', n, p, c, np.ones(len(p)))
+        self._somar_dimensao('produtos_quantidade', n, p, c, np.asarray(quantidades, dtype=np.float64))
+        self._somar_dimensao('produtos_montante', n, p, c, np.asarray(montantes, dtype=np.float64))
+        self._somar_dimensao('produtos_faturamento', n, p, c, np.asarray(faturamentos, dtype=np.float64))
+
+    def adicionar_lote(self, faturas):
+        linhas = ([], [], [], [], [], [], [], [])
+        produtos = ([], [], [], [], [])
+
+        for fatura in faturas:
+            dia_iso = fatura.get('data')
+            if not dia_iso:
+                continue
+            periodo, dia_semana = self._classificar(dia_iso)
+            if periodo is None:
+                continue
+            p = self._indice_periodo(periodo)
+
+            itens = 0
+            for item in (fatura.get('faturas_itemfatura') or []):
+                quantidade = item.get('quantidade', 0)
+                produtos[0].append(p)
+                produtos[1].append(self._dim_produtos.codigo(item.get('nome') or 'Produto Desconhecido'))
+                produtos[2].append(quantidade)
+                produtos[3].append(_cents(quantidade * float(item.get('preco_unitario', 0.0))))
+                produtos[4].append(_cents(item.get('total', 0)))
+                itens += quantidade
+
+            for coluna, valor in zip(linhas, (
+                p, hora_da_fatura(fatura), dia_semana, self._dim_dias.codigo(dia_iso),
+                self._dim_filiais.codigo(filial_da_fatura(fatura) or 'Sem Filial'),
+                _cents(fatura.get('total', 0)), 1, itens
+            )):
+                coluna.append(valor)
+
+            if self.manter_faturas:
+                periodo['faturas'].append(fatura)
+
+        self._acumular_linhas(*linhas)
+        self._acumular_produtos(*produtos)
+        return self
+
+    def adicionar_celulas(self, celulas):
+        linhas = ([], [], [], [], [], [], [], [])
+        produtos = ([], [], [], [], [])
+
+        for dia_iso, dia_celulas in celulas.items():
+            periodo, dia_semana = self._classificar(dia_iso)
+            if periodo is None:
+                continue
+            p = self._indice_periodo(periodo)
+            codigo_dia = self._dim_dias.codigo(dia_iso)
+
+            for (filial, hora), celula in dia_celulas.items():
+                for nome, produto in celula['produtos'].items():
+                    produtos[0].append(p)
+                    produtos[1].append(self._dim_produtos.codigo(nome))
+                    produtos[2].append(produto['quantidade'])
+                    produtos[3].append(_cents(produto['montante']))
+                    produtos[4].append(_cents(produto['faturamento']))
+
+                for coluna, valor in zip(linhas, (
+                    p, hora, dia_semana, codigo_dia, self._dim_filiais.codigo(filial or 'Sem Filial'),
+                    _cents(celula['total']), celula['recibos'], celula['itens']
+                )):
+                    coluna.append(valor)
+
+        self._acumular_linhas(*linhas)
+        self._acumular_produtos(*produtos)
+        return self
+
+    def _linha(self, nome, p):
+        matriz = self._por_dimensao.get(nome)
+        return matriz[p] if matriz is not None else np.zeros(0)
+
+    def _acumulado(self, p):
+        """Converte as colunas do período p para o formato do acumulado Python"""
+        acumulado = {
+            'indice': p,
+            'total': float(self._total[p]) / 100,
+            'recibos': int(self._recibos[p]),
+            'itens': normalizar_numero(self._itens[p]),
+            'vendas_por_hora': (self._horas_volume[p * 24:(p + 1) * 24] / 100).tolist(),
+            'recibos_por_hora': self._horas_recibos[p * 24:(p + 1) * 24].astype(int).tolist(),
+            'faturas': (self.atual if p == 0 else self.anterior)['faturas']
+        }
+
+        dias_recibos = self._linha('dias_recibos', p)
+        dias_volume = self._linha('dias_volume', p)
+        acumulado['vendas_por_dia'] = {
+            self._dim_dias.valores[c]: float(dias_volume[c]) / 100 for c in np.flatnonzero(dias_recibos)
+        }
+
+        filiais_recibos = self._linha('filiais_recibos', p)
+        filiais_volume = self._linha('filiais_volume', p)
+        filiais_itens = self._linha('filiais_itens', p)
+        filiais_horas = self._linha('filiais_horas', p)
+        acumulado['filiais'] = {
+            self._dim_filiais.valores[c]: {
+                'volume': float(filiais_volume[c]) / 100,
+                'recibos': int(filiais_recibos[c]),
+                'itens': normalizar_numero(filiais_itens[c]),
+                'vendas_por_hora': (filiais_horas[c * 24:(c + 1) * 24] / 100).tolist()
+                if len(filiais_horas) >= (c + 1) * 24 else [0.0] * 24
+            }
+            for c in np.flatnonzero(filiais_recibos)
+        }
+        return acumulado
+
+    def _acumulados(self):
+        return self._acumulado(0), self._acumulado(1)
+
+    def _heatmap(self):
+        return HeatmapPeriodos.de_vetores(
+            (self._heatmap_volume / 100).reshape(2, 168),
+            self._heatmap_recibos.reshape(2, 168)
+        )
+
+    def _produtos(self):
+        vazio = np.zeros((2, 0))
+        matriz = lambda nome: self._por_dimensao.get(nome, vazio)
+        return ProdutosPeriodosNumpy(
+            self._dim_produtos,
+            matriz('produtos_linhas'),
+            matriz('produtos_quantidade'),
+            matriz('produtos_montante') / 100,
+            matriz('produtos_faturamento') / 100
+        )
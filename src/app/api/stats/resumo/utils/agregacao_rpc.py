@@ -0,0 +1,192 @@
+# 🔹 Agregação feita na base de dados (RPC), com equivalente SQLite para testes offline
+
+import json
+import os
+import sqlite3
+import threading
+
+from .utils import supabase
+from .rollup import nova_celula, normalizar_numero
+
+# Função SQL instalada no Supabase (ver sql/agregar_celulas_faturas.sql)
+FUNCAO_RPC_AGREGACAO = 'agregar_celulas_faturas'
+
+# Com um caminho definido, o modo rpc usa esta base SQLite em vez do Supabase
+SQLITE_AGREGACAO_PATH = os.getenv('SQLITE_AGREGACAO_PATH', '')
+
+# Mesma agregação que a função SQL do Supabase, em dialeto SQLite
+SQL_SQLITE_AGREGACAO = """
+with faturas as (
+    select
+        f.id,
+        f.data,
+        coalesce(cast(f.filial as text), '') as filial,
+        case
+            when instr(f.hora, ':') > 1
+             and trim(substr(f.hora, 1, instr(f.hora, ':') - 1)) <> ''
+             and trim(substr(f.hora, 1, instr(f.hora, ':') - 1)) not glob '*[^0-9]*'
+             and cast(substr(f.hora, 1, instr(f.hora, ':') - 1) as integer) between 0 and 23
+                then cast(substr(f.hora, 1, instr(f.hora, ':') - 1) as integer)
+            else -1
+        end as hora,
+        f.total,
+        coalesce((select max(c.value) from json_each(:cortes) c where c.value <= f.data), :data_ini) as segmento
+    from faturas_fatura f
+    where f.nif = :nif
+      and f.data between :data_ini and :data_fim
+      and (:filial is null or cast(f.filial as text) = :filial)
+),
+itens_fatura as (
+    select i.fatura_id, sum(i.quantidade) as itens
+    from faturas_itemfatura i
+    join faturas fa on fa.id = i.fatura_id
+    group by i.fatura_id
+)
+select 'c' as tipo, fa.data, fa.filial, fa.hora, null as produto,
+       sum(fa.total) as total, count(*) as recibos, coalesce(sum(it.itens), 0) as itens,
+       null as quantidade, null as montante, null as faturamento
+from faturas fa
+left join itens_fatura it on it.fatura_id = fa.id
+group by fa.data, fa.filial, fa.hora
+
+union all
+
+select 'p', fa.segmento, fa.filial, -1, coalesce(nullif(i.nome, ''), 'Produto Desconhecido'),
+       null, null, null,
+       sum(i.quantidade), sum(i.quantidade * i.preco_unitario), sum(i.total)
+from faturas fa
+join faturas_itemfatura i on i.fatura_id = fa.id
+group by fa.segmento, fa.filial, coalesce(nullif(i.nome, ''), 'Produto Desconhecido')
+"""
+
+SQL_SQLITE_TABELAS = """
+create table if not exists faturas_fatura (
+    id integer primary key,
+    nif text not null,
+    data text not null,
+    hora text,
+    total real not null default 0,
+    filial integer
+);
+create index if not exists faturas_fatura_nif_data on faturas_fatura (nif, data);
+create table if not exists faturas_itemfatura (
+    id integer primary key,
+    fatura_id integer not null references faturas_fatura (id),
+    nome text,
+    quantidade real not null default 0,
+    preco_unitario real not null default 0,
+    total real not null default 0
+);
+create index if not exists faturas_itemfatura_fatura on faturas_itemfatura (fatura_id);
+"""
+
+
+class FonteSQLite:
+    """
+    Base SQLite com as tabelas faturas_fatura/faturas_itemfatura e a mesma
+    agregação do RPC. Permite testar o modo rpc sem Supabase.
+    """
+
+    def __init__(self, caminho=':memory:'):
+        self._conexao = sqlite3.connect(caminho, check_same_thread=False)
+        self._conexao.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conexao.executescript(SQL_SQLITE_TABELAS)
+
+    def carregar(self, nif, faturas):
+        """Grava faturas no formato do PostgREST (itens em 'faturas_itemfatura')"""
+        with self._lock, self._conexao:
+            for fatura in faturas:
+                cursor = self._conexao.execute(
+                    "insert into faturas_fatura (id, nif, data, hora, total, filial) values (?, ?, ?, ?, ?, ?)",
+                    (fatura.get('id'), str(nif), fatura['data'], fatura.get('hora'),
+                     float(fatura.get('total', 0)), fatura.get('filial'))
+                )
+                self._conexao.executemany(
+                    "insert into faturas_itemfatura (fatura_id, nome, quantidade, preco_unitario, total) values (?, ?, ?, ?, ?)",
+                    [
+                        (cursor.lastrowid, item.get('nome'), item.get('quantidade', 0),
+                         float(item.get('preco_unitario', 0.0)), float(item.get('total', 0)))
+                        for item in (fatura.get('faturas_itemfatura') or [])
+                    ]
+                )
+
+    def agregar(self, nif, data_ini, data_fim, filial=None, cortes=()):
+        """Mesmas linhas que o RPC agregar_celulas_faturas"""
+        with self._lock:
+            cursor = self._conexao.execute(SQL_SQLITE_AGREGACAO, {
+                'nif': str(nif),
+                'data_ini': data_ini.isoformat(),
+                'data_fim': data_fim.isoformat(),
+                'filial': filial,
+                'cortes': json.dumps([corte.isoformat() for corte in cortes])
+            })
+            return [dict(linha) for linha in cursor.fetchall()]
+
+
+_fonte_sqlite = None
+_fonte_sqlite_lock = threading.Lock()
+
+
+def fonte_sqlite():
+    global _fonte_sqlite
+    with _fonte_sqlite_lock:
+        if _fonte_sqlite is None:
+            _fonte_sqlite = FonteSQLite(SQLITE_AGREGACAO_PATH or ':memory:')
+        return _fonte_sqlite
+
+
+def _linhas_rpc(nif, data_ini, data_fim, filial=None, cortes=()):
+    """
+    Linhas agregadas pelo RPC do Supabase.
+    OTIMIZAÇÃO: A função devolve todas as linhas num único valor jsonb, sem max-rows
+    nem paginação por offset (que repetiria a agregação inteira em cada página).
+    """
+    res = supabase.rpc(FUNCAO_RPC_AGREGACAO, {
+        'p_nif': str(nif),
+        'p_data_ini': data_ini.isoformat(),
+        'p_data_fim': data_fim.isoformat(),
+        'p_filial': filial,
+        'p_cortes': [corte.isoformat() for corte in cortes]
+    }).execute()
+    return res.data or []
+
+
+def linhas_para_celulas(linhas):
+    """Converte as linhas do RPC em células {dia_iso: {(filial, hora): celula}}"""
+    celulas = {}
+    for linha in linhas:
+        dia_celulas = celulas.setdefault(str(linha['data'])[:10], {})
+        chave = (linha['filial'] or '', int(linha['hora']))
+        celula = dia_celulas.get(chave)
+        if celula is None:
+            celula = dia_celulas[chave] = nova_celula()
+
+        if linha['tipo'] == 'c':
+            celula['total'] += float(linha['total'] or 0)
+            celula['recibos'] += int(linha['recibos'] or 0)
+            celula['itens'] += normalizar_numero(linha['itens'])
+        else:
+            produto = celula['produtos'][linha['produto']]
+            produto['quantidade'] += normalizar_numero(linha['quantidade'])
+            produto['montante'] += float(linha['montante'] or 0)
+            produto['faturamento'] += float(linha['faturamento'] or 0)
+    return celulas
+
+
+def ler_celulas_rpc(nif, data_ini, data_fim, filial=None, cortes=()):
+    """
+    Células (dia, filial, hora) de um intervalo somadas na base de dados.
+    OTIMIZAÇÃO: Em vez de transferir todas as faturas e itens, a base devolve
+    uma linha por (dia, filial, hora) e os produtos somados por filial entre
+    cortes (limites dos períodos), na data do corte e com hora -1: nenhuma rota
+    os usa por dia ou por hora, e são poucos segmentos em vez de um por dia.
+    Sem cortes, os produtos vêm somados no intervalo inteiro (data_ini).
+    Com SQLITE_AGREGACAO_PATH definido usa a base SQLite equivalente.
+    """
+    if SQLITE_AGREGACAO_PATH:
+        linhas = fonte_sqlite().agregar(nif, data_ini, data_fim, filial=filial, cortes=cortes)
+    else:
+        linhas = _linhas_rpc(nif, data_ini, data_fim, filial=filial, cortes=cortes)
+    return linhas_para_celulas(linhas)
@@ -0,0 +1,113 @@
+# 🔹 Cache L1 em memória do processo, à frente do cache Redis das rotas
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from .utils import redis_client
+
+# Memória máxima do L1 por processo (0 desativa o L1)
+CACHE_L1_MAX_BYTES = int(os.getenv('CACHE_L1_MAX_BYTES', 64 * 1024 * 1024))
+
+# Estimativa de memória ocupada por entrada além do corpo da resposta
+BYTES_POR_ENTRADA_L1 = 300
+
+# Canal Redis em que as remoções explícitas de chaves chegam a todos os workers
+CANAL_INVALIDACAO_L1 = 'cache_l1:invalidar'
+
+
+class CacheLocal:
+    """
+    Entradas de cache por chave, com expiração e despejo LRU por memória.
+    As chaves das rotas já levam a geração do NIF/filial, por isso uma
+    invalidação por geração nunca encontra aqui uma entrada antiga; só as
+    remoções explícitas precisam de ser propagadas (ver publicar_remocao).
+    """
+
+    def __init__(self, max_bytes=CACHE_L1_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._entradas = OrderedDict()
+        self._lock = threading.Lock()
+
+    def obter(self, chave):
+        """Valor da chave, ou None se não existir ou já tiver expirado"""
+        with self._lock:
+            entrada = self._entradas.get(chave)
+            if entrada is None:
+                return None
+            if time.time() >= entrada[1]:
+                self._remover(chave)
+                return None
+            self._entradas.move_to_end(chave)
+            return entrada[0]
+
+    def guardar(self, chave, valor, tamanho, expira_em):
+        tamanho += BYTES_POR_ENTRADA_L1
+        if tamanho > self.max_bytes or time.time() >= expira_em:
+            return
+        with self._lock:
+            self._remover(chave)
+            self._entradas[chave] = (valor, expira_em, tamanho)
+            self.bytes += tamanho
+            while self.bytes > self.max_bytes:
+                self._remover(next(iter(self._entradas)))
+
+    def _remover(self, chave):
+        entrada = self._entradas.pop(chave, None)
+        if entrada is not None:
+            self.bytes -= entrada[2]
+
+    def remover(self, chave):
+        with self._lock:
+            self._remover(chave)
+
+    def limpar(self):
+        with self._lock:
+            self._entradas.clear()
+            self.bytes = 0
+
+
+cache_local = CacheLocal()
+
+_escuta_pid = None
+_escuta_lock = threading.Lock()
+
+
+def publicar_remocao(chave):
+    """Remove a chave do L1 deste processo e avisa os restantes workers"""
+    cache_local.remover(chave)
+    try:
+        redis_client.publish(CANAL_INVALIDACAO_L1, chave)
+    except Exception as e:
+        print(f"Erro ao publicar remoção do L1: {str(e)}")
+
+
+def _ouvir_remocoes():
+    while True:
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(CANAL_INVALIDACAO_L1)
+            # Remoções publicadas enquanto não havia subscrição perderam-se
+            cache_local.limpar()
+            for mensagem in pubsub.listen():
+                chave = mensagem.get('data')
+                if isinstance(chave, bytes):
+                    chave = chave.decode()
+                cache_local.remover(chave)
+        except Exception as e:
+            print(f"Erro na subscrição de remoções do L1: {str(e)}")
+            cache_local.limpar()
+            time.sleep(1)
+
+
+def iniciar_escuta():
+    """Arranca (uma vez por processo, também depois de um fork) a thread que aplica as remoções publicadas"""
+    global _escuta_pid
+    if _escuta_pid == os.getpid():
+        return
+    with _escuta_lock:
+        if _escuta_pid != os.getpid():
+            threading.Thread(target=_ouvir_remocoes, daemon=True).start()
+            _escuta_pid = os.getpid()
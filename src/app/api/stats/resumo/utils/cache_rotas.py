@@ -0,0 +1,365 @@
+# 🔹 Cache declarativo das respostas das rotas, com TTL por período
+
+import os
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from datetime import datetime, time as hora, timedelta
+from functools import wraps
+
+from flask import copy_current_request_context, current_app, make_response, request
+
+from .cache_local import CACHE_L1_MAX_BYTES, cache_local, iniciar_escuta, publicar_remocao
+from .geracoes import chave_com_geracoes
+from .utils import redis_client
+
+# TTL (segundos) dos dados por período: 0 Hoje, 2 Semana, 3 Mês, 4 Trimestre, 5 Ano.
+# Os uploads invalidam o cache pela geração do NIF/filial, por isso o TTL só
+# limita quanto tempo uma entrada órfã ocupa o Redis.
+TTL_POR_PERIODO = {
+    0: int(os.getenv('CACHE_TTL_HOJE', 180)),
+    2: int(os.getenv('CACHE_TTL_SEMANA', 1800)),
+    3: int(os.getenv('CACHE_TTL_MES', 3600)),
+    4: int(os.getenv('CACHE_TTL_TRIMESTRE', 7200)),
+    5: int(os.getenv('CACHE_TTL_ANO', 14400))
+}
+
+# TTL das análises de IA: caras de gerar e só mudam com o período
+TTL_ANALISE_IA_POR_PERIODO = {
+    0: 86400,     # Hoje: 1 dia
+    2: 604800,    # Semana: 1 semana
+    3: 2592000,   # Mês: 1 mês
+    4: 2592000,   # Trimestre: 1 mês
+    5: 31536000   # Ano: 1 ano
+}
+
+# TTL de respostas sem período
+TTL_PADRAO = int(os.getenv('CACHE_TTL_PADRAO', 180))
+
+# Períodos só com dias fechados (1 Ontem, contra anteontem): só mudam com uploads, que
+# mudam a geração, por isso ficam em cache até à meia-noite, quando o período passa a
+# ser outro dia. Os dias fechados dos restantes períodos vêm da memória do processo
+# (ver rollup.dias_fechados) e só o dia de hoje é recalculado quando o TTL expira.
+PERIODOS_FECHADOS = (1,)
+
+# Stale-while-revalidate: depois do TTL a resposta ainda é servida durante esta
+# janela enquanto um único worker a recalcula em background
+JANELA_STALE_SEGUNDOS = int(os.getenv('CACHE_JANELA_STALE_SEGUNDOS', 900))
+
+# Lease do lock de revalidação no Redis (um recálculo por chave entre workers)
+LEASE_REVALIDACAO_MS = int(os.getenv('CACHE_LEASE_REVALIDACAO_MS', 60000))
+
+# Single-flight nos misses: lease do lock de cálculo no Redis e intervalo com que
+# os outros workers voltam a procurar a resposta enquanto esperam
+LEASE_CALCULO_MS = int(os.getenv('CACHE_LEASE_CALCULO_MS', 60000))
+INTERVALO_ESPERA_SEGUNDOS = float(os.getenv('CACHE_INTERVALO_ESPERA_SEGUNDOS', 0.05))
+
+# Só quem tem o token do lock o liberta (o lease pode ter expirado e passado a outro)
+_SCRIPT_LIBERTAR = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def _segundos_ate_meia_noite():
+    agora = datetime.now()
+    meia_noite = datetime.combine(agora.date() + timedelta(days=1), hora())
+    return max(1, int((meia_noite - agora).total_seconds()))
+
+
+def ttl_periodo(periodo, politica=TTL_POR_PERIODO, padrao=TTL_PADRAO):
+    """
+    TTL de um período segundo a política (período inválido usa o padrão).
+    Períodos fechados ficam até à meia-noite, qualquer que seja a política.
+    """
+    try:
+        periodo = int(periodo)
+    except (TypeError, ValueError):
+        return padrao
+    if periodo in PERIODOS_FECHADOS:
+        return _segundos_ate_meia_noite()
+    return politica.get(periodo, padrao)
+
+
+def ttl_periodos(periodos, politica=TTL_POR_PERIODO, padrao=TTL_PADRAO):
+    """TTL de uma resposta com vários períodos: o do período que expira primeiro"""
+    return min((ttl_periodo(p, politica, padrao) for p in periodos), default=padrao)
+
+
+def _lista(valor):
+    return [v.strip() for v in valor.split(',') if v.strip()]
+
+
+def _adquirir(chave_lock, lease_ms):
+    """Token do lock (SET NX PX), None se outro worker o tem, ou '' se o Redis não responder"""
+    token = uuid.uuid4().hex
+    try:
+        return token if redis_client.set(chave_lock, token, nx=True, px=lease_ms) else None
+    except Exception as e:
+        print(f"Erro ao obter lock {chave_lock}: {str(e)}")
+        return ''
+
+
+def _libertar(chave_lock, token):
+    if not token:
+        return
+    try:
+        redis_client.eval(_SCRIPT_LIBERTAR, 1, chave_lock, token)
+    except Exception as e:
+        print(f"Erro ao libertar lock {chave_lock}: {str(e)}")
+
+
+def _resposta(guardado):
+    dados, status, mimetype = guardado[:3]
+    return current_app.response_class(dados, status=status, mimetype=mimetype)
+
+
+class _Voo:
+    """Cálculo em curso de uma chave neste processo; os seguidores esperam pelo evento"""
+
+    def __init__(self):
+        self.evento = threading.Event()
+        self.guardado = None
+
+
+class CacheRotas:
+    """
+    Cache das respostas das rotas sobre o Flask-Caching.
+    Cada rota declara a família e os parâmetros que a distinguem; a chave junta
+    esses parâmetros (incluindo a filial) com a geração do NIF/filial, e o TTL
+    vem da política por período. Só respostas 200 são guardadas.
+    Conta hits, misses e respostas stale por família (por processo).
+    OTIMIZAÇÃO: À frente do Redis há um L1 em memória do processo (cache_local):
+    as chaves quentes são servidas sem ida ao Redis pelo corpo da resposta nem
+    unpickle; continua só a leitura das gerações, que é o que garante que
+    uma invalidação se vê em todos os workers.
+    """
+
+    def __init__(self, cache, local=cache_local if CACHE_L1_MAX_BYTES > 0 else None):
+        self.cache = cache
+        self.local = local
+        self._parametros = {}
+        self._contadores = defaultdict(Counter)
+        self._revalidando = set()
+        self._em_voo = {}
+        self._lock = threading.Lock()
+
+    def chave(self, familia, valores):
+        """Chave de cache de uma família para os valores dos seus parâmetros"""
+        parametros = self._parametros[familia]
+        partes = '/'.join(f"{p}={valores.get(p) or ''}" for p in parametros)
+
+        # Geração de cada NIF da resposta; com filial, a dessa filial
+        nifs = _lista(valores.get('nifs') or '') if 'nifs' in parametros else [valores.get('nif') or '']
+        filial = (valores.get('filial') or None) if 'filial' in parametros else None
+        return chave_com_geracoes(f"rota:{familia}:{partes}", [(nif, filial) for nif in nifs])
+
+    def _ttl(self, ttl):
+        if isinstance(ttl, dict):
+            if 'periodos' in request.args:
+                return ttl_periodos(_lista(request.args['periodos']), ttl)
+            return ttl_periodo(request.args.get('periodo', '0'), ttl)
+        return ttl
+
+    def _contar(self, familia, resultado):
+        with self._lock:
+            self._contadores[familia][resultado] += 1
+
+    def estatisticas(self):
+        """
+        Hits, misses, respostas stale e taxa de acerto (stale conta como acerto) por família neste processo.
+        coalescidos: misses servidos pelo cálculo de outro pedido em vez de recalcular.
+        hits_l1: hits servidos da memória do processo, sem ler o Redis.
+        """
+        with self._lock:
+            return {
+                familia: {
+                    'hits': c['hits'],
+                    'misses': c['misses'],
+                    'stale': c['stale'],
+                    'coalescidos': c['coalescidos'],
+                    'hits_l1': c['hits_l1'],
+                    'taxa_acerto': round((c['hits'] + c['stale']) / pedidos * 100, 2) if pedidos else 0.0
+                }
+                for familia, c in self._contadores.items()
+                for pedidos in [c['hits'] + c['misses'] + c['stale']]
+            }
+
+    def _guardar_local(self, chave, guardado):
+        """Guarda no L1 uma entrada ainda fresca, até à sua expiração suave"""
+        if self.local is not None:
+            self.local.guardar(chave, guardado, len(guardado[0]), guardado[3])
+
+    def _ler(self, familia, chave):
+        """
+        Entrada da chave e se veio do L1.
+        O L1 só tem entradas frescas; uma entrada stale é sempre lida do Redis,
+        onde outro worker pode já a ter revalidado.
+        """
+        if self.local is not None:
+            iniciar_escuta()
+            guardado = self.local.obter(chave)
+            if guardado is not None:
+                return guardado, True
+
+        try:
+            guardado = self.cache.get(chave)
+        except Exception as e:
+            print(f"Erro ao ler cache da rota {familia}: {str(e)}")
+            return None, False
+
+        if guardado is not None:
+            self._guardar_local(chave, guardado)
+        return guardado, False
+
+    def apagar(self, familia, valores):
+        """Apaga a entrada de uma família no Redis e no L1 de todos os workers"""
+        chave = self.chave(familia, valores)
+        if self.local is not None:
+            publicar_remocao(chave)
+        return self.cache.delete(chave)
+
+    def _calcular_e_guardar(self, familia, chave, rota, args, kwargs, ttl, swr):
+        """
+        Executa a rota e guarda a resposta 200 com o instante de expiração suave.
+        Retorna (resposta, entrada guardada ou None).
+        """
+        resposta = make_response(rota(*args, **kwargs))
+        if resposta.status_code != 200 or resposta.direct_passthrough:
+            return resposta, None
+
+        guardado = (resposta.get_data(), resposta.status_code, resposta.mimetype, time.time() + ttl)
+        try:
+            self.cache.set(chave, guardado, timeout=ttl + (JANELA_STALE_SEGUNDOS if swr else 0))
+        except Exception as e:
+            print(f"Erro ao guardar cache da rota {familia}: {str(e)}")
+        self._guardar_local(chave, guardado)
+        return resposta, guardado
+
+    def _esperar_outro_worker(self, chave, chave_lock):
+        """Espera que o worker com o lock guarde a resposta; None se o lock acabar sem resposta"""
+        limite = time.time() + LEASE_CALCULO_MS / 1000
+        while time.time() < limite:
+            time.sleep(INTERVALO_ESPERA_SEGUNDOS)
+            try:
+                guardado = self.cache.get(chave)
+                if guardado is not None:
+                    return guardado
+                if not redis_client.exists(chave_lock):
+                    # Falhou ou não guardou (resposta não 200): última tentativa de ler
+                    return self.cache.get(chave)
+            except Exception as e:
+                print(f"Erro ao esperar pelo cálculo de {chave}: {str(e)}")
+                return None
+        return None
+
+    def _calcular_unico(self, familia, chave, rota, args, kwargs, ttl, swr):
+        """
+        Calcula um miss uma única vez por chave.
+        OTIMIZAÇÃO: Depois de uma invalidação, os pedidos simultâneos à mesma chave
+        (dashboard, precache, outros separadores) esperam pelo mesmo cálculo em vez
+        de repetirem a leitura, a agregação e, na análise completa, a chamada ao
+        OpenAI. No processo esperam por um evento; entre workers, quem não obtém
+        o lock (SET NX PX) espera que a resposta apareça no cache.
+        Se o cálculo de quem lidera falhar, cada seguidor calcula por si.
+        """
+        with self._lock:
+            voo = self._em_voo.get(chave)
+            lider = voo is None
+            if lider:
+                voo = self._em_voo[chave] = _Voo()
+
+        if not lider:
+            voo.evento.wait(LEASE_CALCULO_MS / 1000)
+            if voo.guardado is not None:
+                self._contar(familia, 'coalescidos')
+                return _resposta(voo.guardado)
+            return self._calcular_e_guardar(familia, chave, rota, args, kwargs, ttl, swr)[0]
+
+        try:
+            chave_lock = f"calcular:{chave}"
+            token = _adquirir(chave_lock, LEASE_CALCULO_MS)
+            if token is None:
+                voo.guardado = self._esperar_outro_worker(chave, chave_lock)
+                if voo.guardado is not None:
+                    self._contar(familia, 'coalescidos')
+                    return _resposta(voo.guardado)
+
+            try:
+                resposta, voo.guardado = self._calcular_e_guardar(familia, chave, rota, args, kwargs, ttl, swr)
+                return resposta
+            finally:
+                _libertar(chave_lock, token)
+        finally:
+            with self._lock:
+                self._em_voo.pop(chave, None)
+            voo.evento.set()
+
+    def _revalidar(self, familia, chave, rota, args, kwargs, ttl):
+        """
+        Recalcula uma entrada stale em background, no máximo uma vez por chave:
+        no processo (conjunto de chaves em curso) e entre workers (SET NX PX no Redis).
+        """
+        with self._lock:
+            if chave in self._revalidando:
+                return
+            self._revalidando.add(chave)
+
+        # Sem Redis ('') o lock do processo basta
+        chave_lock = f"revalidar:{chave}"
+        token = _adquirir(chave_lock, LEASE_REVALIDACAO_MS)
+        if token is None:
+            with self._lock:
+                self._revalidando.discard(chave)
+            return
+
+        @copy_current_request_context
+        def recalcular():
+            try:
+                self._calcular_e_guardar(familia, chave, rota, args, kwargs, ttl, True)
+            except Exception as e:
+                print(f"Erro ao revalidar cache da rota {familia}: {str(e)}")
+            finally:
+                with self._lock:
+                    self._revalidando.discard(chave)
+                _libertar(chave_lock, token)
+
+        threading.Thread(target=recalcular, daemon=True).start()
+
+    def cached(self, familia, parametros=('nif', 'periodo'), ttl=TTL_POR_PERIODO, swr=False):
+        """
+        Decorador de cache de uma rota.
+        parametros: nomes dos parâmetros do pedido que entram na chave
+        ttl: segundos, ou uma política {periodo: segundos} aplicada ao parâmetro periodo
+             (ou ao período de menor TTL do parâmetro periodos)
+        swr: depois do TTL serve a resposta antiga durante JANELA_STALE_SEGUNDOS e
+             recalcula-a em background.
+             OTIMIZAÇÃO: Só o primeiro pedido de sempre (ou depois de uma
+             invalidação) espera pela leitura e agregação; a expiração por TTL
+             nunca fica no caminho do utilizador.
+        """
+        self._parametros[familia] = tuple(parametros)
+
+        def decorador(rota):
+            @wraps(rota)
+            def envolvida(*args, **kwargs):
+                chave = self.chave(familia, {p: request.args.get(p, '').strip() for p in parametros})
+
+                guardado, do_l1 = self._ler(familia, chave)
+                if guardado is not None:
+                    if swr and time.time() >= guardado[3]:
+                        self._contar(familia, 'stale')
+                        self._revalidar(familia, chave, rota, args, kwargs, self._ttl(ttl))
+                    else:
+                        self._contar(familia, 'hits')
+                        if do_l1:
+                            self._contar(familia, 'hits_l1')
+                    return _resposta(guardado)
+
+                self._contar(familia, 'misses')
+                return self._calcular_unico(familia, chave, rota, args, kwargs, self._ttl(ttl), swr)
+            return envolvida
+        return decorador
@@ -0,0 +1,43 @@
+# 🔹 Construtor central das consultas a faturas: cada rota declara os campos de que precisa
+
+TABELA_FATURAS = 'faturas_fatura'
+TABELA_ITENS = 'faturas_itemfatura'
+
+# Colunas conhecidas de cada tabela (um campo fora destas listas é um erro da rota)
+COLUNAS_FATURA = (
+    'id', 'numero_fatura', 'data', 'hora', 'total', 'texto_original', 'texto_completo',
+    'qrcode', 'filial', 'nif', 'nif_cliente', 'criado_em', 'atualizado_em'
+)
+COLUNAS_ITEM = ('id', 'fatura_id', 'nome', 'quantidade', 'preco_unitario', 'total')
+
+# Campos de item por métrica pedida
+CAMPOS_ITEM_PRODUTOS = ('nome', 'quantidade', 'preco_unitario', 'total')  # totais por produto
+CAMPOS_ITEM_CONTAGEM = ('quantidade',)                                    # só itens vendidos
+
+
+def _validar(campos, colunas, tabela):
+    desconhecidos = [c for c in campos if c not in colunas]
+    if desconhecidos:
+        raise ValueError(f"Campos desconhecidos em {tabela}: {', '.join(desconhecidos)}")
+
+
+def montar_select(campos, campos_itens=()):
+    """
+    Expressão select mais estreita para os campos pedidos.
+    OTIMIZAÇÃO: Só as colunas declaradas são transferidas; o join dos itens
+    só entra quando há campos de item, porque é ele que multiplica o payload.
+    """
+    campos = tuple(dict.fromkeys(campos))
+    campos_itens = tuple(dict.fromkeys(campos_itens or ()))
+    _validar(campos, COLUNAS_FATURA, TABELA_FATURAS)
+    _validar(campos_itens, COLUNAS_ITEM, TABELA_ITENS)
+
+    select = ', '.join(campos)
+    if campos_itens:
+        select += f", {TABELA_ITENS}({', '.join(campos_itens)})"
+    return select
+
+
+def consulta_faturas(cliente, campos, campos_itens=()):
+    """Consulta a faturas_fatura do cliente Supabase, já com o select mínimo"""
+    return cliente.table(TABELA_FATURAS).select(montar_select(campos, campos_itens))
@@ -0,0 +1,49 @@
+# 🔹 Métricas por filial a partir do resultado da agregação
+
+from .utils import calcular_variacao_dados
+
+
+def _ticket(dados):
+    return round(dados['volume'] / dados['recibos'], 2) if dados['recibos'] else 0.0
+
+
+def metricas_filiais(dados_processados, comparar=False):
+    """
+    Volume, faturas, itens, ticket médio, curva horária e quota de cada filial.
+    OTIMIZAÇÃO: Tudo vem dos acumulados por filial preenchidos na passagem
+    principal da agregação, sem consultas adicionais.
+    Com comparar=True inclui a variação face ao período anterior.
+    Retorna a lista ordenada por volume (maior primeiro).
+    """
+    filiais_atual = dados_processados['filiais_atual']
+    filiais_anterior = dados_processados['filiais_anterior']
+    volume_total = sum(dados['volume'] for dados in filiais_atual.values())
+
+    metricas = []
+    for filial, dados in filiais_atual.items():
+        metrica = {
+            'filial': filial,
+            'volume': round(dados['volume'], 2),
+            'numero_faturas': dados['recibos'],
+            'itens_vendidos': dados['itens'],
+            'ticket_medio': _ticket(dados),
+            'percentual_total': round(dados['volume'] / volume_total * 100, 2) if volume_total > 0 else 0.0,
+            'vendas_por_hora': [
+                {'hora': f"{hora:02d}:00", 'total': round(total, 2)}
+                for hora, total in enumerate(dados['vendas_por_hora']) if total
+            ]
+        }
+
+        if comparar:
+            anterior = filiais_anterior.get(filial, {'volume': 0.0, 'recibos': 0, 'itens': 0})
+            metrica['variacao'] = {
+                'volume': calcular_variacao_dados(dados['volume'], anterior['volume']),
+                'numero_faturas': calcular_variacao_dados(dados['recibos'], anterior['recibos']),
+                'itens_vendidos': calcular_variacao_dados(dados['itens'], anterior['itens']),
+                'ticket_medio': calcular_variacao_dados(_ticket(dados), _ticket(anterior))
+            }
+
+        metricas.append(metrica)
+
+    metricas.sort(key=lambda m: m['volume'], reverse=True)
+    return metricas
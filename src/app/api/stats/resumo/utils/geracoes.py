@@ -0,0 +1,88 @@
+# 🔹 Gerações de cache por NIF e por (NIF, filial): invalidar é um único INCR
+
+import uuid
+
+from .utils import redis_client
+
+
+def _chave_geracao_nif(nif):
+    return f"cache_geracao:{nif}"
+
+
+def _chave_geracao_filial(nif, filial):
+    return f"cache_geracao:{nif}:{filial or ''}"
+
+
+def geracao(nif, filial=None):
+    """
+    Geração atual das entradas de cache de um NIF/filial, como texto 'N.M'
+    (N: geração do NIF, M: geração da filial; sem filial, a das respostas de todas as filiais).
+    Retorna None se o Redis não responder.
+    """
+    return geracoes([(nif, filial)])
+
+
+def geracoes(pares):
+    """Gerações de vários (NIF, filial) lidas num só MGET, como texto 'N.M-N.M...'"""
+    chaves = []
+    for nif, filial in pares:
+        chaves += [_chave_geracao_nif(nif), _chave_geracao_filial(nif, filial)]
+    try:
+        valores = [int(v or 0) for v in redis_client.mget(chaves)]
+    except Exception as e:
+        print(f"Erro ao ler geração do cache: {str(e)}")
+        return None
+    return '-'.join(f"{valores[i]}.{valores[i + 1]}" for i in range(0, len(valores), 2))
+
+
+def chave_com_geracao(chave, nif, filial=None):
+    """
+    Chave de cache com a geração do NIF/filial.
+    OTIMIZAÇÃO: Depois de um INCR todas as chaves antigas deixam de ser pedidas e
+    expiram pelo TTL, sem enumerar nem apagar chaves.
+    Sem geração (Redis em baixo) devolve uma chave única, ou seja, sem cache.
+    """
+    return chave_com_geracoes(chave, [(nif, filial)])
+
+
+def chave_com_geracoes(chave, pares):
+    """Como chave_com_geracao, para respostas que juntam vários (NIF, filial)"""
+    atual = geracoes(pares)
+    if atual is None:
+        return f"{chave}@{uuid.uuid4().hex}"
+    return f"{chave}@{atual}"
+
+
+def _incrementar(*chaves):
+    """INCR de cada chave numa só ida ao Redis; retorna o primeiro valor, ou None se falhar"""
+    try:
+        pipe = redis_client.pipeline()
+        for chave in chaves:
+            pipe.incr(chave)
+        return pipe.execute()[0]
+    except Exception as e:
+        print(f"Erro ao invalidar cache: {str(e)}")
+        return None
+
+
+def invalidar_cache(nif, filial=None):
+    """
+    Invalida as entradas de cache de um NIF (todas as filiais) ou só de uma filial.
+    Uma filial invalida também as respostas de todas as filiais, que a incluem.
+    Retorna a nova geração, ou None se o Redis não responder.
+    """
+    if not filial:
+        return _incrementar(_chave_geracao_nif(nif))
+    return _incrementar(_chave_geracao_filial(nif, filial), _chave_geracao_filial(nif, None))
+
+
+def invalidar_cache_faturas(faturas):
+    """Invalida o cache de cada (NIF, filial) das faturas gravadas e retorna os NIFs afetados"""
+    pares = {(str(f.get('nif')), f.get('filial') or None) for f in faturas if f.get('nif')}
+    for nif, filial in pares:
+        if filial:
+            invalidar_cache(nif, filial)
+        else:
+            # Faturas sem filial só entram nas respostas de todas as filiais
+            _incrementar(_chave_geracao_filial(nif, None))
+    return {nif for nif, _ in pares}
@@ -0,0 +1,81 @@
+# 🔹 Heatmap hora × dia da semana para os períodos atual e anterior
+
+import heapq
+
+NOMES_DIAS = ["Segunda", "Terça", "Quarta", "Quinta", "Sexta", "Sábado", "Domingo"]
+
+ATUAL = 0
+ANTERIOR = 1
+
+
+class HeatmapPeriodos:
+    """
+    Grelhas 24x7 fixas de volume e quantidade de faturas para ambos os períodos.
+    OTIMIZAÇÃO: Cada grelha é um vetor plano de 168 posições (hora * 7 + dia),
+    preenchido numa única passagem para os dois períodos; totais, picos e
+    tickets médios são lidos diretamente desses vetores.
+    """
+
+    def __init__(self):
+        self.volume = [[0.0] * 168, [0.0] * 168]
+        self.quantidade = [[0] * 168, [0] * 168]
+
+    @classmethod
+    def de_vetores(cls, volume, quantidade):
+        """Cria o heatmap a partir de vetores (2, 168) já calculados (ex.: backend NumPy)"""
+        heatmap = cls()
+        heatmap.volume = [list(map(float, volume[ATUAL])), list(map(float, volume[ANTERIOR]))]
+        heatmap.quantidade = [list(map(int, quantidade[ATUAL])), list(map(int, quantidade[ANTERIOR]))]
+        return heatmap
+
+    def adicionar(self, periodo, hora, dia_semana, volume, quantidade=1):
+        indice = hora * 7 + dia_semana
+        self.volume[periodo][indice] += volume
+        self.quantidade[periodo][indice] += quantidade
+
+    def totais(self, periodo=ATUAL):
+        """Retorna (volume total, número de faturas) do período"""
+        return sum(self.volume[periodo]), sum(self.quantidade[periodo])
+
+    def _celula(self, periodo, indice):
+        hora, dia = divmod(indice, 7)
+        volume = self.volume[periodo][indice]
+        quantidade = self.quantidade[periodo][indice]
+        return {
+            "hora": f"{hora:02d}:00",
+            "hora_num": hora,
+            "dia_semana": NOMES_DIAS[dia],
+            "dia_num": dia,
+            "volume": round(volume, 2),
+            "quantidade_faturas": quantidade,
+            "ticket_medio": round(volume / quantidade, 2) if quantidade > 0 else 0.0
+        }
+
+    def celulas(self, periodo=ATUAL):
+        """Células com dados, ordenadas por hora e dia, com ticket médio por célula"""
+        quantidade = self.quantidade[periodo]
+        return [self._celula(periodo, indice) for indice in range(168) if quantidade[indice] > 0]
+
+    def top_celulas(self, periodo=ATUAL, n=5, chave="volume"):
+        """As n células com maior volume (ou quantidade), sem ordenar a grelha inteira"""
+        valores = self.volume[periodo] if chave == "volume" else self.quantidade[periodo]
+        quantidade = self.quantidade[periodo]
+        indices = heapq.nlargest(n, (i for i in range(168) if quantidade[i] > 0), key=valores.__getitem__)
+        return [self._celula(periodo, indice) for indice in indices]
+
+    def picos(self, periodo=ATUAL):
+        """Células de maior volume e de maior quantidade de faturas do período"""
+        maior_volume = self.top_celulas(periodo, 1, "volume")
+        maior_quantidade = self.top_celulas(periodo, 1, "quantidade")
+        return {
+            "maior_volume": {
+                "hora": maior_volume[0]["hora"],
+                "dia": maior_volume[0]["dia_semana"],
+                "volume": maior_volume[0]["volume"]
+            } if maior_volume else None,
+            "maior_quantidade": {
+                "hora": maior_quantidade[0]["hora"],
+                "dia": maior_quantidade[0]["dia_semana"],
+                "quantidade": maior_quantidade[0]["quantidade_faturas"]
+            } if maior_quantidade else None
+        }
@@ -0,0 +1,175 @@
+# 🔹 Métricas de hoje atualizadas de forma incremental por watermark
+
+import os
+import threading
+import time
+from datetime import date, datetime, timezone
+
+from .utils import redis_client, iterar_lotes_faturas_periodo, COLUNAS_FATURA_CELULAS
+from .consultas import montar_select, CAMPOS_ITEM_PRODUTOS
+from .rollup import acumular_celulas, nova_celula
+
+# Tempo máximo entre a ingestão começar a gravar uma fatura (criado_em) e a fatura,
+# com os itens, ficar visível. Os ids não ficam visíveis por ordem (uploads
+# concorrentes), por isso cada leitura volta a ler a janela acima do watermark:
+# uma fatura só entra no acumulado quando já não pode estar a meio da gravação, e
+# o watermark só passa por ids para os quais todos os ids menores já estão visíveis
+MARGEM_WATERMARK_SEGUNDOS = int(os.getenv('MARGEM_WATERMARK_SEGUNDOS', 60))
+
+# criado_em limita o momento em que o id da fatura foi atribuído
+CAMPOS_FATURA_HOJE = montar_select(COLUNAS_FATURA_CELULAS + ('criado_em',), CAMPOS_ITEM_PRODUTOS)
+
+
+def _chave_geracao(nif):
+    return f"hoje_geracao:{nif}"
+
+
+class _AcumuladoHoje:
+    """
+    Células de hoje de um NIF (todas as filiais) e o watermark: todas as faturas
+    com id até ele já estão no acumulado. Acima dele ficam os ids já incorporados
+    e, por fatura, o último momento em que o seu id pode ter sido atribuído.
+    O acumulado só soma faturas: quando uma é apagada a geração do NIF muda
+    (invalidar_hoje) e o acumulado recomeça.
+    """
+
+    def __init__(self, dia_iso, geracao):
+        self.dia_iso = dia_iso
+        self.geracao = geracao
+        self.celulas = {}
+        self.watermark = None
+        self.incorporadas = set()
+        self.vistas = {}
+        self.lock = threading.Lock()
+
+
+_acumulados = {}
+_acumulados_lock = threading.Lock()
+
+
+def _geracao(nif):
+    """Geração do acumulado de hoje do NIF, ou None se o Redis não responder"""
+    try:
+        return int(redis_client.get(_chave_geracao(nif)) or 0)
+    except Exception as e:
+        print(f"Erro ao ler geração das métricas de hoje: {str(e)}")
+        return None
+
+
+def invalidar_hoje(nifs):
+    """Faz recomeçar o acumulado de hoje dos NIFs em todos os processos (ex.: faturas apagadas)"""
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for nif in nifs:
+            pipe.incr(_chave_geracao(nif))
+        pipe.execute()
+    except Exception as e:
+        print(f"Erro ao invalidar métricas de hoje: {str(e)}")
+
+
+def _acumulado(nif, dia_iso):
+    geracao = _geracao(nif)
+    with _acumulados_lock:
+        acumulado = _acumulados.get(nif)
+        # Mudança de dia: o acumulado de ontem passa a ser servido pelo rollup.
+        # Sem Redis a geração fica a que era
+        if acumulado is None or acumulado.dia_iso != dia_iso or geracao not in (None, acumulado.geracao):
+            acumulado = _acumulados[nif] = _AcumuladoHoje(dia_iso, geracao)
+        return acumulado
+
+
+def _atribuida_ate(fatura, agora):
+    """
+    Momento (epoch) até ao qual o id da fatura foi atribuído: quando foi vista pela
+    primeira vez ou, se antes, criado_em (gravado pela ingestão mesmo antes do INSERT) + margem.
+    """
+    criado_em = fatura.get('criado_em')
+    if not criado_em:
+        return agora
+    try:
+        momento = datetime.fromisoformat(criado_em.replace('Z', '+00:00'))
+    except (TypeError, ValueError):
+        return agora
+    if momento.tzinfo is None:
+        # criado_em é gravado em UTC pela ingestão
+        momento = momento.replace(tzinfo=timezone.utc)
+    return min(agora, momento.timestamp() + MARGEM_WATERMARK_SEGUNDOS)
+
+
+def _somar_celula(a, b):
+    celula = nova_celula()
+    for origem in (a, b):
+        celula['total'] += origem['total']
+        celula['recibos'] += origem['recibos']
+        celula['itens'] += origem['itens']
+        for nome, produto in origem['produtos'].items():
+            destino = celula['produtos'][nome]
+            destino['quantidade'] += produto['quantidade']
+            destino['montante'] += produto['montante']
+            destino['faturamento'] += produto['faturamento']
+    return celula
+
+
+def _juntar(dia_celulas, dia_iso, faturas):
+    """
+    Novo dicionário de células com as faturas somadas.
+    Só as células tocadas são copiadas; as restantes são partilhadas, por isso
+    quem já leu o acumulado nunca o vê mudar.
+    """
+    novas = acumular_celulas({}, faturas).get(dia_iso, {})
+    if not novas:
+        return dia_celulas
+    juntas = dict(dia_celulas)
+    for chave, celula in novas.items():
+        base = juntas.get(chave)
+        juntas[chave] = _somar_celula(base, celula) if base is not None else celula
+    return juntas
+
+
+def celulas_hoje(nif, filial=None):
+    """
+    Células {(filial, hora): celula} de hoje de um NIF.
+    OTIMIZAÇÃO: Cada leitura só vai buscar as faturas com id acima do watermark
+    e soma as novas ao acumulado do processo, por isso o custo de atualizar é
+    proporcional às vendas recentes e não ao tamanho do dia.
+    """
+    hoje = date.today()
+    dia_iso = hoje.isoformat()
+    acumulado = _acumulado(nif, dia_iso)
+
+    with acumulado.lock:
+        agora = time.time()
+        lidas = []
+        for lote in iterar_lotes_faturas_periodo(nif, hoje, hoje, depois_id=acumulado.watermark, campos=CAMPOS_FATURA_HOJE):
+            lidas.extend(lote)
+
+        # Só ficam as faturas lidas agora; as apagadas já incorporadas saem pela geração (ver invalidar_hoje)
+        acumulado.vistas = {f['id']: acumulado.vistas.get(f['id']) or _atribuida_ate(f, agora) for f in lidas}
+        assentes = agora - MARGEM_WATERMARK_SEGUNDOS
+
+        novas, pendentes = [], []
+        for fatura in lidas:
+            if fatura['id'] in acumulado.incorporadas:
+                continue
+            if acumulado.vistas[fatura['id']] <= assentes:
+                novas.append(fatura)
+                acumulado.incorporadas.add(fatura['id'])
+            else:
+                pendentes.append(fatura)
+        acumulado.celulas = _juntar(acumulado.celulas, dia_iso, novas)
+        dia_celulas = _juntar(acumulado.celulas, dia_iso, pendentes)
+
+        # O watermark avança (por ordem de id) sobre faturas incorporadas atribuídas antes da margem:
+        # um id menor foi atribuído antes e por isso já estava visível nesta leitura
+        for fatura in lidas:
+            if fatura['id'] not in acumulado.incorporadas or acumulado.vistas[fatura['id']] > assentes:
+                break
+            acumulado.watermark = fatura['id']
+        if acumulado.watermark is not None:
+            acumulado.incorporadas = {i for i in acumulado.incorporadas if i > acumulado.watermark}
+            acumulado.vistas = {i: v for i, v in acumulado.vistas.items() if i > acumulado.watermark}
+
+    if filial:
+        filial = str(filial)
+        dia_celulas = {chave: celula for chave, celula in dia_celulas.items() if chave[0] == filial}
+    return dia_celulas
@@ -0,0 +1,481 @@
+# 🔹 Ingestão de faturas enviadas por upload
+
+import codecs
+import hashlib
+import json
+import os
+from datetime import date, datetime
+
+from .utils import supabase, redis_client
+from .rollup import aplicar_delta_rollup, iniciar_insercao_rollup, terminar_insercao_rollup
+from .segmentos import invalidar_segmentos
+from .geracoes import invalidar_cache_faturas
+from .hoje import invalidar_hoje
+from .parse_faturas import parse_faturas
+
+# Faturas por INSERT multi-linha e itens por INSERT multi-linha
+TAMANHO_LOTE_INSERCAO_FATURAS = 500
+TAMANHO_LOTE_INSERCAO_ITENS = 1000
+
+# Leitura do upload em modo stream
+TAMANHO_BLOCO_LEITURA = 1024 * 1024
+# ⚠️ Modo stream: SEPARADOR_FATURAS é o texto que separa faturas consecutivas no ficheiro
+# exportado (aceita escapes, ex.: "\f" ou "\n\n\n"). Sem esta variável o separador é
+# detetado no início de cada ficheiro: exportações com quebra de página (\f) entre
+# faturas são lidas em stream e as restantes inteiras em memória.
+SEPARADOR_FATURAS = codecs.decode(os.getenv('SEPARADOR_FATURAS', ''), 'unicode_escape')
+SEPARADORES_DETETADOS = ('\f',)
+# Texto acumulado sem encontrar um separador a partir do qual o ficheiro é recusado:
+# o separador está errado e o stream ia guardar o ficheiro inteiro em memória
+MAX_TEXTO_SEM_SEPARADOR = int(os.getenv('MAX_TEXTO_SEM_SEPARADOR', 16 * 1024 * 1024))
+
+# Erros que o parser levanta perante texto mal formado. Os restantes (banco, Redis,
+# disco) não são erros do ficheiro: propagam para o chamador
+ERROS_PARSER = (ValueError, KeyError, IndexError, TypeError, AttributeError)
+
+# 'filial' também é obrigatório
+CAMPOS_OBRIGATORIOS = ['numero_fatura', 'data', 'hora', 'total', 'nif_emitente', 'nif_cliente', 'itens', 'filial']
+
+
+def normalizar_numero_fatura(numero_fatura):
+    return numero_fatura.replace('/', '_').replace(' ', '')
+
+
+# 🔹 Índice de impressões digitais para uploads idempotentes
+#
+# ingestao:ficheiro:{sha256}          resumo de um ficheiro ingerido sem erros
+# ingestao:faturas:{nif}:{AAAA-MM}    impressões das faturas do NIF com data nesse mês
+#
+# As chaves expiram TTL_INDICE_INGESTAO_DIAS depois da última escrita: uma fatura mais
+# antiga do que isso volta a ser inserida se for reenviada.
+# Para forçar a reingestão (por exemplo depois de apagar faturas no banco), apagar
+# as chaves correspondentes no Redis:
+#   DEL ingestao:ficheiro:<sha256sum do ficheiro>
+#   DEL ingestao:faturas:<nif>:<AAAA-MM>     (um por mês das faturas a reenviar)
+TTL_INDICE_INGESTAO_DIAS = int(os.getenv('TTL_INDICE_INGESTAO_DIAS', 400))
+
+def _chave_ficheiro(impressao):
+    return f"ingestao:ficheiro:{impressao}"
+
+def _chave_faturas(fa):
+    return f"ingestao:faturas:{fa['nif_emitente']}:{str(fa['data'])[:7]}"
+
+def impressao_ficheiro(conteudo):
+    """Impressão digital (SHA-256) do conteúdo bruto de um ficheiro"""
+    return hashlib.sha256(conteudo).hexdigest()
+
+def impressao_fatura(fa):
+    """Impressão digital de uma fatura: número normalizado + NIF emitente + total"""
+    chave = f"{normalizar_numero_fatura(str(fa['numero_fatura']))}|{fa['nif_emitente']}|{float(fa['total']):.2f}"
+    return hashlib.sha1(chave.encode('utf-8')).hexdigest()
+
+def impressao_ficheiro_stream(stream, tamanho_bloco=TAMANHO_BLOCO_LEITURA):
+    """
+    Impressão digital (SHA-256) de um ficheiro lido bloco a bloco.
+    Valida também o UTF-8 na mesma passagem (levanta UnicodeDecodeError) e
+    volta a pôr o stream no início para o parse.
+    """
+    impressao = hashlib.sha256()
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for bloco in iter(lambda: stream.read(tamanho_bloco), b''):
+        impressao.update(bloco)
+        decoder.decode(bloco)
+    decoder.decode(b'', final=True)
+    stream.seek(0)
+    return impressao.hexdigest()
+
+def obter_ficheiro_ingerido(impressao):
+    """Retorna o resumo de um ficheiro já ingerido, ou None"""
+    resumo = redis_client.get(_chave_ficheiro(impressao))
+    return json.loads(resumo) if resumo else None
+
+def registar_ficheiro_ingerido(impressao, resumo):
+    redis_client.set(_chave_ficheiro(impressao), json.dumps(resumo), ex=TTL_INDICE_INGESTAO_DIAS * 86400)
+
+def _filtrar_ja_ingeridas(lote, linhas, impressoes, duplicadas):
+    """
+    Remove do lote as faturas cujo impressão já está no índice.
+    OTIMIZAÇÃO: Uma verificação O(1) por fatura, todas num único pipeline.
+    """
+    pipe = redis_client.pipeline(transaction=False)
+    for fa, impressao in zip(lote, impressoes):
+        pipe.sismember(_chave_faturas(fa), impressao)
+
+    filtrado = ([], [], [])
+    for fa, linha, impressao, existe in zip(lote, linhas, impressoes, pipe.execute()):
+        if existe:
+            duplicadas.append({'numero_fatura': linha['numero_fatura'], 'motivo': 'Fatura já importada'})
+            continue
+        filtrado[0].append(fa)
+        filtrado[1].append(linha)
+        filtrado[2].append(impressao)
+    return filtrado
+
+def _registar_faturas_ingeridas(faturas_impressoes):
+    pipe = redis_client.pipeline(transaction=False)
+    chaves = set()
+    for fa, impressao in faturas_impressoes:
+        chave = _chave_faturas(fa)
+        pipe.sadd(chave, impressao)
+        chaves.add(chave)
+    for chave in chaves:
+        pipe.expire(chave, TTL_INDICE_INGESTAO_DIAS * 86400)
+    pipe.execute()
+
+
+def detetar_separador(stream, tamanho_bloco=TAMANHO_BLOCO_LEITURA):
+    """
+    Separador de faturas do ficheiro: SEPARADOR_FATURAS se definido, senão o primeiro
+    de SEPARADORES_DETETADOS presente no primeiro bloco. Retorna '' se não houver
+    (o ficheiro é lido inteiro). Volta a pôr o stream no início.
+    """
+    if SEPARADOR_FATURAS:
+        return SEPARADOR_FATURAS
+    inicio = stream.read(tamanho_bloco).decode('utf-8', errors='ignore')
+    stream.seek(0)
+    return next((separador for separador in SEPARADORES_DETETADOS if separador in inicio), '')
+
+
+def iterar_faturas_stream(stream, separador=None, tamanho_bloco=TAMANHO_BLOCO_LEITURA):
+    """
+    Lê o upload bloco a bloco e gera as faturas à medida que ficam completas.
+    OTIMIZAÇÃO: Cada bloco é cortado no último separador de faturas; o texto
+    completo até aí vai para parse_faturas e só o resto fica pendente. A memória
+    fica limitada a um bloco e as inserções começam antes do fim do ficheiro.
+    Levanta ValueError se passar MAX_TEXTO_SEM_SEPARADOR sem encontrar um separador.
+    """
+    separador = separador or SEPARADOR_FATURAS
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    pendente = ''
+
+    for bloco in iter(lambda: stream.read(tamanho_bloco), b''):
+        # Só o texto novo (e o fim do anterior, se o separador ficou cortado) é procurado
+        inicio = max(0, len(pendente) - len(separador) + 1)
+        pendente += decoder.decode(bloco)
+        corte = pendente.rfind(separador, inicio)
+        if corte < 0:
+            if len(pendente) > MAX_TEXTO_SEM_SEPARADOR:
+                raise ValueError(
+                    f'Mais de {MAX_TEXTO_SEM_SEPARADOR} caracteres sem separador de faturas: '
+                    'confirme SEPARADOR_FATURAS'
+                )
+            continue
+
+        texto, pendente = pendente[:corte], pendente[corte + len(separador):]
+        if texto.strip():
+            yield from parse_faturas(texto)
+
+    pendente += decoder.decode(b'', final=True)
+    if pendente.strip():
+        yield from parse_faturas(pendente)
+
+
+def montar_linha_fatura(fa, agora):
+    return {
+        'numero_fatura': normalizar_numero_fatura(fa['numero_fatura']),
+        'data': fa['data'],
+        'hora': fa['hora'],
+        'total': float(fa['total']),
+        'texto_original': fa['texto_original'],
+        'texto_completo': fa['texto_completo'],
+        'qrcode': fa['qrcode'],
+        'filial': fa['filial'],
+        'nif': fa['nif_emitente'],
+        'nif_cliente': fa['nif_cliente'],
+        'criado_em': agora,
+        'atualizado_em': agora
+    }
+
+
+def montar_linha_item(fatura_id, it):
+    return {
+        'fatura_id': fatura_id,
+        'nome': it['nome'],
+        'quantidade': it['quantidade'],
+        'preco_unitario': float(it['preco_unitario']),
+        'total': float(it['total'])
+    }
+
+
+def _inserir_itens(faturas_lote, inseridas, numero_lote, erros):
+    """
+    Insere os itens de um lote de faturas em INSERTs multi-linha.
+    Os itens de uma fatura nunca são repartidos entre pedidos e, se um pedido
+    falhar, os itens são reenviados fatura a fatura, para que a falha aponte
+    exatamente as faturas afetadas.
+    Retorna os índices (no lote) das faturas cujos itens falharam.
+    """
+    falhadas = set()
+    grupos = []
+
+    def enviar():
+        try:
+            supabase.table('faturas_itemfatura').insert([l for _, linhas in grupos for l in linhas]).execute()
+            return
+        except Exception as e:
+            if len(grupos) == 1:
+                falhas = [(grupos[0][0], e)]
+            else:
+                falhas = []
+                for i, linhas in grupos:
+                    try:
+                        supabase.table('faturas_itemfatura').insert(linhas).execute()
+                    except Exception as e_fatura:
+                        falhas.append((i, e_fatura))
+
+        for i, e in falhas:
+            falhadas.add(i)
+            erros.append({
+                'numero_fatura': inseridas[i]['numero_fatura'],
+                'erro': f'Itens não inseridos: {str(e)}',
+                'lote': numero_lote
+            })
+
+    total_linhas = 0
+    for i, (fa, fatura) in enumerate(zip(faturas_lote, inseridas)):
+        linhas = [montar_linha_item(fatura['id'], it) for it in fa['itens']]
+        grupos.append((i, linhas))
+        total_linhas += len(linhas)
+        if total_linhas >= TAMANHO_LOTE_INSERCAO_ITENS:
+            enviar()
+            grupos, total_linhas = [], 0
+
+    if grupos:
+        enviar()
+    return falhadas
+
+
+def _inserir_lote(faturas_lote, linhas, impressoes, numero_lote, criadas, erros, duplicadas):
+    """Insere um lote de faturas e os respetivos itens, preenchendo criadas/erros/duplicadas"""
+    faturas_lote, linhas, impressoes = _filtrar_ja_ingeridas(faturas_lote, linhas, impressoes, duplicadas)
+    if not linhas:
+        return
+
+    # Uma construção do rollup que leia as faturas durante a inserção não marca estes dias como construídos
+    iniciar_insercao_rollup(linhas)
+    try:
+        _gravar_lote(faturas_lote, linhas, impressoes, numero_lote, criadas, erros)
+    finally:
+        terminar_insercao_rollup(linhas)
+
+
+def _carimbar(linhas):
+    """criado_em mesmo antes do INSERT: as métricas de hoje contam com ele (ver hoje.py)"""
+    agora = datetime.utcnow().isoformat()
+    for linha in linhas:
+        linha['criado_em'] = linha['atualizado_em'] = agora
+
+
+def _inserir_cabecalhos(linhas, numero_lote, erros):
+    """
+    Insere os cabeçalhos de um lote de faturas num INSERT multi-linha.
+    O INSERT é atómico: se falhar, repete fatura a fatura para que uma linha
+    em conflito não deite abaixo o lote inteiro.
+    Retorna a linha gravada de cada fatura (pela ordem de linhas), ou None se falhou.
+    """
+    _carimbar(linhas)
+    try:
+        res = supabase.table('faturas_fatura').insert(linhas).execute()
+    except Exception:
+        res = None
+
+    if res is not None:
+        inseridas = res.data or []
+        if len(inseridas) == len(linhas):
+            # O PostgREST devolve as linhas inseridas pela ordem enviada
+            return inseridas
+        for linha in linhas:
+            erros.append({
+                'numero_fatura': linha['numero_fatura'],
+                'erro': 'Falha ao inserir lote de faturas no banco de dados',
+                'lote': numero_lote
+            })
+        return [None] * len(linhas)
+
+    inseridas = []
+    for linha in linhas:
+        _carimbar([linha])
+        try:
+            res = supabase.table('faturas_fatura').insert(linha).execute()
+            if not res.data:
+                raise ValueError('Falha ao inserir fatura no banco de dados')
+            inseridas.append(res.data[0])
+        except Exception as e:
+            erros.append({'numero_fatura': linha['numero_fatura'], 'erro': str(e), 'lote': numero_lote})
+            inseridas.append(None)
+    return inseridas
+
+
+def _remover_cabecalhos(faturas):
+    """
+    Apaga as faturas cujos itens não foram gravados, para que possam ser reenviadas sem duplicar.
+    Retorna False se não foi possível apagá-las.
+    """
+    try:
+        supabase.table('faturas_fatura').delete().in_('id', [f['id'] for f in faturas]).execute()
+    except Exception as e:
+        print(f"Erro ao remover faturas sem itens: {str(e)}")
+        return False
+
+    # Entre o INSERT e o DELETE as faturas podem ter sido lidas: acumulado de hoje,
+    # segmentos e respostas em cache deixam de as contar
+    hoje = date.today().isoformat()
+    invalidar_hoje({str(f['nif']) for f in faturas if str(f.get('data')) == hoje})
+    invalidar_segmentos({str(f['nif']) for f in faturas})
+    invalidar_cache_faturas(faturas)
+    return True
+
+
+def _gravar_lote(faturas_lote, linhas, impressoes, numero_lote, criadas, erros):
+    inseridas = _inserir_cabecalhos(linhas, numero_lote, erros)
+    gravadas = [i for i, fatura in enumerate(inseridas) if fatura is not None]
+    if not gravadas:
+        return
+    faturas_lote = [faturas_lote[i] for i in gravadas]
+    impressoes = [impressoes[i] for i in gravadas]
+    inseridas = [inseridas[i] for i in gravadas]
+
+    falhadas = _inserir_itens(faturas_lote, inseridas, numero_lote, erros)
+    if falhadas and not _remover_cabecalhos([inseridas[i] for i in falhadas]):
+        # As faturas ficaram gravadas (sem itens): seguem como criadas, com o erro dos itens
+        # já reportado, para que o rollup, o cache e o índice de impressões batam com o banco
+        falhadas = set()
+
+    ingeridas = []
+    for i, (fa, fatura) in enumerate(zip(faturas_lote, inseridas)):
+        if i in falhadas:
+            continue
+        criadas.append(fatura)
+        ingeridas.append((fa, impressoes[i]))
+
+        # Incorporar a fatura no rollup horário do seu dia
+        aplicar_delta_rollup(fa['nif_emitente'], {**fatura, 'faturas_itemfatura': fa['itens']})
+
+    # Os dias em cache destes NIFs deixam de estar completos
+    invalidar_segmentos({fa['nif_emitente'] for fa, _ in ingeridas})
+    _registar_faturas_ingeridas(ingeridas)
+
+def inserir_faturas(fats, tamanho_lote=TAMANHO_LOTE_INSERCAO_FATURAS, ao_progresso=None):
+    """
+    Insere faturas e itens em lotes limitados, ignorando faturas já importadas.
+    OTIMIZAÇÃO: Um pedido por lote de faturas e um por lote de itens, em vez de
+    um pedido por fatura e outro por item.
+    Aceita qualquer iterável de faturas. ao_progresso(criadas, erros, duplicadas)
+    é chamado com as contagens após cada lote. Retorna (criadas, erros, duplicadas).
+    Erros do parser ficam em erros; falhas do banco ou do Redis propagam.
+    """
+    criadas, erros, duplicadas = [], [], []
+    lote, linhas, impressoes = [], [], []
+    vistas = set()
+    numero_lote = 0
+    faturas = iter(fats)
+
+    try:
+        while True:
+            try:
+                fa = next(faturas)
+            except StopIteration:
+                break
+            except ERROS_PARSER as e:
+                # Erro do parser em modo stream: as faturas já lidas continuam a ser inseridas
+                erros.append({'numero_fatura': 'desconhecido', 'erro': f'Erro ao ler faturas do ficheiro: {str(e)}'})
+                break
+
+            if any(not fa.get(c) for c in CAMPOS_OBRIGATORIOS):
+                erros.append({
+                    'numero_fatura': fa.get('numero_fatura', 'desconhecido'),
+                    'erro': 'Campos obrigatórios faltando'
+                })
+                continue
+
+            try:
+                linha = montar_linha_fatura(fa, datetime.utcnow().isoformat())
+                impressao = impressao_fatura(fa)
+            except ERROS_PARSER as e:
+                erros.append({'numero_fatura': normalizar_numero_fatura(fa['numero_fatura']), 'erro': str(e)})
+                continue
+
+            # Repetida dentro do próprio ficheiro
+            if impressao in vistas:
+                duplicadas.append({'numero_fatura': linha['numero_fatura'], 'motivo': 'Fatura repetida no ficheiro'})
+                continue
+            vistas.add(impressao)
+
+            lote.append(fa)
+            linhas.append(linha)
+            impressoes.append(impressao)
+            if len(lote) >= tamanho_lote:
+                numero_lote += 1
+                _inserir_lote(lote, linhas, impressoes, numero_lote, criadas, erros, duplicadas)
+                lote, linhas, impressoes = [], [], []
+                if ao_progresso:
+                    ao_progresso(len(criadas), len(erros), len(duplicadas))
+
+        if lote:
+            numero_lote += 1
+            _inserir_lote(lote, linhas, impressoes, numero_lote, criadas, erros, duplicadas)
+    except Exception:
+        # Falha de infraestrutura: a ingestão pára, mas as faturas já gravadas não podem
+        # ficar escondidas por respostas em cache
+        if criadas:
+            invalidar_cache_faturas(criadas)
+        raise
+
+    if ao_progresso:
+        ao_progresso(len(criadas), len(erros), len(duplicadas))
+
+    return criadas, erros, duplicadas
+
+
+def processar_ficheiro(ficheiro, ao_progresso=None):
+    """
+    Processa um ficheiro de faturas completo: impressão digital, parse e inserção.
+    ficheiro é um objeto binário posicionável (stream do upload ou ficheiro temporário).
+    Levanta ValueError quando o ficheiro não pode ser processado.
+    Só é lido em stream quando há separador de faturas (ver detetar_separador).
+    Retorna um dicionário com criadas, erros, duplicadas e, para ficheiros já
+    ingeridos, o resumo da ingestão anterior em 'ingerido'.
+    """
+    # Em modo stream o ficheiro nunca é carregado inteiro em memória
+    separador = detetar_separador(ficheiro)
+    modo_stream = bool(separador)
+
+    try:
+        if modo_stream:
+            impressao = impressao_ficheiro_stream(ficheiro)
+        else:
+            conteudo = ficheiro.read()
+            impressao = impressao_ficheiro(conteudo)
+            text = conteudo.decode('utf-8')
+    except UnicodeDecodeError:
+        raise ValueError('Arquivo com codificação inválida. Use UTF-8')
+
+    # Ficheiro já ingerido: responder sem fazer parse nem tocar no banco
+    ingerido = obter_ficheiro_ingerido(impressao)
+    if ingerido:
+        return {'criadas': [], 'erros': [], 'duplicadas': [], 'ingerido': ingerido}
+
+    if modo_stream:
+        # As faturas são geradas à medida que o ficheiro é lido e vão direto para a inserção
+        fats = iterar_faturas_stream(ficheiro, separador)
+    else:
+        try:
+            fats = parse_faturas(text)
+        except Exception as e:
+            raise ValueError(str(e))
+        if not fats:
+            raise ValueError('Nenhuma fatura válida encontrada no arquivo')
+
+    # Inserção em lotes de faturas e itens, ignorando faturas já importadas
+    criadas, erros, duplicadas = inserir_faturas(fats, ao_progresso=ao_progresso)
+    if not (criadas or erros or duplicadas):
+        raise ValueError('Nenhuma fatura válida encontrada no arquivo')
+
+    # Só um ficheiro sem erros fica registado, para que falhas parciais possam ser reenviadas
+    if not erros:
+        registar_ficheiro_ingerido(impressao, {
+            'faturas': len(criadas) + len(duplicadas),
+            'processado_em': datetime.now().isoformat()
+        })
+
+    return {'criadas': criadas, 'erros': erros, 'duplicadas': duplicadas, 'ingerido': None}
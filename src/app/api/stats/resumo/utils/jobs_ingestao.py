@@ -0,0 +1,171 @@
+# 🔹 Jobs de ingestão em background
+
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from .utils import redis_client
+from .ingestao import processar_ficheiro
+
+# Workers locais dedicados à ingestão, separados dos workers que atendem pedidos
+MAX_WORKERS_INGESTAO = int(os.getenv('MAX_WORKERS_INGESTAO', '2'))
+# Tempo que o estado de um job fica disponível para consulta (1 dia)
+TTL_JOB_INGESTAO = 86400
+# Erros guardados no estado do job (a lista completa pode ser enorme)
+MAX_ERROS_JOB = 100
+
+# Os jobs só existem no pool do processo que os criou. Cada processo com jobs bate no
+# Redis a cada TTL_BATIMENTO_SEGUNDOS / 3: um job por terminar cujo processo deixou de
+# bater (reinício, crash) é marcado como erro na consulta seguinte
+TTL_BATIMENTO_SEGUNDOS = int(os.getenv('TTL_BATIMENTO_INGESTAO_SEGUNDOS', 60))
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS_INGESTAO, thread_name_prefix='ingestao')
+_batimento = {'pid': None, 'processo': None}
+_batimento_lock = threading.Lock()
+
+
+def _chave_job(job_id):
+    return f"ingestao:job:{job_id}"
+
+def _chave_batimento(processo):
+    return f"ingestao:processo:{processo}"
+
+
+def _bater(processo):
+    while True:
+        time.sleep(TTL_BATIMENTO_SEGUNDOS / 3)
+        try:
+            redis_client.set(_chave_batimento(processo), 1, ex=TTL_BATIMENTO_SEGUNDOS)
+        except Exception as e:
+            print(f"Erro ao registar batimento da ingestão: {str(e)}")
+
+
+def _processo_atual():
+    """
+    Identificador deste processo nos jobs, com o batimento já iniciado.
+    Um processo criado por fork não herda a thread do batimento: recebe um novo.
+    """
+    with _batimento_lock:
+        if _batimento['pid'] != os.getpid():
+            processo = uuid.uuid4().hex
+            redis_client.set(_chave_batimento(processo), 1, ex=TTL_BATIMENTO_SEGUNDOS)
+            threading.Thread(target=_bater, args=(processo,), name='ingestao-batimento', daemon=True).start()
+            _batimento.update(pid=os.getpid(), processo=processo)
+        return _batimento['processo']
+
+def _atualizar_job(job_id, **campos):
+    chave = _chave_job(job_id)
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.hset(chave, mapping={k: json.dumps(v) for k, v in campos.items()})
+    pipe.expire(chave, TTL_JOB_INGESTAO)
+    pipe.execute()
+
+
+def obter_job(job_id):
+    """
+    Retorna o estado de um job com contagens e throughput (faturas/s), ou None.
+    O estado fica no Redis, por isso qualquer worker Flask pode responder.
+    """
+    dados = redis_client.hgetall(_chave_job(job_id))
+    if not dados:
+        return None
+
+    job = {'job_id': job_id, **{k.decode('utf-8'): json.loads(v) for k, v in dados.items()}}
+    if job.get('estado') in ('em_fila', 'a_processar') and not redis_client.exists(_chave_batimento(job.get('processo'))):
+        job.update(_marcar_orfao(job_id, job.get('caminho')))
+
+    processadas = job.get('processadas', 0) + job.get('falhadas', 0) + job.get('duplicadas', 0)
+    inicio = job.get('inicio_ts')
+    if inicio:
+        decorrido = (job.get('fim_ts') or time.time()) - inicio
+        job['segundos'] = round(decorrido, 2)
+        job['throughput'] = round(processadas / decorrido, 2) if decorrido > 0 else 0.0
+    for campo in ('inicio_ts', 'fim_ts', 'processo', 'caminho'):
+        job.pop(campo, None)
+    return job
+
+
+def _marcar_orfao(job_id, caminho):
+    """Job cujo processo terminou a meio: passa a erro e o ficheiro temporário é apagado"""
+    campos = {
+        'estado': 'erro',
+        'fim_ts': time.time(),
+        'fim': datetime.now().isoformat(),
+        'erro': 'Ingestão interrompida: o processo que a executava terminou. Reenvie o ficheiro'
+    }
+    _atualizar_job(job_id, **campos)
+    _remover_ficheiro(caminho)
+    return campos
+
+
+def _remover_ficheiro(caminho):
+    try:
+        os.remove(caminho)
+    except (OSError, TypeError):
+        pass
+
+
+def job_do_nif(job, nif):
+    """Se o job pertence ao NIF: declarado no upload ou emitente de faturas criadas pelo job"""
+    return bool(job) and str(nif) in job.get('nifs', [])
+
+
+def _executar_job(job_id, caminho, ao_concluir, nifs):
+    _atualizar_job(job_id, estado='a_processar', inicio_ts=time.time(), inicio=datetime.now().isoformat())
+
+    def progresso(criadas, erros, duplicadas):
+        _atualizar_job(job_id, processadas=criadas, falhadas=erros, duplicadas=duplicadas)
+
+    try:
+        with open(caminho, 'rb') as ficheiro:
+            resultado = processar_ficheiro(ficheiro, ao_progresso=progresso)
+
+        cache_limpo = ao_concluir(resultado['criadas']) if ao_concluir and resultado['criadas'] else 0
+        nifs = sorted(set(nifs) | {str(f['nif']) for f in resultado['criadas'] if f.get('nif')})
+        _atualizar_job(
+            job_id,
+            estado='concluido',
+            fim_ts=time.time(),
+            fim=datetime.now().isoformat(),
+            processadas=len(resultado['criadas']),
+            falhadas=len(resultado['erros']),
+            duplicadas=len(resultado['duplicadas']),
+            ficheiro_duplicado=bool(resultado['ingerido']),
+            erros=resultado['erros'][:MAX_ERROS_JOB],
+            cache_limpo=cache_limpo,
+            nifs=nifs
+        )
+    except Exception as e:
+        _atualizar_job(job_id, estado='erro', fim_ts=time.time(), fim=datetime.now().isoformat(), erro=str(e))
+    finally:
+        _remover_ficheiro(caminho)
+
+
+def criar_job(caminho, nome_ficheiro, ao_concluir=None, nif=None):
+    """
+    Coloca na fila a ingestão de um ficheiro já gravado em disco e retorna o job_id.
+    O ficheiro é apagado no fim. ao_concluir(criadas) é chamado com as faturas
+    criadas (por exemplo para invalidar cache) e deve retornar um inteiro.
+    O job pertence ao NIF declarado no upload e, no fim, também aos emitentes das
+    faturas criadas (ver job_do_nif).
+    """
+    nifs = [str(nif)] if nif else []
+    job_id = uuid.uuid4().hex
+    _atualizar_job(
+        job_id,
+        estado='em_fila',
+        processo=_processo_atual(),
+        caminho=caminho,
+        ficheiro=nome_ficheiro,
+        criado_em=datetime.now().isoformat(),
+        processadas=0,
+        falhadas=0,
+        duplicadas=0,
+        nifs=nifs
+    )
+    _executor.submit(_executar_job, job_id, caminho, ao_concluir, nifs)
+    return job_id
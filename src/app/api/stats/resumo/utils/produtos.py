@@ -0,0 +1,115 @@
+# 🔹 Dimensão de produtos e ranking top-K para os períodos atual e anterior
+
+import heapq
+
+from .heatmap import ATUAL
+
+CHAVES_PRODUTO = ("quantidade", "montante", "faturamento")
+
+
+class Dimensao:
+    """Converte valores (produtos, dias, filiais) em códigos inteiros compactos"""
+
+    def __init__(self):
+        self.codigos = {}
+        self.valores = []
+
+    def codigo(self, valor):
+        codigo = self.codigos.get(valor)
+        if codigo is None:
+            codigo = self.codigos[valor] = len(self.valores)
+            self.valores.append(valor)
+        return codigo
+
+    def __len__(self):
+        return len(self.valores)
+
+
+class RankingProdutos:
+    """
+    Leitura e ranking das métricas por produto de ambos os períodos.
+    As subclasses guardam os vetores linhas, quantidade, montante e faturamento,
+    indexados por período e código de produto.
+    """
+
+    def __init__(self, dimensao=None):
+        self.dimensao = dimensao or Dimensao()
+
+    def _vetor(self, chave, periodo):
+        return getattr(self, chave)[periodo]
+
+    def _codigos(self, periodo):
+        linhas = self.linhas[periodo]
+        return [codigo for codigo in range(len(linhas)) if linhas[codigo]]
+
+    def _produto(self, periodo, codigo):
+        return {
+            "produto": self.dimensao.valores[codigo],
+            "quantidade": self.quantidade[periodo][codigo],
+            "montante": self.montante[periodo][codigo],
+            "faturamento": self.faturamento[periodo][codigo]
+        }
+
+    def quantidade_produtos(self, periodo=ATUAL):
+        return len(self._codigos(periodo))
+
+    def totais(self, periodo=ATUAL):
+        """Retorna (quantidade, montante, faturamento) totais do período"""
+        return tuple(sum(self._vetor(chave, periodo)) for chave in CHAVES_PRODUTO)
+
+    def _top_codigos(self, periodo, n, chave):
+        valores = self._vetor(chave, periodo)
+        return heapq.nlargest(n, self._codigos(periodo), key=valores.__getitem__)
+
+    def top(self, periodo=ATUAL, n=10, chave="montante"):
+        """Os n produtos com maior valor na chave, sem ordenar todos os produtos"""
+        return [self._produto(periodo, codigo) for codigo in self._top_codigos(periodo, n, chave)]
+
+    def ordenados(self, periodo=ATUAL, chave="montante"):
+        """Todos os produtos do período, ordenados pela chave (ordenação completa)"""
+        valores = self._vetor(chave, periodo)
+        codigos = sorted(self._codigos(periodo), key=valores.__getitem__, reverse=True)
+        return [self._produto(periodo, codigo) for codigo in codigos]
+
+    def como_dict(self, periodo=ATUAL):
+        """{nome: {quantidade, montante, faturamento}} do período"""
+        return {
+            self.dimensao.valores[codigo]: {
+                chave: self._vetor(chave, periodo)[codigo] for chave in CHAVES_PRODUTO
+            }
+            for codigo in self._codigos(periodo)
+        }
+
+
+class ProdutosPeriodos(RankingProdutos):
+    """
+    Quantidade, montante e faturamento por produto de ambos os períodos.
+    OTIMIZAÇÃO: Os nomes são convertidos uma só vez em códigos inteiros
+    (Dimensao) partilhados pelos dois períodos, e as métricas ficam em vetores
+    indexados por código. O ranking usa seleção parcial (heap) para os
+    top-K; a ordenação completa só acontece quando se pede a lista inteira.
+    """
+
+    def __init__(self, dimensao=None):
+        super().__init__(dimensao)
+        # Linhas de item por produto: distingue produtos vendidos de códigos vazios
+        self.linhas = [[], []]
+        self.quantidade = [[], []]
+        self.montante = [[], []]
+        self.faturamento = [[], []]
+
+    def _codigo(self, nome):
+        codigo = self.dimensao.codigo(nome)
+        if codigo >= len(self.linhas[ATUAL]):
+            crescimento = codigo + 1 - len(self.linhas[ATUAL])
+            for vetores, zero in ((self.linhas, 0), (self.quantidade, 0), (self.montante, 0.0), (self.faturamento, 0.0)):
+                for vetor in vetores:
+                    vetor.extend([zero] * crescimento)
+        return codigo
+
+    def adicionar(self, periodo, nome, quantidade, montante, faturamento, linhas=1):
+        codigo = self._codigo(nome)
+        self.linhas[periodo][codigo] += linhas
+        self.quantidade[periodo][codigo] += quantidade
+        self.montante[periodo][codigo] += montante
+        self.faturamento[periodo][codigo] += faturamento
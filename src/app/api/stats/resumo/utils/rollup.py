@@ -0,0 +1,444 @@
+# 🔹 Rollup horário de faturas por NIF, filial, dia e hora
+
+import os
+import threading
+from collections import OrderedDict, defaultdict
+from datetime import date, timedelta
+
+from .utils import redis_client, iterar_lotes_faturas_periodo, CAMPOS_FATURA_CELULAS
+
+# Fonte usada pelas rotas analíticas: 'rollup' (agregados pré-calculados), 'faturas'
+# (faturas em bruto) ou 'rpc' (agregação na base de dados, ver agregacao_rpc.py).
+# O rollup não precisa de backfill: os dias em falta são construídos na primeira leitura
+# (ler_rollup); POST /api/rollup/construir só serve para os preparar antes.
+FONTE_AGREGACAO = os.getenv('FONTE_AGREGACAO', 'rollup')
+
+# Hora usada para faturas sem hora válida: contam nos totais mas não nas curvas horárias
+HORA_DESCONHECIDA = -1
+
+# Dias fechados mantidos em memória por processo (sem TTL: só saem por LRU ou por nova versão)
+MAX_DIAS_FECHADOS_MEMORIA = int(os.getenv('MAX_DIAS_FECHADOS_MEMORIA', 20000))
+
+
+def _chave_dia(nif, dia_iso):
+    return f"rollup:{nif}:{dia_iso}"
+
+def _chave_dias_construidos(nif):
+    return f"rollup_dias:{nif}"
+
+def _chave_versoes(nif):
+    return f"rollup_versoes:{nif}"
+
+def _chave_alteracoes(nif):
+    return f"rollup_alteracoes:{nif}"
+
+def _chave_em_curso(nif):
+    return f"rollup_em_curso:{nif}"
+
+# Um marcador de inserção em curso que ficou para trás (processo morto a meio) deixa de
+# impedir a construção dos seus dias ao fim deste tempo
+TTL_EM_CURSO_SEGUNDOS = int(os.getenv('ROLLUP_TTL_EM_CURSO_SEGUNDOS', 3600))
+
+# Versões por dia no hash rollup_versoes:{nif}:
+#   "dia"          reconstruções do dia (invalida todas as filiais)
+#   "dia|"         alterações ao dia em qualquer filial
+#   "dia|filial"   alterações ao dia nessa filial
+def _campos_versao(dia_iso, filial=None):
+    return (dia_iso, f"{dia_iso}|{filial or ''}")
+
+def _decode(valor):
+    return valor.decode('utf-8') if isinstance(valor, bytes) else valor
+
+def nova_celula():
+    return {
+        'total': 0.0,
+        'recibos': 0,
+        'itens': 0,
+        'produtos': defaultdict(lambda: {'quantidade': 0, 'montante': 0.0, 'faturamento': 0.0})
+    }
+
+def normalizar_numero(valor):
+    """Quantidades (e itens) podem ser fracionárias (ex.: kg): só as inteiras voltam a int"""
+    numero = float(valor or 0)
+    return int(numero) if numero.is_integer() else numero
+
+def filial_da_fatura(fatura):
+    """Filial como texto ('' sem filial): a coluna é numérica, as chaves das células são texto"""
+    return str(fatura.get('filial') or '')
+
+def hora_da_fatura(fatura):
+    hora_str = fatura.get('hora')
+    if not hora_str:
+        return HORA_DESCONHECIDA
+    try:
+        hora = int(hora_str.split(":")[0])
+    except (ValueError, IndexError):
+        return HORA_DESCONHECIDA
+    return hora if 0 <= hora < 24 else HORA_DESCONHECIDA
+
+
+def acumular_celulas(celulas, faturas):
+    """
+    Acumula faturas em células {dia_iso: {(filial, hora): celula}}.
+    Cada célula guarda total, número de recibos, itens e totais por produto.
+    """
+    for fatura in faturas:
+        dia_iso = fatura.get('data')
+        if not dia_iso:
+            continue
+
+        filial = filial_da_fatura(fatura)
+        hora = hora_da_fatura(fatura)
+
+        dia_celulas = celulas.setdefault(dia_iso, {})
+        celula = dia_celulas.get((filial, hora))
+        if celula is None:
+            celula = dia_celulas[(filial, hora)] = nova_celula()
+
+        celula['total'] += float(fatura.get('total', 0))
+        celula['recibos'] += 1
+
+        for item in (fatura.get('faturas_itemfatura') or []):
+            quantidade = item.get('quantidade', 0)
+            produto = celula['produtos'][item.get('nome') or 'Produto Desconhecido']
+            produto['quantidade'] += quantidade
+            produto['montante'] += quantidade * float(item.get('preco_unitario', 0.0))
+            produto['faturamento'] += float(item.get('total', 0))
+            celula['itens'] += quantidade
+    return celulas
+
+
+def calcular_celulas(nif, data_ini, data_fim, filial=None):
+    """Calcula as células de um intervalo diretamente a partir das faturas"""
+    celulas = {}
+    for lote in iterar_lotes_faturas_periodo(nif, data_ini, data_fim, filial=filial, campos=CAMPOS_FATURA_CELULAS):
+        acumular_celulas(celulas, lote)
+    return celulas
+
+
+def _celulas_para_hash(dia_celulas):
+    """
+    Serializa as células de um dia para um hash Redis.
+    Campos: c|filial|hora|{t,r,i} e p|filial|hora|{q,m,f}|produto
+    """
+    mapping = {}
+    for (filial, hora), celula in dia_celulas.items():
+        mapping[f"c|{filial}|{hora}|t"] = celula['total']
+        mapping[f"c|{filial}|{hora}|r"] = celula['recibos']
+        mapping[f"c|{filial}|{hora}|i"] = celula['itens']
+        for nome, produto in celula['produtos'].items():
+            mapping[f"p|{filial}|{hora}|q|{nome}"] = produto['quantidade']
+            mapping[f"p|{filial}|{hora}|m|{nome}"] = produto['montante']
+            mapping[f"p|{filial}|{hora}|f|{nome}"] = produto['faturamento']
+    return mapping
+
+def _hash_para_celulas(mapping):
+    campos_celula = {'t': 'total', 'r': 'recibos', 'i': 'itens'}
+    campos_produto = {'q': 'quantidade', 'm': 'montante', 'f': 'faturamento'}
+
+    dia_celulas = {}
+    for campo, valor in mapping.items():
+        campo = _decode(campo)
+        valor = _decode(valor)
+        if campo.startswith('c|'):
+            _, filial, hora, tipo = campo.split('|', 3)
+            nome = None
+        else:
+            _, filial, hora, tipo, nome = campo.split('|', 4)
+
+        celula = dia_celulas.get((filial, int(hora)))
+        if celula is None:
+            celula = dia_celulas[(filial, int(hora))] = nova_celula()
+
+        valor = normalizar_numero(valor) if tipo in ('r', 'i', 'q') else float(valor)
+        if nome is None:
+            celula[campos_celula[tipo]] += valor
+        else:
+            celula['produtos'][nome][campos_produto[tipo]] += valor
+    return dia_celulas
+
+
+def _intervalos_contiguos(dias):
+    """Agrupa uma lista ordenada de datas em intervalos (inicio, fim) contíguos"""
+    intervalos = []
+    for dia in dias:
+        if intervalos and intervalos[-1][1] + timedelta(days=1) == dia:
+            intervalos[-1][1] = dia
+        else:
+            intervalos.append([dia, dia])
+    return [(inicio, fim) for inicio, fim in intervalos]
+
+
+# Grava o rollup de um dia e marca-o como construído, mas só se nenhuma fatura desse dia
+# foi gravada desde que as faturas foram lidas (contador de alterações igual ao lido antes
+# da leitura) nem está a ser inserida agora (marcador em curso). Caso contrário o dia fica
+# por construir e é lido de novo das faturas na próxima leitura.
+# KEYS: rollup_dias, rollup:{nif}:{dia}, rollup_versoes, rollup_alteracoes, rollup_em_curso
+# ARGV: dia, alterações lidas antes da leitura, pares campo/valor...
+_SCRIPT_CONSTRUIR = redis_client.register_script("""
+redis.call('HINCRBY', KEYS[3], ARGV[1], 1)
+redis.call('DEL', KEYS[2])
+local alteracoes = tonumber(redis.call('HGET', KEYS[4], ARGV[1]) or '0')
+local em_curso = tonumber(redis.call('HGET', KEYS[5], ARGV[1]) or '0')
+if alteracoes ~= tonumber(ARGV[2]) or em_curso > 0 then
+    redis.call('SREM', KEYS[1], ARGV[1])
+    return 0
+end
+for i = 3, #ARGV, 2 do
+    redis.call('HSET', KEYS[2], ARGV[i], ARGV[i + 1])
+end
+redis.call('SADD', KEYS[1], ARGV[1])
+return 1
+""")
+
+
+def construir_rollup(nif, data_ini, data_fim):
+    """
+    Constrói (ou reconstrói) o rollup dos dias fechados de um intervalo.
+    O dia de hoje nunca é gravado: continua a receber vendas e é sempre calculado na hora.
+    Um dia que recebeu faturas durante a construção não fica marcado como construído
+    (ver _SCRIPT_CONSTRUIR), para que essas faturas não se percam nem contem a dobrar.
+    Retorna as células calculadas para todo o intervalo.
+    """
+    ultimo_fechado = min(data_fim, date.today() - timedelta(days=1))
+    dias_iso = []
+    dia = data_ini
+    while dia <= ultimo_fechado:
+        dias_iso.append(dia.isoformat())
+        dia += timedelta(days=1)
+
+    # Alterações de cada dia antes de ler as faturas
+    alteracoes = redis_client.hmget(_chave_alteracoes(nif), dias_iso) if dias_iso else []
+
+    celulas = calcular_celulas(nif, data_ini, data_fim)
+
+    pipe = redis_client.pipeline(transaction=False)
+    chaves_nif = [_chave_versoes(nif), _chave_alteracoes(nif), _chave_em_curso(nif)]
+    for dia_iso, alteracoes_dia in zip(dias_iso, alteracoes):
+        argumentos = [dia_iso, int(alteracoes_dia or 0)]
+        for campo, valor in _celulas_para_hash(celulas.get(dia_iso, {})).items():
+            argumentos.extend([campo, valor])
+        _SCRIPT_CONSTRUIR(
+            keys=[_chave_dias_construidos(nif), _chave_dia(nif, dia_iso), *chaves_nif],
+            args=argumentos,
+            client=pipe
+        )
+    pipe.execute()
+
+    return celulas
+
+
+class _DiasFechados:
+    """
+    Células de dias fechados por (nif, filial, dia), guardadas sem TTL.
+    Cada entrada leva as versões do dia lidas no Redis; só é usada enquanto
+    essas versões não mudarem (upload ou reconstrução desse dia).
+    """
+
+    def __init__(self, maximo=MAX_DIAS_FECHADOS_MEMORIA):
+        self.maximo = maximo
+        self._dias = OrderedDict()
+        self._lock = threading.Lock()
+
+    def obter(self, nif, filial, dia_iso, versao):
+        chave = (nif, filial or '', dia_iso)
+        with self._lock:
+            entrada = self._dias.get(chave)
+            if entrada is None or entrada[0] != versao:
+                return None
+            self._dias.move_to_end(chave)
+            return entrada[1]
+
+    def guardar(self, nif, filial, dia_iso, versao, dia_celulas):
+        if self.maximo <= 0:
+            return
+        chave = (nif, filial or '', dia_iso)
+        with self._lock:
+            self._dias[chave] = (versao, dia_celulas)
+            self._dias.move_to_end(chave)
+            while len(self._dias) > self.maximo:
+                self._dias.popitem(last=False)
+
+
+dias_fechados = _DiasFechados()
+
+
+def _filtrar_filial(dia_celulas, filial):
+    if not filial:
+        return dia_celulas
+    filial = str(filial)
+    return {chave: celula for chave, celula in dia_celulas.items() if chave[0] == filial}
+
+
+def _ler_dias_construidos(nif, dias_iso, filial=None):
+    """
+    Células dos dias já construídos, da memória quando a versão do dia não mudou.
+    OTIMIZAÇÃO: Um HMGET das versões valida todos os dias em memória; só os dias
+    alterados desde a última leitura fazem HGETALL, lidos em conjunto com as suas
+    versões numa transação para não guardar um dia com a versão de outro estado.
+    """
+    chave_versoes = _chave_versoes(nif)
+    campos = [campo for dia_iso in dias_iso for campo in _campos_versao(dia_iso, filial)]
+    valores = redis_client.hmget(chave_versoes, campos)
+    versoes = {
+        dia_iso: (_decode(valores[2 * i]), _decode(valores[2 * i + 1]))
+        for i, dia_iso in enumerate(dias_iso)
+    }
+
+    celulas = {}
+    a_ler = []
+    for dia_iso in dias_iso:
+        dia_celulas = dias_fechados.obter(nif, filial, dia_iso, versoes[dia_iso])
+        if dia_celulas is None:
+            a_ler.append(dia_iso)
+        else:
+            celulas[dia_iso] = dia_celulas
+
+    if a_ler:
+        pipe = redis_client.pipeline(transaction=True)
+        for dia_iso in a_ler:
+            pipe.hmget(chave_versoes, list(_campos_versao(dia_iso, filial)))
+            pipe.hgetall(_chave_dia(nif, dia_iso))
+        respostas = pipe.execute()
+        for i, dia_iso in enumerate(a_ler):
+            versao = tuple(_decode(v) for v in respostas[2 * i])
+            dia_celulas = _filtrar_filial(_hash_para_celulas(respostas[2 * i + 1]), filial)
+            dias_fechados.guardar(nif, filial, dia_iso, versao, dia_celulas)
+            celulas[dia_iso] = dia_celulas
+    return celulas
+
+
+def ler_rollup(nif, data_ini, data_fim, filial=None):
+    """
+    Lê as células (dia, filial, hora) de um intervalo.
+    OTIMIZAÇÃO: Dias fechados vêm da memória do processo enquanto a sua versão não
+    mudar, e caso contrário do rollup (um HGETALL por dia num único pipeline);
+    dias ainda não construídos são preenchidos uma vez e ficam gravados; hoje vem
+    do acumulado incremental (celulas_hoje), que só lê as faturas novas.
+    Retorna: {dia_iso: {(filial, hora): celula}}
+    """
+    hoje = date.today()
+    construidos = {_decode(d) for d in redis_client.smembers(_chave_dias_construidos(nif))}
+
+    fechados = []
+    dia = data_ini
+    while dia <= data_fim and dia < hoje:
+        fechados.append(dia)
+        dia += timedelta(days=1)
+
+    celulas = {}
+
+    # Backfill dos dias fechados que ainda não têm rollup
+    em_falta = [d for d in fechados if d.isoformat() not in construidos]
+    for inicio, fim in _intervalos_contiguos(em_falta):
+        for dia_iso, dia_celulas in construir_rollup(nif, inicio, fim).items():
+            celulas[dia_iso] = _filtrar_filial(dia_celulas, filial)
+
+    # Ler os dias já construídos
+    a_ler = [d.isoformat() for d in fechados if d.isoformat() in construidos]
+    if a_ler:
+        celulas.update(_ler_dias_construidos(nif, a_ler, filial=filial))
+
+    # Hoje a partir do acumulado incremental, já filtrado por filial
+    if data_ini <= hoje <= data_fim:
+        from .hoje import celulas_hoje
+        celulas[hoje.isoformat()] = celulas_hoje(nif, filial=filial)
+
+    # Datas futuras (ex.: resto da semana) a partir das faturas
+    if data_fim > hoje:
+        celulas.update(calcular_celulas(nif, max(data_ini, hoje + timedelta(days=1)), data_fim, filial=filial))
+
+    return celulas
+
+
+# Conta a alteração do dia (ver _SCRIPT_CONSTRUIR) e aplica os incrementos só se esse
+# dia já tiver rollup construído, incrementando as versões do dia (geral e das filiais
+# afetadas) na mesma operação.
+# Dias sem rollup são construídos a partir das faturas na próxima leitura, que já as inclui.
+# KEYS: rollup_dias, rollup:{nif}:{dia}, rollup_versoes, rollup_alteracoes
+# ARGV: dia, número de filiais, filiais..., pares campo/valor...
+_SCRIPT_DELTA = redis_client.register_script("""
+redis.call('HINCRBY', KEYS[4], ARGV[1], 1)
+if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+local n = tonumber(ARGV[2])
+redis.call('HINCRBY', KEYS[3], ARGV[1] .. '|', 1)
+for i = 3, 2 + n do
+    redis.call('HINCRBY', KEYS[3], ARGV[1] .. '|' .. ARGV[i], 1)
+end
+for i = 3 + n, #ARGV, 2 do
+    redis.call('HINCRBYFLOAT', KEYS[2], ARGV[i], ARGV[i + 1])
+end
+return 1
+""")
+
+
+def _dias_fechados_das_faturas(faturas):
+    """Pares (nif, dia_iso) das faturas, só dos dias anteriores a hoje, com o número de faturas"""
+    hoje_iso = date.today().isoformat()
+    contagem = defaultdict(int)
+    for fatura in faturas:
+        dia_iso = fatura.get('data')
+        if fatura.get('nif') and dia_iso and dia_iso < hoje_iso:
+            contagem[(str(fatura['nif']), dia_iso)] += 1
+    return contagem
+
+
+def _marcar_em_curso(faturas, sinal):
+    pipe = redis_client.pipeline(transaction=False)
+    for (nif, dia_iso), n in _dias_fechados_das_faturas(faturas).items():
+        pipe.hincrby(_chave_em_curso(nif), dia_iso, sinal * n)
+        pipe.expire(_chave_em_curso(nif), TTL_EM_CURSO_SEGUNDOS)
+    pipe.execute()
+
+
+def iniciar_insercao_rollup(faturas):
+    """
+    Marca os dias das faturas (linhas com 'nif' e 'data') como tendo inserções em curso.
+    Deve ser chamado antes do INSERT, e terminar_insercao_rollup depois dos deltas,
+    para que uma construção que leia as faturas entretanto não marque esses dias como construídos.
+    """
+    _marcar_em_curso(faturas, 1)
+
+
+def terminar_insercao_rollup(faturas):
+    """Retira os marcadores de iniciar_insercao_rollup (também quando o INSERT falha)"""
+    try:
+        _marcar_em_curso(faturas, -1)
+    except Exception as e:
+        # O marcador expira sozinho (TTL_EM_CURSO_SEGUNDOS)
+        print(f"Erro ao terminar inserção no rollup: {str(e)}")
+
+
+def aplicar_delta_rollup(nif, fatura):
+    """
+    Incorpora uma fatura acabada de inserir no rollup do seu dia.
+    OTIMIZAÇÃO: O incremento é atómico (script Lua) e custa um pedido ao Redis por
+    fatura, em vez de obrigar as leituras a recalcular o período.
+    A fatura deve trazer os itens em 'faturas_itemfatura'.
+    """
+    celulas = acumular_celulas({}, [fatura])
+    for dia_iso, dia_celulas in celulas.items():
+        if dia_iso >= date.today().isoformat():
+            # Hoje é sempre calculado a partir das faturas
+            continue
+
+        filiais = sorted({filial for filial, _ in dia_celulas if filial})
+        argumentos = [dia_iso, len(filiais), *filiais]
+        for campo, valor in _celulas_para_hash(dia_celulas).items():
+            argumentos.extend([campo, valor])
+
+        try:
+            _SCRIPT_DELTA(
+                keys=[_chave_dias_construidos(nif), _chave_dia(nif, dia_iso), _chave_versoes(nif), _chave_alteracoes(nif)],
+                args=argumentos
+            )
+        except Exception as e:
+            # Sem o delta o rollup do dia ficaria errado: força a reconstrução na próxima
+            # leitura, impede uma construção em curso de o marcar como construído e
+            # invalida as cópias do dia em memória
+            print(f"Erro ao atualizar rollup: {str(e)}")
+            redis_client.srem(_chave_dias_construidos(nif), dia_iso)
+            redis_client.hincrby(_chave_alteracoes(nif), dia_iso, 1)
+            redis_client.hincrby(_chave_versoes(nif), dia_iso, 1)
@@ -0,0 +1,157 @@
+# 🔹 Cache em memória de faturas por dia, reutilizado entre períodos
+
+import os
+import threading
+from collections import OrderedDict
+from datetime import date, timedelta
+
+from .utils import redis_client, iterar_lotes_faturas_periodo
+
+# Memória máxima do cache de segmentos por processo (0 desativa o cache)
+CACHE_SEGMENTOS_MAX_BYTES = int(os.getenv('CACHE_SEGMENTOS_MAX_BYTES', 256 * 1024 * 1024))
+
+# Estimativa de memória ocupada por fatura e por item (dicionários do PostgREST)
+BYTES_POR_FATURA = 1200
+BYTES_POR_ITEM = 600
+
+
+def _chave_versao(nif):
+    return f"segmentos:versao:{nif}"
+
+
+def _estimar_bytes(faturas):
+    return sum(BYTES_POR_FATURA + BYTES_POR_ITEM * len(f.get('faturas_itemfatura') or []) for f in faturas)
+
+
+class CacheSegmentos:
+    """
+    Faturas de dias fechados por (nif, filial, dia), com despejo LRU por memória.
+    Cada segmento guarda a versão do NIF em que foi lido; um upload incrementa a
+    versão no Redis e os segmentos antigos deixam de ser usados em todos os workers.
+    """
+
+    def __init__(self, max_bytes=CACHE_SEGMENTOS_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._segmentos = OrderedDict()
+        self._lock = threading.Lock()
+
+    def obter(self, nif, filial, dia_iso, versao):
+        """Faturas do dia, ou None se o dia não estiver em cache nessa versão"""
+        with self._lock:
+            faturas = self._obter(nif, filial, dia_iso, versao)
+            if faturas is None and filial:
+                # Um segmento de todas as filiais também responde a uma filial
+                faturas = self._obter(nif, None, dia_iso, versao)
+                if faturas is not None:
+                    faturas = [f for f in faturas if str(f.get('filial')) == str(filial)]
+            return faturas
+
+    def _obter(self, nif, filial, dia_iso, versao):
+        chave = (nif, filial or '', dia_iso)
+        segmento = self._segmentos.get(chave)
+        if segmento is None:
+            return None
+        if segmento[0] != versao:
+            self._remover(chave)
+            return None
+        self._segmentos.move_to_end(chave)
+        return segmento[1]
+
+    def guardar(self, nif, filial, dia_iso, versao, faturas):
+        tamanho = _estimar_bytes(faturas)
+        if tamanho > self.max_bytes:
+            return
+        chave = (nif, filial or '', dia_iso)
+        with self._lock:
+            self._remover(chave)
+            self._segmentos[chave] = (versao, faturas, tamanho)
+            self.bytes += tamanho
+            while self.bytes > self.max_bytes:
+                self._remover(next(iter(self._segmentos)))
+
+    def _remover(self, chave):
+        segmento = self._segmentos.pop(chave, None)
+        if segmento is not None:
+            self.bytes -= segmento[2]
+
+    def remover_nif(self, nif):
+        with self._lock:
+            for chave in [c for c in self._segmentos if c[0] == nif]:
+                self._remover(chave)
+
+
+cache_segmentos = CacheSegmentos()
+
+
+def _versao_atual(nif):
+    """Versão dos dados do NIF no Redis, ou None se o Redis não responder (cache desligado)"""
+    try:
+        return int(redis_client.get(_chave_versao(nif)) or 0)
+    except Exception as e:
+        print(f"Erro ao ler versão dos segmentos: {str(e)}")
+        return None
+
+
+def invalidar_segmentos(nifs):
+    """Marca como desatualizados os segmentos em cache dos NIFs (chamado após uploads)"""
+    for nif in map(str, nifs):
+        cache_segmentos.remover_nif(nif)
+        try:
+            redis_client.incr(_chave_versao(nif))
+        except Exception as e:
+            print(f"Erro ao invalidar segmentos: {str(e)}")
+
+
+def _buscar_e_guardar(nif, data_ini, data_fim, filial, versao):
+    """Lê um intervalo de dias em falta, gera os lotes e guarda cada dia (mesmo sem faturas)"""
+    por_dia = {}
+    for lote in iterar_lotes_faturas_periodo(nif, data_ini, data_fim, filial=filial):
+        for fatura in lote:
+            por_dia.setdefault(fatura.get('data'), []).append(fatura)
+        yield lote
+
+    # Só chega aqui se o intervalo foi lido por completo
+    dia = data_ini
+    while dia <= data_fim:
+        cache_segmentos.guardar(nif, filial, dia.isoformat(), versao, por_dia.get(dia.isoformat(), []))
+        dia += timedelta(days=1)
+
+
+def iterar_lotes_faturas_cache(nif, data_ini, data_fim, filial=None):
+    """
+    Gera as faturas de um período em lotes, como iterar_lotes_faturas_periodo,
+    reutilizando os dias fechados já lidos por qualquer período.
+    OTIMIZAÇÃO: Os períodos encaixam uns nos outros (semana ⊂ mês ⊂ trimestre ⊂ ano);
+    só os dias em falta são lidos da base, agrupados em intervalos contíguos.
+    Hoje nunca é guardado: continua a receber vendas.
+    """
+    versao = _versao_atual(nif) if CACHE_SEGMENTOS_MAX_BYTES > 0 else None
+    if versao is None:
+        yield from iterar_lotes_faturas_periodo(nif, data_ini, data_fim, filial=filial)
+        return
+
+    hoje = date.today()
+    dia = data_ini
+    while dia <= data_fim:
+        if dia >= hoje:
+            # Hoje e datas futuras: sempre da base, sem guardar
+            yield from iterar_lotes_faturas_periodo(nif, dia, data_fim, filial=filial)
+            return
+
+        faturas = cache_segmentos.obter(nif, filial, dia.isoformat(), versao)
+        if faturas is not None:
+            if faturas:
+                yield faturas
+            dia += timedelta(days=1)
+            continue
+
+        # Estender o intervalo em falta até ao próximo dia em cache (ou até hoje)
+        fim = dia
+        seguinte = fim + timedelta(days=1)
+        while seguinte <= data_fim and seguinte < hoje and cache_segmentos.obter(nif, filial, seguinte.isoformat(), versao) is None:
+            fim = seguinte
+            seguinte = fim + timedelta(days=1)
+
+        yield from _buscar_e_guardar(nif, dia, fim, filial, versao)
+        dia = fim + timedelta(days=1)
@@ -0,0 +1,65 @@
+-- Agregação de faturas no servidor (FONTE_AGREGACAO=rpc).
+-- Devolve as mesmas células do rollup, já somadas na base de dados, num único
+-- valor jsonb (uma chamada, sem max-rows nem paginação por offset):
+--   tipo 'c': totais por (data, filial, hora)
+--   tipo 'p': totais por (segmento, filial, produto), com hora = -1; cada segmento
+--             começa num dos p_cortes (limites dos períodos) ou em p_data_ini
+-- Hora -1 = fatura sem hora válida (conta nos totais, não nas curvas horárias).
+-- Instalar no Supabase (SQL editor) antes de ativar o modo rpc; a versão anterior
+-- (returns table, sem p_cortes) tem de ser removida primeiro.
+
+drop function if exists agregar_celulas_faturas(text, date, date, text);
+
+create or replace function agregar_celulas_faturas(
+    p_nif text,
+    p_data_ini date,
+    p_data_fim date,
+    p_filial text default null,
+    p_cortes date[] default '{}'
+)
+returns jsonb
+language sql
+stable
+as $$
+    with faturas as (
+        select
+            f.id,
+            f.data,
+            coalesce(f.filial::text, '') as filial,
+            case
+                when f.hora::text ~ '^\s*\d{1,2}:' and split_part(f.hora::text, ':', 1)::int between 0 and 23
+                    then split_part(f.hora::text, ':', 1)::int
+                else -1
+            end as hora,
+            f.total,
+            coalesce((select max(c) from unnest(p_cortes) as c where c <= f.data), p_data_ini) as segmento
+        from faturas_fatura f
+        where f.nif::text = p_nif
+          and f.data between p_data_ini and p_data_fim
+          and (p_filial is null or f.filial::text = p_filial)
+    ),
+    itens_fatura as (
+        select i.fatura_id, sum(i.quantidade) as itens
+        from faturas_itemfatura i
+        join faturas fa on fa.id = i.fatura_id
+        group by i.fatura_id
+    ),
+    linhas as (
+        select 'c' as tipo, fa.data, fa.filial, fa.hora, null::text as produto,
+               sum(fa.total) as total, count(*) as recibos, coalesce(sum(it.itens), 0) as itens,
+               null::numeric as quantidade, null::numeric as montante, null::numeric as faturamento
+        from faturas fa
+        left join itens_fatura it on it.fatura_id = fa.id
+        group by fa.data, fa.filial, fa.hora
+
+        union all
+
+        select 'p', fa.segmento, fa.filial, -1, coalesce(nullif(i.nome, ''), 'Produto Desconhecido'),
+               null::numeric, null::bigint, null::numeric,
+               sum(i.quantidade), sum(i.quantidade * i.preco_unitario), sum(i.total)
+        from faturas fa
+        join faturas_itemfatura i on i.fatura_id = fa.id
+        group by fa.segmento, fa.filial, coalesce(nullif(i.nome, ''), 'Produto Desconhecido')
+    )
+    select coalesce(jsonb_agg(to_jsonb(l)), '[]'::jsonb) from linhas l
+$$;
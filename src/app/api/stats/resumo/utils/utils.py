@@ -3,6 +3,7 @@
 from collections import defaultdict
 from typing import Optional
 from .supabaseUtil import get_supabase
+from .consultas import consulta_faturas, montar_select, CAMPOS_ITEM_PRODUTOS
 
 supabase = get_supabase()
 
@@ -11,8 +12,7 @@ def is_valid_nif(nif):
 
 # Funções para buscar faturas por data e NIF
 def buscar_faturas_por_data(nif, data_obj):
-    response = supabase.table("faturas_fatura") \
-        .select("*, itens:faturas_itemfatura(*)") \
+    response = consulta_faturas(supabase, COLUNAS_FATURA_PERIODO, CAMPOS_ITEM_PRODUTOS) \
         .eq("data", data_obj.isoformat()) \
         .eq("nif", nif) \
         .execute()
@@ -72,23 +72,21 @@ def gerar_comparativo_por_hora(vendas_hoje, vendas_ontem):
     return comparativo
 
 
+import os
 import redis
-redis_client = redis.Redis.from_url("redis://localhost:6379/0")
+# Mesmo Redis do cache do Flask (REDIS_URL); localhost só quando não está configurado
+redis_client = redis.Redis.from_url(os.getenv('REDIS_URL') or "redis://localhost:6379/0")
 
 def limpar_cache_por_nif(nif: str):
     if not nif or not nif.isdigit():
         raise ValueError("NIF inválido")
     
     try:
-        # Usar cache do Flask
-        from main import cache
-        # Limpar cache específico para o NIF
-        cache.delete(f"dados_resumo_ia:{nif}:todas:0")
-        cache.delete(f"dados_resumo_ia:{nif}:todas:1")
-        cache.delete(f"dados_resumo_ia:{nif}:todas:2")
-        cache.delete(f"dados_resumo_ia:{nif}:todas:3")
-        cache.delete(f"dados_resumo_ia:{nif}:todas:4")
-        cache.delete(f"dados_resumo_ia:{nif}:todas:5")
+        # OTIMIZAÇÃO: Um INCR da geração do NIF retira todas as entradas de cache
+        # do NIF (todas as rotas, períodos e filiais); as antigas expiram pelo TTL
+        from .geracoes import invalidar_cache
+        if invalidar_cache(nif) is None:
+            return "Erro ao limpar cache: Redis indisponível"
         return f"Cache limpo para NIF {nif}"
     except Exception as e:
         # Se houver erro, retorna mensagem de erro
@@ -169,27 +167,87 @@ def get_periodo_datas(periodo):
 
 
 
-def buscar_faturas_periodo(nif, data_ini, data_fim, filial=None):
+# Tamanho de página pedido na paginação por keyset (o servidor pode devolver menos, ver max-rows)
+TAMANHO_LOTE_FATURAS = 1000
+
+# Colunas de fatura da agregação e da listagem de faturas de um período
+COLUNAS_FATURA_PERIODO = ('id', 'data', 'total', 'numero_fatura', 'hora', 'nif_cliente', 'filial')
+
+# Colunas de que as células (dia, filial, hora) precisam: o id só serve a paginação
+COLUNAS_FATURA_CELULAS = ('id', 'data', 'total', 'hora', 'filial')
+
+CAMPOS_FATURA_PERIODO = montar_select(COLUNAS_FATURA_PERIODO, CAMPOS_ITEM_PRODUTOS)
+CAMPOS_FATURA_CELULAS = montar_select(COLUNAS_FATURA_CELULAS, CAMPOS_ITEM_PRODUTOS)
+
+# Campos para leituras de vários NIFs, em que cada fatura tem de dizer a que NIF pertence
+CAMPOS_FATURA_GRUPO = montar_select(('nif',) + COLUNAS_FATURA_PERIODO, CAMPOS_ITEM_PRODUTOS)
+
+
+def _filtro_valor_ou_lista(query, coluna, valor):
+    """eq para um valor, in para uma lista de valores"""
+    if isinstance(valor, (list, tuple, set)):
+        return query.in_(coluna, list(valor))
+    return query.eq(coluna, valor)
+
+
+def iterar_lotes_faturas_periodo(nif, data_ini, data_fim, filial=None, tamanho_lote=TAMANHO_LOTE_FATURAS,
+                                 depois_id=None, campos=CAMPOS_FATURA_PERIODO):
     """
-    Busca faturas de um período específico.
-    OTIMIZAÇÃO: Consulta mais eficiente com seleção específica de campos.
+    Gera as faturas de um período em lotes, paginando por keyset (data, id).
+    OTIMIZAÇÃO: Cada página continua a partir da última (data, id) vista, por isso
+    o custo por página é constante e o limite de linhas do PostgREST deixa de
+    truncar períodos longos. Só um lote fica em memória de cada vez.
+    nif e filial aceitam um valor ou uma lista (uma só consulta com filtro in).
+    Com depois_id só são lidas faturas com id superior (leituras incrementais).
     """
-    try:
-        # Construir query base
+    ultima_data = ultimo_id = None
+
+    while True:
         query = supabase.table('faturas_fatura') \
-            .select('id, data, total, numero_fatura, hora, nif_cliente, filial, faturas_itemfatura(id, nome, quantidade, preco_unitario, total)') \
-            .eq('nif', nif) \
+            .select(campos) \
             .gte('data', data_ini.isoformat()) \
             .lte('data', data_fim.isoformat())
 
-        # Adicionar filtro de filial se especificado
+        query = _filtro_valor_ou_lista(query, 'nif', nif)
         if filial:
-            query = query.eq('filial', filial)
+            query = _filtro_valor_ou_lista(query, 'filial', filial)
+
+        if depois_id is not None:
+            query = query.gt('id', depois_id)
+
+        # Continuar depois do último registo da página anterior
+        if ultimo_id is not None:
+            query = query.or_(f"data.gt.{ultima_data},and(data.eq.{ultima_data},id.gt.{ultimo_id})")
+
+        res = query.order('data').order('id').limit(tamanho_lote).execute()
+        lote = res.data or []
+        if not lote:
+            return
+
+        yield lote
+
+        # Uma página curta não é a última: o max-rows do PostgREST pode ser menor
+        # que tamanho_lote. Só uma página vazia termina o período
+        ultima_data = lote[-1]['data']
+        ultimo_id = lote[-1]['id']
+
+
+def buscar_faturas_periodo(nif, data_ini, data_fim, filial=None):
+    """
+    Busca faturas de um período específico.
+    OTIMIZAÇÃO: Consulta mais eficiente com seleção específica de campos, e os
+    dias fechados já lidos por outros períodos vêm do cache de segmentos.
+    Para períodos longos prefira iterar_lotes_faturas_cache, que não junta
+    todas as faturas numa única lista.
+    """
+    from .segmentos import iterar_lotes_faturas_cache
+
+    try:
+        faturas = []
+        for lote in iterar_lotes_faturas_cache(nif, data_ini, data_fim, filial=filial):
+            faturas.extend(lote)
+        return faturas
 
-        # Executar consulta
-        res = query.execute()
-        return res.data or []
-        
     except Exception as e:
         # Log do erro para debug
         print(f"Erro ao buscar faturas: {str(e)}")
@@ -205,19 +263,17 @@ def limpar_cache_dados_ia(nif: str, periodo: Optional[int] = None, filial: Optio
     
     try:
         from main import cache
+        from .geracoes import chave_com_geracao, invalidar_cache
         
         if periodo is not None:
-            # Limpar cache específico para período
+            # Limpar cache específico para período (a chave da geração atual)
             filial_key = filial or "todas"
-            cache_key = f"dados_resumo_ia:{nif}:{filial_key}:{periodo}"
+            cache_key = chave_com_geracao(f"dados_resumo_ia:{nif}:{filial_key}:{periodo}", nif, filial)
             cache.delete(cache_key)
             return f"Cache limpo para NIF {nif}, período {periodo}"
         else:
-            # Limpar cache para todos os períodos
-            filial_key = filial or "todas"
-            for p in range(6):  # 0-5 períodos
-                cache_key = f"dados_resumo_ia:{nif}:{filial_key}:{p}"
-                cache.delete(cache_key)
+            # Todos os períodos: um INCR da geração do NIF/filial
+            invalidar_cache(nif, filial)
             return f"Cache limpo para NIF {nif}, todos os períodos"
             
     except Exception as e:
@@ -227,7 +283,9 @@ def limpar_cache_dados_ia(nif: str, periodo: Optional[int] = None, filial: Optio
 def buscar_faturas_multiplos_periodos(nif, periodos_datas, filial=None):
     """
     Busca faturas para múltiplos períodos em uma única consulta.
-    OTIMIZAÇÃO: Uma consulta para todos os períodos, depois filtra no código.
+    OTIMIZAÇÃO: Uma leitura do intervalo que cobre todos os períodos, e cada
+    lote é distribuído pelos períodos numa só passagem, comparando as datas ISO
+    como texto (sem converter cada data).
     
     Args:
         nif: NIF do cliente
@@ -237,38 +295,29 @@ def buscar_faturas_multiplos_periodos(nif, periodos_datas, filial=None):
     Returns:
         dict: {nome_periodo: [faturas]}
     """
+    from .segmentos import iterar_lotes_faturas_cache
+
     try:
+        if not periodos_datas:
+            return {}
+
         # Encontrar o período mais amplo que cubra todos os períodos
-        todas_datas = []
-        for data_ini, data_fim, _ in periodos_datas:
-            todas_datas.extend([data_ini, data_fim])
-        
-        data_mais_antiga = min(todas_datas)
-        data_mais_recente = max(todas_datas)
-        
-        # Uma única consulta ao banco
-        faturas_completas = buscar_faturas_periodo(nif, data_mais_antiga, data_mais_recente, filial)
-        
-        # Filtrar faturas por período
-        resultado = {}
-        
-        for data_ini, data_fim, nome_periodo in periodos_datas:
-            faturas_periodo = []
-            
-            for fatura in faturas_completas:
+        data_mais_antiga = min(data_ini for data_ini, _, _ in periodos_datas)
+        data_mais_recente = max(data_fim for _, data_fim, _ in periodos_datas)
+
+        limites = [(data_ini.isoformat(), data_fim.isoformat(), nome) for data_ini, data_fim, nome in periodos_datas]
+        resultado = {nome: [] for _, _, nome in limites}
+
+        # Uma única leitura, distribuída pelos períodos
+        for lote in iterar_lotes_faturas_cache(nif, data_mais_antiga, data_mais_recente, filial=filial):
+            for fatura in lote:
                 data_fatura = fatura.get('data')
-                if data_fatura:
-                    # Converter string para date se necessário
-                    if isinstance(data_fatura, str):
-                        from datetime import datetime
-                        data_fatura = datetime.strptime(data_fatura, '%Y-%m-%d').date()
-                    
-                    # Verificar se a fatura está no período
-                    if data_ini <= data_fatura <= data_fim:
-                        faturas_periodo.append(fatura)
-            
-            resultado[nome_periodo] = faturas_periodo
-        
+                if not data_fatura:
+                    continue
+                for inicio, fim, nome in limites:
+                    if inicio <= data_fatura <= fim:
+                        resultado[nome].append(fatura)
+
         return resultado
         
     except Exception as e:
@@ -286,9 +335,10 @@ def gerar_dados_resumo_ia(nif: str, periodo: int, filial: Optional[str] = None)
     from datetime import datetime
     from typing import Optional
     
-    # Gerar chave de cache única
+    # Gerar chave de cache única (com a geração do NIF/filial)
+    from .geracoes import chave_com_geracao
     filial_key = filial or "todas"
-    cache_key = f"dados_resumo_ia:{nif}:{filial_key}:{periodo}"
+    cache_key = chave_com_geracao(f"dados_resumo_ia:{nif}:{filial_key}:{periodo}", nif, filial)
     
     try:
         # Tentar obter dados do cache primeiro
@@ -305,75 +355,33 @@ def gerar_dados_resumo_ia(nif: str, periodo: int, filial: Optional[str] = None)
         # Obter datas do período
         data_inicio, data_fim, data_inicio_anterior, data_fim_anterior = get_periodo_datas(periodo)
 
-        # OTIMIZAÇÃO: Uma única chamada ao banco para ambos os períodos
-        # Buscar faturas do período mais amplo (anterior + atual)
-        data_mais_antiga = min(data_inicio_anterior, data_inicio)
-        data_mais_recente = max(data_fim_anterior, data_fim)
-        
-        # Uma única consulta ao banco
-        faturas_completas = buscar_faturas_periodo(nif, data_mais_antiga, data_mais_recente, filial=filial)
-        
-        # Filtrar faturas por período no código
-        faturas_atual = []
-        faturas_anterior = []
-        
-        for fatura in faturas_completas:
-            data_fatura = fatura.get('data')
-            if data_fatura:
-                # Converter string para date se necessário
-                if isinstance(data_fatura, str):
-                    from datetime import datetime
-                    data_fatura = datetime.strptime(data_fatura, '%Y-%m-%d').date()
-                
-                # Filtrar por período
-                if data_inicio <= data_fatura <= data_fim:
-                    faturas_atual.append(fatura)
-                elif data_inicio_anterior <= data_fatura <= data_fim_anterior:
-                    faturas_anterior.append(fatura)
-
-        # Processar todas as faturas de uma vez usando a função otimizada
-        dados_processados = processar_faturas_otimizado(faturas_completas, data_inicio, data_fim, data_inicio_anterior, data_fim_anterior)
+        # OTIMIZAÇÃO: Uma única leitura e uma única passagem para ambos os períodos
+        from .agregacao import agregar_periodo
+        from .heatmap import ATUAL
+        dados_processados = agregar_periodo(nif, data_inicio, data_fim, data_inicio_anterior, data_fim_anterior, filial=filial)
         
         # Extrair dados processados
         total_at, rec_at, it_at, tk_at = dados_processados['stats_atual']
         total_bt, rec_bt, it_bt, tk_bt = dados_processados['stats_anterior']
         comparativo_hora = dados_processados['comparativo_por_hora']
-        faturas_atual = dados_processados['faturas_atual']
         vendas_por_hora_atual = dados_processados['vendas_por_hora_atual']
+        produtos = dados_processados['produtos']
 
-        # Análise de produtos
-        produtos_mais_vendidos = []
-        if faturas_atual:
-            produtos = defaultdict(lambda: {'quantidade': 0, 'faturamento': 0.0})
-            for fatura in faturas_atual:
-                for item in fatura.get('faturas_itemfatura', []):
-                    nome_produto = item.get('nome', 'Produto Desconhecido')
-                    quantidade = item.get('quantidade', 0)
-                    total_item = item.get('total', 0)
-                    
-                    produtos[nome_produto]['quantidade'] += quantidade
-                    produtos[nome_produto]['faturamento'] += float(total_item)
-            
-            produtos_mais_vendidos = sorted(
-                [{'produto': k, 'quantidade': v['quantidade'], 'faturamento': round(v['faturamento'], 2)} for k, v in produtos.items()],
-                key=lambda x: x['faturamento'],
-                reverse=True
-            )[:10]
+        # Análise de produtos (top 10 por seleção parcial, sem ordenar todos)
+        produtos_mais_vendidos = [
+            {'produto': v['produto'], 'quantidade': v['quantidade'], 'faturamento': round(v['faturamento'], 2)}
+            for v in produtos.top(ATUAL, 10, 'faturamento')
+        ]
 
-        # Análise por filiais
+        # Análise por filiais (da mesma passagem de agregação)
         analise_filiais = {}
         if not filial:
-            filiais_agg = defaultdict(float)
-            for fatura in faturas_atual:
-                filiais_agg[fatura.get('filial', 'Sem Filial')] += float(fatura.get('total', 0))
+            from .filiais import metricas_filiais
+            volume_por_filial = metricas_filiais(dados_processados)
             
-            if filiais_agg:
-                analise_filiais['volume_por_filial'] = sorted(
-                    [{'filial': k, 'volume': round(v, 2), 'percentual_total': (v / total_at * 100) if total_at > 0 else 0} for k, v in filiais_agg.items()],
-                    key=lambda x: x['volume'],
-                    reverse=True
-                )
-                analise_filiais['total_filiais'] = len(filiais_agg)
+            if volume_por_filial:
+                analise_filiais['volume_por_filial'] = volume_por_filial
+                analise_filiais['total_filiais'] = len(volume_por_filial)
 
         # Preparar dados estruturados
         dados_ia = {
@@ -407,7 +415,7 @@ def gerar_dados_resumo_ia(nif: str, periodo: int, filial: Optional[str] = None)
             },
             "analise_produtos": {
                 "top_10_mais_vendidos": produtos_mais_vendidos,
-                "total_produtos_unicos": len(produtos)
+                "total_produtos_unicos": produtos.quantidade_produtos(ATUAL)
             },
             "analise_filiais": analise_filiais if not filial else None,
         }
@@ -415,16 +423,8 @@ def gerar_dados_resumo_ia(nif: str, periodo: int, filial: Optional[str] = None)
         # Salvar no cache com timeout baseado no período
         try:
             from main import cache
-            timeout_cache = {
-                0: 300,    # Hoje: 5 minutos
-                1: 600,    # Ontem: 10 minutos
-                2: 1800,   # Semana: 30 minutos
-                3: 3600,   # Mês: 1 hora
-                4: 7200,   # Trimestre: 2 horas
-                5: 14400   # Ano: 4 horas
-            }
-            timeout = timeout_cache.get(periodo, 1800)  # Default: 30 minutos
-            cache.set(cache_key, dados_ia, timeout=timeout)
+            from .cache_rotas import ttl_periodo
+            cache.set(cache_key, dados_ia, timeout=ttl_periodo(periodo))
         except ImportError:
             # Se não conseguir importar cache, continua sem cache
             pass
@@ -436,126 +436,25 @@ def gerar_dados_resumo_ia(nif: str, periodo: int, filial: Optional[str] = None)
         return {"success": False, "error": f"Erro ao gerar dados para IA: {str(e)}"}
 
 
-def calcular_stats_otimizado(faturas_completas, data_inicio, data_fim, data_inicio_anterior, data_fim_anterior):
+def processar_lotes_faturas(lotes, data_inicio, data_fim, data_inicio_anterior, data_fim_anterior, manter_faturas=True):
     """
-    Calcula estatísticas para ambos os períodos em uma única passagem pelos dados.
-    Retorna: (stats_atual, stats_anterior)
+    Processa faturas lote a lote, acumulando as estatísticas de ambos os períodos.
+    OTIMIZAÇÃO: Cada lote é dobrado no acumulado assim que chega, portanto com
+    manter_faturas=False a memória fica limitada ao tamanho de um lote.
+    Retorna o resultado de AgregadorFaturas.
     """
-    total_atual = total_anterior = 0.0
-    recibos_atual = recibos_anterior = 0
-    itens_atual = itens_anterior = 0
-    
-    for fatura in faturas_completas:
-        data_fatura = fatura.get('data')
-        if not data_fatura:
-            continue
-            
-        # Converter string para date se necessário
-        if isinstance(data_fatura, str):
-            from datetime import datetime
-            data_fatura = datetime.strptime(data_fatura, '%Y-%m-%d').date()
-        
-        total_fatura = float(fatura.get('total', 0))
-        itens_fatura = sum(item.get('quantidade', 0) for item in (fatura.get('faturas_itemfatura') or []))
-        
-        # Determinar a qual período pertence
-        if data_inicio <= data_fatura <= data_fim:
-            total_atual += total_fatura
-            recibos_atual += 1
-            itens_atual += itens_fatura
-        elif data_inicio_anterior <= data_fatura <= data_fim_anterior:
-            total_anterior += total_fatura
-            recibos_anterior += 1
-            itens_anterior += itens_fatura
-    
-    # Calcular ticket médio
-    ticket_atual = round(total_atual / recibos_atual, 2) if recibos_atual else 0.0
-    ticket_anterior = round(total_anterior / recibos_anterior, 2) if recibos_anterior else 0.0
-    
-    stats_atual = (total_atual, recibos_atual, itens_atual, ticket_atual)
-    stats_anterior = (total_anterior, recibos_anterior, itens_anterior, ticket_anterior)
-    
-    return stats_atual, stats_anterior
+    from .agregacao import criar_agregador
 
-def agrupar_por_hora_otimizado(faturas_completas, data_inicio, data_fim, data_inicio_anterior, data_fim_anterior):
-    """
-    Agrupa vendas por hora para ambos os períodos em uma única passagem pelos dados.
-    Retorna: (vendas_por_hora_atual, vendas_por_hora_anterior)
-    """
-    vendas_por_hora_atual = defaultdict(float)
-    vendas_por_hora_anterior = defaultdict(float)
-    
-    for fatura in faturas_completas:
-        data_fatura = fatura.get('data')
-        if not data_fatura:
-            continue
-            
-        # Converter string para date se necessário
-        if isinstance(data_fatura, str):
-            from datetime import datetime
-            data_fatura = datetime.strptime(data_fatura, '%Y-%m-%d').date()
-        
-        hora_str = fatura.get('hora')
-        if not hora_str:
-            continue
-            
-        try:
-            hora = int(hora_str.split(":")[0])
-            total_fatura = float(fatura.get('total', 0))
-            
-            # Determinar a qual período pertence
-            if data_inicio <= data_fatura <= data_fim:
-                vendas_por_hora_atual[hora] += total_fatura
-            elif data_inicio_anterior <= data_fatura <= data_fim_anterior:
-                vendas_por_hora_anterior[hora] += total_fatura
-                
-        except (ValueError, IndexError):
-            continue
-    
-    return dict(vendas_por_hora_atual), dict(vendas_por_hora_anterior)
+    agregador = criar_agregador(data_inicio, data_fim, data_inicio_anterior, data_fim_anterior, manter_faturas=manter_faturas)
+    for lote in lotes:
+        agregador.adicionar_lote(lote)
+    return agregador.resultado()
 
 def processar_faturas_otimizado(faturas_completas, data_inicio, data_fim, data_inicio_anterior, data_fim_anterior):
     """
     Processa todas as faturas de uma vez, separando por período e calculando todas as estatísticas.
     Retorna um dicionário com todos os dados processados.
     """
-    # Calcular estatísticas para ambos os períodos
-    stats_atual, stats_anterior = calcular_stats_otimizado(
-        faturas_completas, data_inicio, data_fim, data_inicio_anterior, data_fim_anterior
+    return processar_lotes_faturas(
+        [faturas_completas], data_inicio, data_fim, data_inicio_anterior, data_fim_anterior
     )
-    
-    # Agrupar vendas por hora para ambos os períodos
-    vendas_por_hora_atual, vendas_por_hora_anterior = agrupar_por_hora_otimizado(
-        faturas_completas, data_inicio, data_fim, data_inicio_anterior, data_fim_anterior
-    )
-    
-    # Gerar comparativo por hora
-    comparativo_por_hora = gerar_comparativo_por_hora(vendas_por_hora_atual, vendas_por_hora_anterior)
-    
-    # Separar faturas por período para uso posterior
-    faturas_atual = []
-    faturas_anterior = []
-    
-    for fatura in faturas_completas:
-        data_fatura = fatura.get('data')
-        if data_fatura:
-            # Converter string para date se necessário
-            if isinstance(data_fatura, str):
-                from datetime import datetime
-                data_fatura = datetime.strptime(data_fatura, '%Y-%m-%d').date()
-            
-            # Filtrar por período
-            if data_inicio <= data_fatura <= data_fim:
-                faturas_atual.append(fatura)
-            elif data_inicio_anterior <= data_fatura <= data_fim_anterior:
-                faturas_anterior.append(fatura)
-    
-    return {
-        'stats_atual': stats_atual,
-        'stats_anterior': stats_anterior,
-        'vendas_por_hora_atual': vendas_por_hora_atual,
-        'vendas_por_hora_anterior': vendas_por_hora_anterior,
-        'comparativo_por_hora': comparativo_por_hora,
-        'faturas_atual': faturas_atual,
-        'faturas_anterior': faturas_anterior
-    }